@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import sqlite3
+import hashlib
+import datetime
+import threading
+
+
+def segment_path(directory, segment):
+    return os.path.join(directory, 'segment-%06d.z' % segment)
+
+
+def read_blob(directory, segment, offset, length):
+    """
+    :return: the content stored at offset of the segment, decompressed; a
+             module-level function, so that other processes can read the
+             archive without opening its index
+    """
+    with open(segment_path(directory, segment), 'rb') as h:
+        h.seek(offset)
+        return zlib.decompress(h.read(length))
+
+
+class PageArchive(object):
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, timeout=30.0):
+        """
+        The pages fetched by the flows, as they were fetched, so that the
+        records can be extracted again (e.g. with a fixed generator) without
+        fetching them again.
+
+        The contents are compressed one by one and appended to segment files,
+        a new one being started once the current one has grown past
+        segment_size; nothing is ever rewritten. The same content is stored
+        only once, whatever the number of times it is fetched: an unchanged
+        page only costs a row of the index. The index, an SQLite database,
+        tells where each content is and which page of which flow was fetched
+        when.
+
+        Several processes (e.g. those sharing a lease queue) may add to the
+        same archive: each addition is one write transaction of the index,
+        taken before anything is read, that also serializes the appends to
+        the segments.
+
+        :param directory: where the segments and the index are
+        :param segment_size: size in bytes from which a new segment is started
+        :param timeout: seconds to wait for the other processes' additions
+        :return:
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.sqlite'), timeout=timeout,
+                                    check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS blobs ('
+            ' digest TEXT PRIMARY KEY,'  # sha1 hex digest of the content
+            ' segment INTEGER NOT NULL,'
+            ' offset INTEGER NOT NULL,'
+            ' length INTEGER NOT NULL,'  # compressed
+            ' size INTEGER NOT NULL)')    # uncompressed
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            ' id INTEGER PRIMARY KEY,'
+            ' url TEXT NOT NULL,'        # url of the flow
+            ' page INTEGER NOT NULL,'
+            ' location TEXT NOT NULL,'   # where the page was fetched from
+            ' content_type TEXT,'
+            ' fetched TEXT NOT NULL,'    # 'YYYY-mm-dd HH:MM:SS'
+            ' digest TEXT NOT NULL REFERENCES blobs (digest))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pages_url_fetched ON pages (url, fetched)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pages_fetched ON pages (fetched)')
+
+    def append(self, compressed):
+        """
+        Appends to the last segment, or to a new one; only within the write
+        transaction of add(), so that no other process appends meanwhile.
+
+        :return: tuple (segment, offset) of the data appended
+        """
+        segment = self.conn.execute('SELECT MAX(segment) FROM blobs').fetchone()[0] or 1
+        path = segment_path(self.directory, segment)
+        if os.access(path, os.F_OK) and os.path.getsize(path) >= self.segment_size:
+            segment += 1
+            path = segment_path(self.directory, segment)
+        with open(path, 'ab') as h:
+            h.seek(0, os.SEEK_END)  # whatever is there, even what a crash left unindexed, stays
+            offset = h.tell()
+            h.write(compressed)
+            h.flush()
+            os.fsync(h.fileno())  # before the index refers to it
+        return segment, offset
+
+    def add(self, url, page, location, content, content_type, fetched=None):
+        """
+        :param url: the url of the flow
+        :param fetched: when the page was fetched, 'YYYY-mm-dd HH:MM:SS',
+                        now if None
+        :return: True if the content was not in the archive yet
+        """
+        digest = hashlib.sha1(content).hexdigest()
+        fetched = fetched or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                new = self.conn.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone() is None
+                if new:
+                    compressed = zlib.compress(content, 6)
+                    segment, offset = self.append(compressed)
+                    self.conn.execute('INSERT INTO blobs (digest, segment, offset, length, size) VALUES (?, ?, ?, ?, ?)',
+                                      (digest, segment, offset, len(compressed), len(content)))
+                self.conn.execute(
+                    'INSERT INTO pages (url, page, location, content_type, fetched, digest) VALUES (?, ?, ?, ?, ?, ?)',
+                    (url, page, location, content_type, fetched, digest))
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+        return new
+
+    def pages(self, urls=None, since=None, until=None):
+        """
+        :param urls: urls of the flows whose pages are wanted, all if None
+        :param since: first day of the pages wanted, 'YYYY-mm-dd'
+        :param until: last day of the pages wanted, 'YYYY-mm-dd'
+        :return: list of tuples (url, page, location, content_type, fetched,
+                 segment, offset, length) of the distinct contents of each
+                 page of each flow, as first fetched, by flow then fetch time;
+                 see read_blob()
+        """
+        if urls is None:
+            return self.select_pages(None, since, until)
+        # by chunks of urls, SQLite taking at most 999 parameters; in order,
+        # so that the pages stay by flow
+        urls = sorted(set(urls))
+        pages = []
+        for i in xrange(0, len(urls), self.max_urls):
+            pages.extend(self.select_pages(urls[i:i + self.max_urls], since, until))
+        return pages
+
+    max_urls = 500  # per query of pages()
+
+    def select_pages(self, urls, since, until):
+        conditions, parameters = [], []
+        if urls is not None:
+            conditions.append('p.url IN (%s)' % ', '.join(['?'] * len(urls)))
+            parameters.extend(urls)
+        if since:
+            conditions.append('p.fetched >= ?')
+            parameters.append(since)
+        if until:
+            conditions.append('p.fetched < ?')
+            parameters.append(until + '~')  # after all the times of the day
+        with self.lock:
+            return self.conn.execute(
+                'SELECT p.url, p.page, p.location, p.content_type, MIN(p.fetched), b.segment, b.offset, b.length'
+                ' FROM pages p JOIN blobs b ON b.digest = p.digest%s'
+                ' GROUP BY p.url, p.page, p.digest ORDER BY p.url, MIN(p.fetched), p.page' % (
+                    ' WHERE ' + ' AND '.join(conditions) if conditions else ''), parameters).fetchall()
+
+    def content(self, digest):
+        """
+        :return: the content of the digest, None if it is not in the archive
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT segment, offset, length FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        return read_blob(self.directory, *row) if row else None
+
+    def size(self):
+        """
+        :return: tuple (pages fetched, distinct contents, their size, their
+                 compressed size)
+        """
+        with self.lock:
+            fetched = self.conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+            contents, size, length = self.conn.execute(
+                'SELECT COUNT(*), SUM(size), SUM(length) FROM blobs').fetchone()
+        return fetched, contents, size or 0, length or 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,337 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Benchmarks over the cached pages in sample-data/, without touching the
+# network:
+#   benchmark.py [-n ITERATIONS] [--suite SUITE ...] [--update-golden]
+# The scaling suite is only meaningful on a machine with several cores.
+# The load suite runs copies of the flows against the mock portal (see
+# mockportal.py), fetching for real over the loopback interface.
+# The golden suite checks the records extracted from the pages against those
+# in benchmark-golden.json, so that performance work cannot silently change
+# them; --update-golden rewrites that file when a change is intended.
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import codecs
+import multiprocessing
+import bs4
+import crawl
+import mockportal
+
+GOLDEN = 'benchmark-golden.json'
+STAGES = ['fetch', 'decode', 'parse', 'select', 'generator', 'commit']
+
+
+def cpu_time():
+    return time.clock()  # processor time on Unix, wall-clock time on Windows
+
+
+def load_soups(flows):
+    soups = []
+    for flow in flows:
+        text = crawl.CrawlerDataSource.fetch_text(flow.location)
+        soups.append(bs4.BeautifulSoup(text, 'html.parser'))
+    return soups
+
+
+def bench_matcher(flows, soups, iterations):
+    """
+    Compares SoupAncestorSearch.search_soup_for_tags() with the compiled
+    matchers of the flows: both must find the very same tags, in the same
+    order.
+
+    :return: True if the outputs are identical for all flows
+    """
+    identical = True
+    total_legacy = total_compiled = 0.0
+    print '%-16s %8s %12s %12s %8s' % ('flow', 'anchors', 'legacy(ms)', 'compiled(ms)', 'speedup')
+    for flow, soup in zip(flows, soups):
+        legacy = list(crawl.SoupAncestorSearch.search_soup_for_tags(soup, flow.tag, flow.searches))
+        compiled = list(flow.matcher.search(soup))
+        same = len(legacy) == len(compiled) and all(a is b for a, b in zip(legacy, compiled))
+        identical = identical and same
+        t0 = cpu_time()
+        for _ in xrange(iterations):
+            list(crawl.SoupAncestorSearch.search_soup_for_tags(soup, flow.tag, flow.searches))
+        t1 = cpu_time()
+        for _ in xrange(iterations):
+            list(flow.matcher.search(soup))
+        t2 = cpu_time()
+        total_legacy += t1 - t0
+        total_compiled += t2 - t1
+        print '%-16s %8d %12.3f %12.3f %8s%s' % (
+            os.path.basename(flow.location), len(legacy),
+            (t1 - t0) * 1000 / iterations, (t2 - t1) * 1000 / iterations,
+            '%.1fx' % ((t1 - t0) / (t2 - t1)) if t2 > t1 else '-',
+            '' if same else '  OUTPUT DIFFERS')
+    pages = len(flows) * iterations
+    print '%-16s %8s %12.3f %12.3f  (CPU ms per page)' % (
+        'all', '', total_legacy * 1000 / pages, total_compiled * 1000 / pages)
+    return identical
+
+
+def extract(flow, soup):
+    return [flow.generator(flow, a, None)[:4] for a in flow.matcher.search(soup)]
+
+
+def bench_parsers(flows, iterations):
+    """
+    Times each ParserBackend over the pages and compares the records then
+    extracted with those extracted with the default backend.
+    """
+    texts = [crawl.CrawlerDataSource.fetch_text(flow.location) for flow in flows]
+    reference = crawl.PARSER_BACKENDS[crawl.ParserBackend.default]
+    expected = [extract(flow, reference.parse(text, flow)) for flow, text in zip(flows, texts)]
+    print '%-16s %12s %8s' % ('parser', 'parse(ms)', 'records')
+    for name, backend in sorted(crawl.PARSER_BACKENDS.iteritems()):
+        t0 = cpu_time()
+        for _ in xrange(iterations):
+            for flow, text in zip(flows, texts):
+                backend.parse(text, flow)
+        t1 = cpu_time()
+        records = [extract(flow, backend.parse(text, flow)) for flow, text in zip(flows, texts)]
+        print '%-16s %12.3f %8d' % (name, (t1 - t0) * 1000 / iterations / len(flows), sum(map(len, records)))
+        for flow, a, b in zip(flows, expected, records):
+            if a != b:
+                print '    %s: %d records instead of %d, or different ones' % (
+                    os.path.basename(flow.location), len(b), len(a))
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:  # not on Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if sys.platform == 'darwin' else rss  # bytes on OS X, KB elsewhere
+
+
+def golden_records(flows):
+    records = {}
+    for flow in flows:
+        text = crawl.CrawlerDataSource.fetch_text(flow.source())
+        data = crawl.extract_records(flow, text, crawl.FlowStats(flow))
+        records[os.path.basename(flow.location)] = [list(d[:4]) for d in data]
+    return records
+
+
+def check_golden(flows, update):
+    """
+    :return: True if the records extracted match the golden ones
+    """
+    records = golden_records(flows)
+    if update:
+        with codecs.open(GOLDEN, 'w', 'utf-8') as h:
+            h.write(json.dumps(records, ensure_ascii=False, indent=1, sort_keys=True, separators=(',', ': ')) + '\n')
+        print '#Info: golden records written to "%s"' % GOLDEN
+        return True
+    with codecs.open(GOLDEN, 'r', 'utf-8') as h:
+        golden = json.load(h)
+    ok = True
+    for name in sorted(set(golden) | set(records)):
+        expected, actual = golden.get(name, []), records.get(name, [])
+        if expected != actual:
+            ok = False
+            print '#Error: %s: %d records extracted instead of the %d golden ones, or different ones' % (
+                name, len(actual), len(expected))
+    if ok:
+        print '#Info: records of all %d flows match the golden ones' % len(records)
+    return ok
+
+
+def bench_stages(flows, iterations, store_name):
+    """
+    Runs all the flows the way crawl.py does (replaying the pages), with a
+    fresh record store, and reports the time spent per flow in each stage.
+    The first iteration commits the records, the others find them known.
+    """
+    prefix = tempfile.mkdtemp(prefix='ztb-benchmark-')
+    store = crawl.RECORD_STORES[store_name](prefix)
+    stats = [crawl.FlowStats(flow) for flow in flows]
+    t0 = time.time()
+    try:
+        for _ in xrange(iterations):
+            for flow, s in zip(flows, stats):
+                crawl.run_flow(flow, store, crawl.FlowLogBuffer(), s)
+    finally:
+        elapsed = time.time() - t0
+        store.close()
+        shutil.rmtree(prefix)
+    print '%-16s' % 'flow' + ''.join(['%10s' % stage for stage in STAGES]) + '%10s%9s' % ('total', 'records')
+    totals = dict((stage, 0.0) for stage in STAGES)
+    for s in stats:
+        for stage in STAGES:
+            totals[stage] += s.timings.get(stage, 0.0)
+        print '%-16s' % os.path.basename(s.flow.location) + \
+            ''.join(['%10.3f' % (s.timings.get(stage, 0.0) * 1000 / iterations) for stage in STAGES]) + \
+            '%10.3f%9d%s' % (sum(s.timings.values()) * 1000 / iterations, s.records / iterations,
+                             '' if s.succeeded else '  FAILED')
+    runs = len(flows) * iterations
+    print '%-16s' % 'mean' + ''.join(['%10.3f' % (totals[stage] * 1000 / runs) for stage in STAGES]) + \
+        '%10.3f  (ms per flow run)' % (sum(totals.values()) * 1000 / runs)
+    records = sum([s.records for s in stats])
+    print '#Info: %d flow runs, %d records in %.3f s: %.1f records/s, %.1f flows/s' % (
+        runs, records, elapsed, records / elapsed, runs / elapsed)
+    rss = peak_rss_kb()
+    if rss is not None:
+        print '#Info: peak RSS %d KB' % rss
+    return all([s.succeeded for s in stats])
+
+
+def bench_scaling(flows, iterations, store_name):
+    """
+    Replays all the flows through crawl.run_flows() with as many threads as
+    flows, extracting in the crawling threads and then in ExtractionPools of
+    1 up to cpu_count() processes, and reports the throughput of each.
+    """
+    sizes = [0] + range(1, multiprocessing.cpu_count() + 1)
+    print '%-16s %10s %12s %10s' % ('processes', 'seconds', 'records/s', 'records')
+    ok = True
+    for size in sizes:
+        prefix = tempfile.mkdtemp(prefix='ztb-benchmark-')
+        store = crawl.RECORD_STORES[store_name](prefix)
+        crawl.ExtractionPool.current = crawl.ExtractionPool(size) if size else None
+        records = 0
+        t0 = time.time()
+        try:
+            for _ in xrange(iterations):
+                stats = crawl.run_flows(flows, store, crawl.FlowLogBuffer(), len(flows))
+                records += sum([s.records for s in stats])
+                ok = ok and all([s.succeeded for s in stats])
+        finally:
+            elapsed = time.time() - t0
+            if crawl.ExtractionPool.current:
+                crawl.ExtractionPool.current.close()
+                crawl.ExtractionPool.current = None
+            store.close()
+            shutil.rmtree(prefix)
+        print '%-16s %10.3f %12.1f %10d' % (size or 'in-thread', elapsed, records / elapsed, records)
+    return ok
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)] if values else 0.0
+
+
+def bench_load(count, workers, latency, pages, store_name):
+    """
+    Runs count copies of the flows, at the virtual hosts of a mock portal
+    served from a thread, through crawl.run_flows() once, and reports the
+    throughput, the distribution of the durations of the flows and the
+    memory used.
+
+    :param latency: mean response time of the mock portal, in seconds
+    """
+    entries, templates = mockportal.load_templates(crawl.ZTBCrawlFlow.catalogue_path)
+    portal = mockportal.MockPortal(templates, pages=pages, latency=latency, seed=1)
+    server = mockportal.start_server(portal)
+    prefix = tempfile.mkdtemp(prefix='ztb-benchmark-')
+    catalogue = os.path.join(prefix, 'mock-flows.json')
+    with open(catalogue, 'wb') as h:
+        json.dump({'flows': mockportal.mock_entries(entries, count)}, h)
+    flows = [flow for url, flow in sorted(crawl.open_catalogue(catalogue).load().iteritems())]
+    store = crawl.RECORD_STORES[store_name](prefix)
+    saved = os.environ.get('http_proxy'), crawl.CrawlerDataSourceWebPage.throttle
+    os.environ['http_proxy'] = 'http://127.0.0.1:%d' % server.server_address[1]
+    crawl.CrawlerDataSourceWebPage.throttle = crawl.HostThrottle(1, 0)
+    crawl.ZTBCrawlFlow.replay = False
+    t0 = time.time()
+    try:
+        stats = crawl.run_flows(flows, store, crawl.FlowLogBuffer(), workers)
+    finally:
+        elapsed = time.time() - t0
+        crawl.ZTBCrawlFlow.replay = True
+        crawl.CrawlerDataSourceWebPage.throttle = saved[1]
+        if saved[0] is None:
+            del os.environ['http_proxy']
+        else:
+            os.environ['http_proxy'] = saved[0]
+        server.shutdown()
+        store.close()
+        shutil.rmtree(prefix)
+    durations = [sum(s.timings.values()) * 1000 for s in stats]
+    records = sum([s.records for s in stats])
+    print '#Info: %d flows, %d workers, %d pages of %d bytes served in %.3f s: %.1f flows/s, %.1f records/s' % (
+        len(flows), workers, portal.counters.get('pages', 0), portal.counters.get('bytes', 0), elapsed,
+        len(flows) / elapsed, records / elapsed)
+    print '#Info: flow duration (ms): p50 %.1f, p90 %.1f, p99 %.1f, max %.1f' % (
+        percentile(durations, 50), percentile(durations, 90), percentile(durations, 99), max(durations or [0]))
+    rss = peak_rss_kb()
+    if rss is not None:
+        print '#Info: peak RSS %d KB' % rss
+    failed = [s for s in stats if not s.succeeded]
+    for s in failed[:5]:
+        print '#Error: %s: %s: %s' % ((s.flow.url,) + s.error)
+    return not failed
+
+
+SUITES = ['golden', 'stages', 'matcher', 'parsers', 'scaling', 'load']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the crawler over sample-data/.')
+    parser.add_argument('-n', '--iterations', type=int, default=20,
+                        help='number of times each page is processed (default: 20)')
+    parser.add_argument('--suite', action='append', choices=SUITES,
+                        help='what to run; may be repeated (default: all of them)')
+    parser.add_argument('--parser', choices=sorted(crawl.PARSER_BACKENDS), default=crawl.ParserBackend.default,
+                        help='the parser backend used by the golden and stages suites')
+    parser.add_argument('--store', choices=sorted(crawl.RECORD_STORES), default='dir',
+                        help='the record store used by the stages suite')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='write the records extracted as the golden ones')
+    parser.add_argument('--load-flows', type=int, default=190,
+                        help='number of flows of the load suite (default: 190)')
+    parser.add_argument('--load-workers', type=int, default=32,
+                        help='number of flows run in parallel by the load suite (default: 32)')
+    parser.add_argument('--load-latency', type=float, default=50,
+                        help='mean response time of the mock portal of the load suite, in ms (default: 50)')
+    parser.add_argument('--load-pages', type=int, default=1,
+                        help='number of pages of the listings of the load suite (default: 1)')
+    args = parser.parse_args()
+    suites = args.suite or SUITES
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # flow locations are relative to it
+    flows = [flow for url, flow in sorted(crawl.get_crawl_workflows().iteritems())]
+    crawl.ZTBCrawlFlow.replay = True
+    ok = True
+    if 'golden' in suites:
+        crawl.ParserBackend.default = args.parser
+        ok = check_golden(flows, args.update_golden) and ok
+        crawl.ParserBackend.default = 'html.parser'
+    if 'stages' in suites:
+        print
+        crawl.ParserBackend.default = args.parser
+        ok = bench_stages(flows, args.iterations, args.store) and ok
+        crawl.ParserBackend.default = 'html.parser'
+    if 'matcher' in suites:
+        print
+        if not bench_matcher(flows, load_soups(flows), args.iterations):
+            print '#Error: compiled matchers and SoupAncestorSearch disagree'
+            ok = False
+    if 'parsers' in suites:
+        print
+        bench_parsers(flows, args.iterations)
+    if 'scaling' in suites:
+        print
+        crawl.ParserBackend.default = args.parser
+        ok = bench_scaling(flows, args.iterations, args.store) and ok
+        crawl.ParserBackend.default = 'html.parser'
+    if 'load' in suites:
+        print
+        crawl.ParserBackend.default = args.parser
+        ok = bench_load(args.load_flows, args.load_workers, args.load_latency / 1000.0, args.load_pages,
+                        args.store) and ok
+        crawl.ParserBackend.default = 'html.parser'
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
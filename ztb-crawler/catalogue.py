@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import cPickle
+import threading
+try:
+    import yaml  # optional; only needed for the catalogues in YAML
+except ImportError:
+    yaml = None
+
+
+class CatalogueError(ValueError):
+    pass
+
+
+ENTRY_KEYS = {
+    'url': True, 'name': True, 'tag': True, 'searches': True, 'generator': True,  # required
+    'location': False, 'parser': False, 'pager': False, 'max_bytes': False,
+}
+SEARCH_KEYS = {'path': True, 'tag': True, 'attributes': True, 'blacklist': False}
+
+
+def parse_document(path, content):
+    """
+    :return: the catalogue content read from path, parsed as YAML if its
+             name ends with .yaml or .yml, as JSON otherwise
+    """
+    try:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            if yaml is None:
+                raise CatalogueError('%s: PyYAML is needed for the catalogues in YAML' % path)
+            return yaml.safe_load(content)
+        return json.loads(content.decode('utf-8'))
+    except (ValueError, UnicodeError) as e:
+        raise CatalogueError('%s: %s' % (path, e))
+    except Exception as e:
+        if yaml is not None and isinstance(e, yaml.YAMLError):
+            raise CatalogueError('%s: %s' % (path, e))
+        raise
+
+
+def entry_digest(entry):
+    return hashlib.sha1(json.dumps(entry, sort_keys=True)).hexdigest()
+
+
+class Catalogue(object):
+    def __init__(self, path, build, generators, pagers, parsers, cache_path=None, version=''):
+        """
+        The flows, as described by a catalogue file:
+          {"flows": [
+            {"url": "http://...", "location": "./sample-data/...", "name": "...", "tag": "a",
+             "searches": [{"path": ["td", "tr", "table"], "tag": "table", "attributes": {"id": "DataGrid1"}}],
+             "generator": "yxztb", "pager": {"type": "aspnet-postback", "event_target": "Pager"}},
+            ...]}
+
+        The entries are validated, then turned into flow objects by build.
+        The flow objects of the whole catalogue are pickled in cache_path,
+        if any, so that the next start only has to unpickle them (as long as
+        neither the catalogue nor version change). reload() applies the
+        changes of the catalogue to a running process, rebuilding only the
+        entries that have changed.
+
+        :param path: the catalogue file, in JSON or YAML
+        :param build: function(entry) returning the flow object of a
+                      validated entry; its url attribute is the key of the
+                      flow
+        :param generators: names of the valid generators
+        :param pagers: dict type name -> names of the parameters of the
+                       valid pagers
+        :param parsers: names of the valid parser backends
+        :param cache_path: where to keep the pickled flows, if anywhere
+        :param version: what invalidates the cache when changed, e.g. the
+                        version of the code building the flows
+        :return:
+        """
+        self.path = path
+        self.build = build
+        self.generators = set(generators)
+        self.pagers = pagers
+        self.parsers = set(parsers)
+        self.cache_path = cache_path
+        self.version = version
+        self.lock = threading.Lock()
+        self.stat = None
+        self.content_digest = None
+        self.digests = {}  # url -> digest of its entry
+        self.flows = {}    # url -> flow object
+
+    def validate(self, document):
+        """
+        :return: the entries of the document, by url
+        :raise: CatalogueError telling where the first problem is
+        """
+        def fail(where, message):
+            raise CatalogueError('%s: %s: %s' % (self.path, where, message))
+
+        def check_keys(d, keys, where):
+            if not isinstance(d, dict):
+                fail(where, 'an object is expected')
+            for k in d:
+                if k not in keys:
+                    fail(where, 'unknown key "%s"' % k)
+            for k, required in keys.iteritems():
+                if required and d.get(k) is None:
+                    fail(where, '"%s" is missing' % k)
+
+        def check_string(v, where):
+            if not isinstance(v, basestring) or not v:
+                fail(where, 'a non-empty string is expected')
+
+        def check_attributes(d, where):
+            if not isinstance(d, dict):
+                fail(where, 'an object is expected')
+            for k, v in d.iteritems():
+                check_string(v, '%s.%s' % (where, k))
+
+        if not isinstance(document, dict) or not isinstance(document.get('flows'), list):
+            fail('flows', 'a list of flows is expected')
+        entries = {}
+        for i, entry in enumerate(document['flows']):
+            where = 'flows[%d]' % i
+            check_keys(entry, ENTRY_KEYS, where)
+            for k in ('url', 'name', 'tag'):
+                check_string(entry[k], '%s.%s' % (where, k))
+            if not (entry['url'].startswith('http://') or entry['url'].startswith('https://')):
+                fail(where + '.url', 'an http or https url is expected')
+            if entry['url'] in entries:
+                fail(where + '.url', 'duplicate of another flow')
+            if entry.get('location') is not None:
+                check_string(entry['location'], where + '.location')
+            if entry['generator'] not in self.generators:
+                fail(where + '.generator', 'unknown generator "%s", shall be one of %s' % (
+                    entry['generator'], ', '.join(sorted(self.generators))))
+            if entry.get('parser') is not None and entry['parser'] not in self.parsers:
+                fail(where + '.parser', 'unknown parser "%s", shall be one of %s' % (
+                    entry['parser'], ', '.join(sorted(self.parsers))))
+            if entry.get('max_bytes') is not None and (
+                    not isinstance(entry['max_bytes'], (int, long)) or entry['max_bytes'] <= 0):
+                fail(where + '.max_bytes', 'a positive integer is expected')
+            pager = entry.get('pager')
+            if pager is not None:
+                if not isinstance(pager, dict) or pager.get('type') not in self.pagers:
+                    fail(where + '.pager', 'an object with a "type" among %s is expected' % (
+                        ', '.join(sorted(self.pagers))))
+                check_keys(pager, dict([('type', True)] + [(k, True) for k in self.pagers[pager['type']]]),
+                           where + '.pager')
+            if not isinstance(entry['searches'], list) or not entry['searches']:
+                fail(where + '.searches', 'a non-empty list is expected')
+            for j, search in enumerate(entry['searches']):
+                w = '%s.searches[%d]' % (where, j)
+                check_keys(search, SEARCH_KEYS, w)
+                if not isinstance(search['path'], list):
+                    fail(w + '.path', 'a list of tag names is expected')
+                for k, p in enumerate(search['path']):
+                    check_string(p, '%s.path[%d]' % (w, k))
+                check_string(search['tag'], w + '.tag')
+                if search['tag'] != (search['path'][-1] if search['path'] else entry['tag']):
+                    fail(w + '.tag', 'shall be the last tag of the path (or the tag of the flow if none)')
+                check_attributes(search['attributes'], w + '.attributes')
+                if search.get('blacklist') is not None:
+                    check_attributes(search['blacklist'], w + '.blacklist')
+            entries[entry['url']] = entry
+        return entries
+
+    def cache_key(self, content):
+        return hashlib.sha1(self.version + '\0' + content).hexdigest()
+
+    def load_cache(self, content):
+        if not (self.cache_path and os.access(self.cache_path, os.R_OK)):
+            return False
+        try:
+            with open(self.cache_path, 'rb') as h:
+                cached = cPickle.load(h)
+        except Exception:  # whatever is wrong with it, it is rebuilt
+            return False
+        if cached.get('key') != self.cache_key(content):
+            return False
+        self.digests, self.flows = cached['digests'], cached['flows']
+        return True
+
+    def save_cache(self, content):
+        if not self.cache_path:
+            return
+        tmp = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        try:
+            with open(tmp, 'wb') as h:
+                cPickle.dump({'key': self.cache_key(content), 'digests': self.digests, 'flows': self.flows}, h,
+                             cPickle.HIGHEST_PROTOCOL)
+            if os.name == 'nt' and os.access(self.cache_path, os.F_OK):
+                os.remove(self.cache_path)  # rename() does not replace files on Windows
+            os.rename(tmp, self.cache_path)
+        except (IOError, OSError):  # e.g. read-only installation: the cache is only an optimization
+            pass
+
+    def file_stat(self):
+        st = os.stat(self.path)
+        return st.st_mtime, st.st_size
+
+    def load(self):
+        """
+        Loads the catalogue, from the cache if it is up to date.
+
+        :return: dict url -> flow object
+        """
+        with self.lock:
+            self.stat = self.file_stat()
+            with open(self.path, 'rb') as h:
+                content = h.read()
+            self.content_digest = hashlib.sha1(content).hexdigest()
+            if not self.load_cache(content):
+                entries = self.validate(parse_document(self.path, content))
+                self.digests = dict((url, entry_digest(e)) for url, e in entries.iteritems())
+                self.flows = dict((url, self.built(e)) for url, e in entries.iteritems())
+                self.save_cache(content)
+            return dict(self.flows)
+
+    def built(self, entry):
+        flow = self.build(entry)
+        flow.spec_digest = entry_digest(entry)
+        return flow
+
+    def reload(self):
+        """
+        Applies the changes of the catalogue file since it was last loaded,
+        if any; when it is invalid, nothing changes and CatalogueError is
+        raised.
+
+        :return: tuple (urls added, urls changed, urls removed)
+        """
+        with self.lock:
+            stat = self.file_stat()
+            if stat == self.stat:
+                return [], [], []
+            with open(self.path, 'rb') as h:
+                content = h.read()
+            self.stat = stat
+            digest = hashlib.sha1(content).hexdigest()
+            if digest == self.content_digest:
+                return [], [], []
+            entries = self.validate(parse_document(self.path, content))
+            digests = dict((url, entry_digest(e)) for url, e in entries.iteritems())
+            added = sorted(set(digests) - set(self.digests))
+            removed = sorted(set(self.digests) - set(digests))
+            changed = sorted([url for url in digests if url in self.digests and digests[url] != self.digests[url]])
+            flows = dict(self.flows)
+            for url in added + changed:
+                flows[url] = self.built(entries[url])
+            for url in removed:
+                del flows[url]
+            self.flows, self.digests, self.content_digest = flows, digests, digest
+            self.save_cache(content)
+            return added, changed, removed
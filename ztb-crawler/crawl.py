@@ -7,10 +7,39 @@ import codecs
 import re
 import time
 import datetime
+import json
+import random
 import hashlib
-from urlparse import urljoin
+import argparse
+import threading
+import contextlib
+import Queue
+import socket
+import cProfile
+import multiprocessing
+import functools
+import itertools
+import _strptime  # imported lazily by strptime(), which is not thread-safe in Python 2
+from urlparse import urljoin, urlparse, urlunparse
+from HTMLParser import HTMLParser, HTMLParseError
 import requests
 import bs4
+from httpcache import HTTPResponseCache
+from metrics import write_json_summary, write_prometheus_textfile, LatestFlowMetrics
+from scheduler import AdaptiveScheduler, parse_quiet_hours
+from leases import LeaseQueue
+from records import Record, collection_time
+from export import EXPORT_FORMATS, open_export, export_records
+from recordstore import DirectoryRecordStore, SQLiteRecordStore, ObservedRecordStore, migrate_directory_tree
+from details import DetailCache, DetailFetcher
+from fingerprints import ListingFingerprints, fingerprint
+from index import RecordIndex
+from duplicates import DuplicateDetector
+from subscriptions import SubscriptionRouter, load_subscribers
+from outbox import Outbox
+from delivery import make_sink, deliver
+from catalogue import Catalogue, CatalogueError
+from archive import PageArchive, read_blob
 
 
 class HTMLTagAttributesVerifier(object):
@@ -39,6 +68,8 @@ class HTMLTagAttributesVerifier(object):
         for attr in attributes:
             k, v = attr
             if k in self.attributes:
+                if k == 'class' and v:  # compared the way verify2() does
+                    v = ' '.join(sorted(v.split()))
                 if self.attributes[k] == v:
                     accumulated.add(k)
                 else:
@@ -58,10 +89,10 @@ class HTMLTagAttributesVerifier(object):
             return False
         for k, v in self.attributes.iteritems():
             r = soup_tag.get(k)
-            # TODO: consider improvements.
             # The get() return a list for 'class' attribute, string for others.
+            # Most tags have a single class, which needs no sorting.
             if isinstance(r, list):
-                r = ' '.join(sorted(r))
+                r = ' '.join(sorted(r)) if len(r) > 1 else ''.join(r)
             if r != v:
                 return False
         if self.attributes_blacklist:
@@ -83,9 +114,54 @@ class CrawlerDataSource(object):
             cls.__location_selector__[prefix] = c
 
     @classmethod
-    def fetch_text_impl(cls, location):
+    def fetch_content_impl(cls, location, data=None, use_cache=True, max_bytes=None, watcher=None):
+        """
+        :param data: dict of the form fields to post to location, if any
+        :param use_cache: whether the content may be reported unchanged
+                          (with ContentNotModified) if known to be so
+        :param max_bytes: size beyond which the content is not read (and
+                          ContentTooLarge is raised), if any
+        :param watcher: object with the methods begin(location, content_type)
+                        and feed(chunk) telling when enough content has been
+                        read (see ListingEndWatcher), if any
+        :return: tuple (content, content_type): the raw bytes at location and
+                 the value of the Content-Type header they came with, if any
+        """
         pass
 
+    chunk_size = 64 * 1024  # what the content is read by
+
+    @staticmethod
+    def read_chunks(location, chunks, content_type, max_bytes=None, watcher=None):
+        """
+        Reads the content from chunks (an iterator over byte strings) up to
+        where the watcher is satisfied, if any, and no further than
+        max_bytes.
+
+        :return: the content read
+        """
+        if watcher:
+            watcher.begin(location, content_type)
+        content, size = [], 0
+        for chunk in chunks:
+            content.append(chunk)
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                raise ContentTooLarge("Content at '%s' is larger than %d bytes" % (location, max_bytes))
+            if watcher and watcher.feed(chunk):
+                FlowStats.count('stopped_early')
+                break
+        return ''.join(content)
+
+    @classmethod
+    def decode_content_impl(cls, location, content, content_type):
+        return cls.decode_string_with_unknown_encoding(content, content_type)
+
+    @classmethod
+    def fetch_text_impl(cls, location):
+        content, content_type = cls.fetch_content_impl(location)
+        return cls.decode_content_impl(location, content, content_type)
+
     @classmethod
     def fetch_and_yield_lines_impl(cls, location):
         pass
@@ -115,51 +191,364 @@ class CrawlerDataSource(object):
         c = cls.subclass_selector(location)
         return c.fetch_and_yield_lines_impl(location)
 
-    @staticmethod
-    def decode_string_with_unknown_encoding(s):
-        decoded = False
-        # TODO: list all encodings that occur in practice here for us to try
-        for encoding in ['utf-8', 'gbk']:
+    @classmethod
+    def fetch_content(cls, location, data=None, use_cache=True, max_bytes=None, watcher=None):
+        c = cls.subclass_selector(location)
+        return c.fetch_content_impl(location, data, use_cache, max_bytes, watcher)
+
+    @classmethod
+    def decode_content(cls, location, content, content_type):
+        c = cls.subclass_selector(location)
+        return c.decode_content_impl(location, content, content_type)
+
+    @classmethod
+    def fetch_done_impl(cls, location, succeeded):
+        pass
+
+    @classmethod
+    def fetch_done(cls, location, succeeded):
+        """
+        To be called once the text fetched from location has been processed
+        (succeeded or not), so that the data source may remember it.
+        """
+        c = cls.subclass_selector(location)
+        return c.fetch_done_impl(location, succeeded)
+
+    # encodings tried when none of the declared ones works; gb18030 is a
+    # superset of gbk, which is itself a superset of gb2312
+    fallback_encodings = ['utf-8', 'gbk', 'gb18030', 'big5']
+    # what the pages declare is decoded with the superset actually used
+    encoding_aliases = {
+        'gb2312': 'gbk', 'gb_2312': 'gbk', 'gb_2312-80': 'gbk', 'x-gbk': 'gbk',
+        'cp936': 'gbk', 'x-euc-cn': 'gbk', 'euc-cn': 'gbk', 'big5-hkscs': 'big5hkscs',
+    }
+    learned_encodings = {}  # key (typically the host) -> encoding that worked last time
+    __content_type_charset__ = re.compile(r'charset\s*=\s*["\']?([-\w.:]+)', re.I)
+    __meta_charset__ = re.compile(r'<meta[^>]+charset\s*=\s*["\']?([-\w.:]+)', re.I)
+
+    @classmethod
+    def normalize_encoding(cls, name):
+        if not name:
+            return None
+        name = name.strip().lower()
+        name = cls.encoding_aliases.get(name, name)
+        try:
+            return codecs.lookup(name).name
+        except LookupError:
+            return None
+
+    @classmethod
+    def candidate_encodings(cls, s, content_type=None, key=None):
+        """
+        :return: the encodings to try on s, most likely first: the one told
+                 by its BOM, the one declared in the Content-Type header, the
+                 one that worked last time for key, the one declared by the
+                 <meta> tags at the beginning of s, then the fallbacks
+        """
+        candidates = []
+        if s.startswith(codecs.BOM_UTF8):
+            candidates.append('utf-8-sig')
+        elif s.startswith(codecs.BOM_UTF16_LE) or s.startswith(codecs.BOM_UTF16_BE):
+            candidates.append('utf-16')
+        if content_type:
+            m = cls.__content_type_charset__.search(content_type)
+            if m:
+                candidates.append(cls.normalize_encoding(m.group(1)))
+        if key is not None:
+            candidates.append(cls.learned_encodings.get(key))
+        m = cls.__meta_charset__.search(s, 0, 4096)
+        if m:
+            candidates.append(cls.normalize_encoding(m.group(1)))
+        candidates.extend(cls.fallback_encodings)
+        tried = set()
+        return [e for e in candidates if e and not (e in tried or tried.add(e))]
+
+    @classmethod
+    def decode_string_with_unknown_encoding(cls, s, content_type=None, key=None):
+        """
+        Decodes s in a single successful pass in most cases, as its encoding
+        is figured out before trying it.
+
+        :param content_type: value of the Content-Type header s came with
+        :param key: what the encoding that works is remembered by for the
+                    next time, typically the host s comes from
+        """
+        for encoding in cls.candidate_encodings(s, content_type, key):
             try:
-                s = s.decode(encoding)
-                decoded = True
-                break
+                decoded = s.decode(encoding)
             except UnicodeDecodeError:
+                continue
+            if key is not None:
+                cls.learned_encodings[key] = encoding
+            return decoded
+        raise UnicodeError("impossible: cannot decode input string")
+
+
+class HostThrottle(object):
+    def __init__(self, max_per_host=1, min_interval=0.0):
+        """
+        Politeness limits shared by all threads talking to the same web site.
+
+        :param max_per_host: maximum number of requests in flight per host
+        :param min_interval: minimum delay in seconds between the starts of
+                             two consecutive requests to the same host
+        """
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.next_slot = {}
+
+    @staticmethod
+    def host_of(location):
+        return urlparse(location).netloc.lower()
+
+    @contextlib.contextmanager
+    def request_slot(self, location):
+        host = self.host_of(location)
+        with self.lock:
+            semaphore = self.semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_per_host)
+                self.semaphores[host] = semaphore
+        semaphore.acquire()
+        try:
+            with self.lock:
+                now = time.time()
+                slot = max(now, self.next_slot.get(host, now))
+                self.next_slot[host] = slot + self.min_interval
+            if slot > now:
+                time.sleep(slot - now)
+            yield host
+        finally:
+            semaphore.release()
+
+
+class CircuitBreaker(object):
+    def __init__(self, threshold=5, cooldown=600.0, state_path=None):
+        """
+        Per-host circuit breaker: after threshold consecutive failed requests
+        to a host, the host is skipped for cooldown seconds; then a single
+        request is let through, which either closes the circuit or opens it
+        again.
+
+        :param state_path: JSON file the open circuits are kept in across
+                           runs, if any
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.failures = {}    # host -> consecutive failures
+        self.open_until = {}  # host -> time the host may be tried again
+        self.trying = set()   # hosts with the trial request in flight
+        if state_path and os.access(state_path, os.R_OK):
+            try:
+                with open(state_path, 'r') as h:
+                    state = json.load(h)
+                self.failures.update(state.get('failures', {}))
+                self.open_until.update(state.get('open_until', {}))
+            except ValueError:
                 pass
-        if decoded:
-                return s
-        else:
-            raise UnicodeError("impossible: cannot decode input string")
+
+    def allow(self, location):
+        """
+        :return: whether a request to the host of location may be made now
+        """
+        host = HostThrottle.host_of(location)
+        with self.lock:
+            until = self.open_until.get(host)
+            if until is None:
+                return True
+            if time.time() < until or host in self.trying:
+                return False
+            self.trying.add(host)  # half-open: this request decides
+            return True
+
+    def succeeded(self, location):
+        host = HostThrottle.host_of(location)
+        with self.lock:
+            self.failures.pop(host, None)
+            self.open_until.pop(host, None)
+            self.trying.discard(host)
+
+    def failed(self, location):
+        host = HostThrottle.host_of(location)
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.threshold or host in self.trying:
+                self.open_until[host] = time.time() + self.cooldown
+            self.trying.discard(host)
+
+    def save_state(self):
+        if not self.state_path:
+            return
+        with self.lock:
+            state = {'failures': dict(self.failures), 'open_until': dict(self.open_until)}
+        with open(self.state_path, 'w') as h:
+            json.dump(state, h, indent=1, sort_keys=True, separators=(',', ': '))
+
+
+class HostUnavailable(IOError):
+    """
+    Raised instead of requesting a host whose circuit is open.
+    """
+    pass
+
+
+class ContentTooLarge(IOError):
+    """
+    Raised by the data sources when the content at a location is larger than
+    what the caller is ready to read.
+    """
+    pass
+
+
+class ContentNotModified(Exception):
+    """
+    Raised by the data sources when the content at a location is known to be
+    the same as the last time it was fetched, so there is nothing to process.
+    """
+    pass
 
 
 class CrawlerDataSourceWebPage(CrawlerDataSource):
+
+    throttle = HostThrottle()
+    breaker = CircuitBreaker()
+    cache = None  # HTTPResponseCache object, if conditional requests are wanted
+    timeout = (10.0, 30.0)  # connect and read timeouts, in seconds
+    attempts = 4  # per request, when the failures are worth retrying
+    backoff = 2.0  # base delay before retrying, in seconds, doubled at each attempt
+    max_backoff = 60.0
+    session_pool = Queue.LifoQueue()  # idle requests.Session objects, not thread-safe
+
     @staticmethod
     def __split_text_and_yield_lines__(text):
         assert text.index('html')
         for l in text.split('\n'):
             yield l.rstrip('\r')
 
-    @classmethod
-    def fetch_text_impl(cls, location):
-        retrying = 3
-        status_code = None
-        headers = {
+    @staticmethod
+    def new_session():
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=4)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        s.headers.update({
             'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
                           'Chrome/42.0.2311.152 Safari/537.36',  # exactly that of my dev browser
-        }
-        while retrying:
+        })
+        return s
+
+    @classmethod
+    @contextlib.contextmanager
+    def borrowed_session(cls):
+        """
+        Lends an idle session from the pool (or a new one) to the calling
+        thread; the sessions, and their kept-alive connections, outlive the
+        threads that use them.
+        """
+        try:
+            s = cls.session_pool.get_nowait()
+        except Queue.Empty:
+            s = cls.new_session()
+        try:
+            yield s
+        finally:
+            cls.session_pool.put(s)
+
+    @staticmethod
+    def is_retryable(status_code):
+        """
+        :return: whether a request answered with status_code may succeed if
+                 made again: server errors and throttling, not client errors
+        """
+        return status_code >= 500 or status_code in (408, 429)
+
+    @classmethod
+    def backoff_delay(cls, attempt):
+        """
+        :return: the delay before retrying after the given failed attempt
+                 (1 for the first one): exponential, with half of it jittered
+                 so that the threads hitting the same host spread out
+        """
+        delay = min(cls.max_backoff, cls.backoff * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @classmethod
+    def fetch_content_impl(cls, location, data=None, use_cache=True, max_bytes=None, watcher=None):
+        cache = cls.cache if use_cache and data is None else None
+        headers = cache.conditional_headers(location) if cache else {}
+        attempt = 0
+        while True:
+            attempt += 1
+            if not cls.breaker.allow(location):
+                FlowStats.count('circuit_open')
+                raise HostUnavailable("Host of the url '%s' skipped after repeated failures" % location)
+            # Whether the host has answered, once known; however the attempt
+            # ends (e.g. ContentTooLarge, TooManyRedirects), the breaker is
+            # told, so that a half-open circuit does not stay so.
+            answered = None
             try:
-                r = requests.get(location, headers=headers)
-                if r.status_code == 200:  # request OK.
-                    return cls.decode_string_with_unknown_encoding(r.content)
+                try:
+                    with cls.throttle.request_slot(location), cls.borrowed_session() as session:
+                        if data is None:
+                            r = session.get(location, headers=headers, timeout=cls.timeout, stream=True)
+                        else:
+                            r = session.post(location, data=data, headers=headers, timeout=cls.timeout,
+                                             stream=True)
+                        try:
+                            content = None
+                            if r.status_code == 200:
+                                content = cls.read_chunks(location, r.iter_content(cls.chunk_size),
+                                                          r.headers.get('Content-Type'), max_bytes, watcher)
+                        finally:
+                            r.close()  # the connection goes back to the pool only if fully read
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    answered = False
+                    FlowStats.count('timeouts' if isinstance(e, requests.exceptions.Timeout) else 'connection_errors')
+                    if attempt >= cls.attempts:
+                        raise IOError("Request for the url '%s' failed: %s: %s" % (location, e.__class__.__name__, e))
                 else:
-                    status_code = r.status_code
-            except:
-                pass
-            time.sleep(5)  # TODO: elaborate on this
-            retrying -= 1
-        status_code = str(status_code) if status_code else '<unknown>'
-        raise IOError("Request for the url '%s' returns status code %s" % (location, status_code))
+                    if r.status_code == 304:  # conditional request says so
+                        answered = True
+                        raise ContentNotModified(location)
+                    if r.status_code == 200:  # request OK.
+                        answered = True
+                        if cache:
+                            unchanged = cache.is_unchanged(location, content)
+                            cache.stage(location, r.headers, content)
+                            if unchanged:
+                                raise ContentNotModified(location)
+                        return content, r.headers.get('Content-Type')
+                    if not cls.is_retryable(r.status_code):
+                        answered = True  # the host is up, the page is not
+                        raise IOError("Request for the url '%s' returns status code %d" % (location, r.status_code))
+                    answered = False
+                    if attempt >= cls.attempts:
+                        raise IOError("Request for the url '%s' returns status code %d after %d attempts" % (
+                            location, r.status_code, attempt))
+            finally:
+                if answered:
+                    cls.breaker.succeeded(location)
+                else:
+                    cls.breaker.failed(location)
+            FlowStats.count('retries')
+            time.sleep(cls.backoff_delay(attempt))
+
+    @classmethod
+    def decode_content_impl(cls, location, content, content_type):
+        return cls.decode_string_with_unknown_encoding(content, content_type, HostThrottle.host_of(location))
+
+    @classmethod
+    def fetch_done_impl(cls, location, succeeded):
+        if cls.cache:
+            if succeeded:
+                cls.cache.commit(location)
+            else:
+                cls.cache.discard(location)
 
     @classmethod
     def fetch_and_yield_lines_impl(cls, location):
@@ -177,19 +566,20 @@ class CrawlerDataSourceLocalFile(CrawlerDataSource):
         return re.sub(r'file:///', r'/', location)
 
     @classmethod
-    def fetch_text_impl(cls, location):
-        with open(cls.get_local_file_path_from_url(location), "r") as h:
-            return cls.decode_string_with_unknown_encoding(h.read())
+    def fetch_content_impl(cls, location, data=None, use_cache=True, max_bytes=None, watcher=None):
+        assert data is None, 'nothing can be posted to local files'
+        with open(cls.get_local_file_path_from_url(location), "rb") as h:
+            return cls.read_chunks(location, iter(lambda: h.read(cls.chunk_size), ''), None, max_bytes, watcher), None
 
     @classmethod
     def fetch_and_yield_lines_impl(cls, location):
-        with open(cls.get_local_file_path_from_url(location), "r") as h:
-            for l in h:
-                yield cls.decode_string_with_unknown_encoding(l.strip())
+        # the encoding is figured out once for the whole file, not per line
+        for l in cls.fetch_text_impl(location).split('\n'):
+            yield l.strip()
 
     @staticmethod
     def prefixes():
-        return [r'^/', r'./', r'^file:///']  # TODO: not compatible with DOS/Windows
+        return [r'^/', r'^\./', r'^file:///', r'^[A-Za-z]:[\\/]']
 
 
 class SoupAncestorSearch(object):
@@ -223,6 +613,263 @@ class SoupAncestorSearch(object):
                 yield t
 
 
+class CompiledSearchMatcher(object):
+    def __init__(self, name, searches):
+        """
+        Does what SoupAncestorSearch.search_soup_for_tags() does, but top-down:
+        all the searches are merged into one chain of (tag name, verifiers)
+        indexed by the distance from the tag we look for, the outermost
+        ancestors qualifying are located first and only their descendants
+        along the chain are visited. Each ancestor is verified once, whatever
+        the number of searches sharing it.
+
+        :param name: name of the tags to search for
+        :param searches: list of SoupAncestorSearch objects
+        """
+        self.name = name
+        self.searches = searches
+        depth = max([len(s.path) for s in searches] or [0])
+        self.names = [name] + [None] * depth
+        self.verifiers = [[] for _ in xrange(depth + 1)]
+        self.impossible = False  # searches that no tag can ever satisfy
+        for s in searches:
+            for i, p in enumerate(s.path):
+                if self.names[i + 1] is None:
+                    self.names[i + 1] = p
+                elif self.names[i + 1] != p:
+                    self.impossible = True
+            if s.verifier.tag != self.names[len(s.path)]:
+                self.impossible = True
+            self.verifiers[len(s.path)].append(s.verifier)
+        # single-valued attributes the outermost ancestors can be rejected on
+        # without going through the verifiers ('class' is a list in bs4)
+        self.top_attributes = {}
+        for v in self.verifiers[depth]:
+            for k, value in v.attributes.iteritems():
+                if k != 'class':
+                    self.top_attributes[k] = value
+
+    def outermost_verifiers(self):
+        """
+        :return: tuple (depth, verifiers) of the outermost ancestor of the tags
+                 searched for, i.e. of the container of all of them, depth
+                 being its distance from these tags
+        """
+        return len(self.verifiers) - 1, self.verifiers[-1]
+
+    def is_verified(self, tag, depth):
+        for v in self.verifiers[depth]:
+            if not v.verify2(tag):
+                return False
+        return True
+
+    def search(self, soup):
+        if self.impossible:
+            return
+        depth = len(self.names) - 1
+        top_name = self.names[depth]
+        top_attributes = self.top_attributes.items()
+        # plain iteration over the descendants is cheaper than find_all()
+        for top in soup.descendants:
+            if top.name != top_name:
+                continue
+            attrs = top.attrs
+            rejected = False
+            for k, v in top_attributes:  # cheap rejection of most candidates
+                if attrs.get(k) != v:
+                    rejected = True
+                    break
+            if rejected or not self.is_verified(top, depth):
+                continue
+            tags = [top]
+            for d in xrange(depth - 1, -1, -1):
+                name = self.names[d]
+                tags = [c for t in tags for c in t.children if c.name == name and self.is_verified(c, d)]
+            for t in tags:
+                yield t
+
+
+class SubtreeLocator(HTMLParser):
+    def __init__(self, verifiers):
+        """
+        Scans HTML text for the elements that satisfy all the verifiers (with
+        HTMLTagAttributesVerifier.verify1()) without building any tree, and
+        records where in the text each of them starts and ends.
+
+        :param verifiers: non-empty list of HTMLTagAttributesVerifier objects,
+                          all for the same tag name
+        """
+        HTMLParser.__init__(self)
+        self.verifiers = verifiers
+        self.tag = verifiers[0].tag
+        self.text = u''
+        self.line_offsets = [0]
+        self.start = None  # offset of the element being scanned through
+        self.depth = 0     # nesting level of self.tag inside it
+        self.spans = []    # (start, end) offsets of the elements found
+        self.closed = 0    # number of elements found and closed
+
+    def position(self):
+        line, column = self.getpos()
+        return self.line_offsets[line - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        if tag != self.tag:
+            return
+        if self.start is not None:
+            self.depth += 1
+            return
+        for v in self.verifiers:
+            if not v.verify1(tag, attrs):
+                return
+        self.start = self.position()
+        self.depth = 1
+
+    def handle_endtag(self, tag):
+        if tag != self.tag or self.start is None:
+            return
+        self.depth -= 1
+        if self.depth == 0:
+            end = self.text.index('>', self.position()) + 1
+            self.spans.append((self.start, end))
+            self.start = None
+            self.closed += 1
+
+    def feed_text(self, chunk):
+        """
+        Scans the next chunk of the text; the elements found so far are in
+        spans, and closed tells how many of them are complete.
+        """
+        base = len(self.text)
+        i = chunk.find('\n')
+        while i >= 0:
+            self.line_offsets.append(base + i + 1)
+            i = chunk.find('\n', i + 1)
+        self.text += chunk
+        self.feed(chunk)
+
+    def locate(self, text):
+        """
+        :return: list of the (start, end) offsets in text of the elements
+                 found; an element left open runs up to the end of the text
+        """
+        self.feed_text(text)
+        self.close()
+        if self.start is not None:
+            self.spans.append((self.start, len(text)))
+            self.start = None
+        return self.spans
+
+
+class ListingEndWatcher(object):
+    def __init__(self, verifiers):
+        """
+        Watches the content of a page as it is read, decoding it
+        incrementally into a SubtreeLocator, and tells when the first element
+        satisfying the verifiers (the container of the listing) has been
+        closed, i.e. when the rest of the page is of no use. If the content
+        cannot be decoded or scanned, it never does.
+
+        :param verifiers: as for SubtreeLocator
+        """
+        self.locator = SubtreeLocator(verifiers)
+        self.decoder = None
+        self.key = None
+        self.content_type = None
+        self.failed = False
+
+    def begin(self, location, content_type):
+        self.key = HostThrottle.host_of(location) or None
+        self.content_type = content_type
+
+    def feed(self, chunk):
+        """
+        :return: whether the listing is complete
+        """
+        if self.failed:
+            return False
+        try:
+            if self.decoder is None:
+                # the encoding as decode_string_with_unknown_encoding() would guess it
+                encoding = CrawlerDataSource.candidate_encodings(chunk, self.content_type, self.key)[0]
+                self.decoder = codecs.getincrementaldecoder(encoding)('strict')
+            self.locator.feed_text(self.decoder.decode(chunk))
+        except (UnicodeError, LookupError, HTMLParseError):
+            self.failed = True
+            return False
+        return self.locator.closed > 0
+
+
+class ParserBackend(object):
+    """
+    Turns the text of a page into the soup the flows search in. Backends are
+    looked up by name in PARSER_BACKENDS; a flow may name its own, otherwise
+    ParserBackend.default is used.
+    """
+
+    default = 'html.parser'
+
+    def parse(self, text, flow):
+        raise NotImplementedError
+
+    @staticmethod
+    def for_flow(flow):
+        return PARSER_BACKENDS[flow.parser or ParserBackend.default]
+
+
+class TreeBuilderParserBackend(ParserBackend):
+    def __init__(self, features):
+        """
+        :param features: the tree builder to have BeautifulSoup use, e.g.
+                         'html.parser' or 'lxml'
+        """
+        self.features = features
+
+    def parse(self, text, flow):
+        return bs4.BeautifulSoup(text, self.features)
+
+
+class SubtreeParserBackend(ParserBackend):
+    def __init__(self, features='html.parser'):
+        """
+        Streams through the page with a SubtreeLocator driven by the flow's
+        outermost verifiers and only builds the tree of the elements found:
+        navigation, iframes, footers etc. never get into the soup. When
+        nothing is found (or the page is too broken to scan), the whole page
+        is parsed as a fallback.
+
+        :param features: the tree builder used for the subtrees
+        """
+        self.features = features
+
+    # The generators look at the ancestors of the tags found, up to the row
+    # (a.parent.parent) at least; these must be part of the subtree.
+    min_depth = 2
+
+    def parse(self, text, flow):
+        depth, verifiers = flow.matcher.outermost_verifiers()
+        if verifiers and depth >= self.min_depth:
+            try:
+                spans = SubtreeLocator(verifiers).locate(text)
+            except HTMLParseError:
+                spans = None
+            if spans:
+                return bs4.BeautifulSoup(''.join([text[a:b] for a, b in spans]), self.features)
+        return bs4.BeautifulSoup(text, self.features)
+
+
+PARSER_BACKENDS = {
+    'html.parser': TreeBuilderParserBackend('html.parser'),
+    'subtree': SubtreeParserBackend('html.parser'),
+}
+try:
+    import lxml  # optional; much faster than html.parser when available
+    PARSER_BACKENDS['lxml'] = TreeBuilderParserBackend('lxml')
+    PARSER_BACKENDS['subtree-lxml'] = SubtreeParserBackend('lxml')
+except ImportError:
+    pass
+
+
 class ZTBParser(object):
     @staticmethod
     def parse_article_time_from_td(s):
@@ -285,12 +932,14 @@ class ZTBParser(object):
         return s[0: c + 1]
 
     @classmethod
-    def generator_yxztb(cls, flow, soup_tag):
+    def generator_yxztb(cls, flow, soup_tag, collected):
         """
 
         :param flow:
         :param soup_tag: the anchor containing our record
-        :return:
+        :param collected: the collection time point of the records of the
+                          batch, see collection_time()
+        :return: the Record object
         """
         addr = soup_tag.get('href')
         t = cls.parse_article_time_from_anchor(soup_tag)
@@ -310,9 +959,7 @@ class ZTBParser(object):
                     t = datetime.datetime.strptime(
                         '-'.join(segments[i-1 : i+2]), '%Y-%m-%d').strftime(
                         '%Y-%m-%d')
-        return [
-            flow.name, t, addr, title, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ]
+        return Record(flow.name, t, addr, title, collected)
 
     @classmethod
     def collect_soup_tag_text(cls, tag):
@@ -329,18 +976,16 @@ class ZTBParser(object):
         return '-'.join(data) if len(data) > 0 else None
 
     @classmethod
-    def generator_zhenjiang(cls, flow, soup_tag):
+    def generator_zhenjiang(cls, flow, soup_tag, collected):
         addr = soup_tag.get('href')
         if addr[0:4] != 'http':  # not full address; compute it
             addr = urljoin(flow.url, addr)
         title = cls.collect_soup_tag_text(soup_tag.parent.parent)
         assert addr is not None and title is not None
-        return [
-            flow.name, None, addr, title, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ]
+        return Record(flow.name, None, addr, title, collected)
 
     @classmethod
-    def generator_yangzhou(cls, flow, soup_tag):
+    def generator_yangzhou(cls, flow, soup_tag, collected):
         # soup_tag goes like this:
         # <a onclick='window.open("ViewReportDetail.aspx?...", ...)' ...> ...
         # Here uses an ugly way to compute the full URL
@@ -352,13 +997,10 @@ class ZTBParser(object):
         tr_list = [c for c in soup_tag.parent.parent.children]
         title_prefix = tr_list[3].text.strip()
         title_time = tr_list[4].text.strip()
-        return [
-            flow.name, title_time, addr, "[%s]%s" % (title_prefix, title_text),
-            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ]
+        return Record(flow.name, title_time, addr, "[%s]%s" % (title_prefix, title_text), collected)
 
     @classmethod
-    def generator_nantong(cls, flow, soup_tag):
+    def generator_nantong(cls, flow, soup_tag, collected):
         addr_relative = soup_tag.get('href')
         addr_sections = flow.url.split('/')[:-1]
         addr_sections.append(addr_relative)
@@ -369,14 +1011,83 @@ class ZTBParser(object):
         title_time = tr_list[11].text
         prefices.append(u'截至日期:%s' % title_time)
         title = ''.join(['[%s]' % s for s in prefices] + [title_text])
-        return [
-            flow.name, title_time, addr, title,
-            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ]
+        return Record(flow.name, title_time, addr, title, collected)
+
+
+class Pager(object):
+    """
+    Knows how to get from one page of a listing to the next one.
+    """
+
+    def next_request(self, flow, page, location, text):
+        """
+        :param page: number of the page just read, from 1
+        :param location: where it was read from
+        :param text: its text
+        :return: tuple (location, data) to fetch page + 1 from, data being the
+                 dict of the form fields to post, if any; None if there is
+                 no next page
+        """
+        raise NotImplementedError
+
+
+class AspNetPostBackPager(Pager):
+    def __init__(self, event_target):
+        """
+        For the ASP.NET pagers whose links call
+        javascript:__doPostBack('<event_target>', '<page>'): the next page is
+        got by posting back the form, hidden fields (__VIEWSTATE and the like)
+        included, with __EVENTTARGET and __EVENTARGUMENT set accordingly.
+
+        :param event_target: e.g. 'MoreInfoList1$Pager'
+        """
+        self.event_target = event_target
+
+    __input_tag__ = re.compile(r'<input\s[^>]*>', re.I)
+    __tag_attribute__ = re.compile(r'([-\w:.]+)\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+)')
+
+    @classmethod
+    def hidden_fields(cls, text):
+        fields = {}
+        unescape = HTMLParser().unescape
+        for tag in cls.__input_tag__.findall(text):
+            attributes = dict((k.lower(), unescape(v.strip('"\'')))
+                              for k, v in cls.__tag_attribute__.findall(tag))
+            if attributes.get('type', '').lower() == 'hidden' and attributes.get('name'):
+                fields[attributes['name']] = attributes.get('value', '')
+        return fields
+
+    def next_request(self, flow, page, location, text):
+        argument = str(page + 1)
+        if ("__doPostBack('%s','%s')" % (self.event_target, argument)) not in text:
+            return None  # no link to the next page: this is the last one
+        data = self.hidden_fields(text)
+        data['__EVENTTARGET'] = self.event_target
+        data['__EVENTARGUMENT'] = argument
+        return location, data
+
+
+class QueryStringPager(Pager):
+    def __init__(self, parameter):
+        """
+        For the listings whose pages are at the url of the first one with an
+        extra query string parameter telling the page number.
+
+        :param parameter: name of the parameter, e.g. 'page'
+        """
+        self.parameter = parameter
+
+    def next_request(self, flow, page, location, text):
+        link = '%s=%d' % (self.parameter, page + 1)
+        if not re.search(r'[?&;]%s(?!\d)' % re.escape(link), text):
+            return None  # no link to the next page: this is the last one
+        scheme, netloc, path, params, query, fragment = urlparse(flow.url)
+        query = '&'.join([q for q in query.split('&') if q and q.split('=')[0] != self.parameter] + [link])
+        return urlunparse((scheme, netloc, path, params, query, fragment)), None
 
 
 class ZTBCrawlFlow(object):
-    def __init__(self, url, location, name, tag, searches, generator):
+    def __init__(self, url, location, name, tag, searches, generator, parser=None, pager=None, max_bytes=None):
         """
 
         :param url: target web page url
@@ -388,6 +1099,12 @@ class ZTBCrawlFlow(object):
         :param searches: list of SoupAncestorSearch objects that help identify
                          the tag
         :param generator: generator that emit the records collected
+        :param parser: name of the ParserBackend for this flow; None for the
+                       default one
+        :param pager: Pager object for walking the pages of the listing after
+                      the first one, if any
+        :param max_bytes: size of the pages beyond which the flow fails, if not
+                          ZTBCrawlFlow.max_bytes
         :return:
         """
         self.url = url
@@ -396,226 +1113,1312 @@ class ZTBCrawlFlow(object):
         self.tag = tag
         self.searches = searches
         self.generator = generator
+        self.parser = parser
+        self.pager = pager
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.matcher = CompiledSearchMatcher(tag, searches)
+
+    replay = False  # whether to read the pages from location instead of url
+    # The pages of a listing are walked until one with a record seen before
+    # (so that in the steady state, only the first page is read) and up to
+    # max_pages of them; when backfilling, max_pages of them are walked
+    # whatever the records in them.
+    max_pages = 5
+    backfill = False
+    details = None  # DetailFetcher object, if the articles of the new records are to be fetched too
+    archive = None  # PageArchive object, if the pages fetched are to be kept
+    max_bytes = 8 * 1024 * 1024  # no page larger than that is read
+    # Whether to stop reading the pages once the container of the listing has
+    # been read. Not for the flows with a pager, which needs the page tail,
+    # nor for those whose container is too close to the tags searched for
+    # to hold what the generators look at (see SubtreeParserBackend).
+    stop_early = True
+    # ListingFingerprints object, if the listings are to be compared with
+    # what they were the last time
+    fingerprints = None
+    catalogue_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flows.json')
+    catalogue = None  # catalogue.Catalogue object the flows come from, once loaded
+    spec_digest = None  # digest of the catalogue entry of the flow
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['generator'] = self.generator.__name__  # bound methods cannot be pickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.generator = getattr(ZTBParser, state['generator'])
+
+    def end_watcher(self):
+        """
+        :return: ListingEndWatcher object for reading a page of the flow, or
+                 None if the whole page is to be read
+        """
+        depth, verifiers = self.matcher.outermost_verifiers()
+        if not self.stop_early or self.pager or not verifiers or depth < SubtreeParserBackend.min_depth:
+            return None
+        return ListingEndWatcher(verifiers)
+
+    def source(self):
+        """
+        :return: where to read the page from: the url, or the cached version
+                 at location when replaying (relative locations are relative
+                 to the directory of this script)
+        """
+        if not (self.replay and self.location):
+            return self.url
+        if self.location.startswith('./'):
+            return os.path.join(os.path.dirname(os.path.abspath(__file__)), self.location[2:])
+        return self.location
+
+
+GENERATORS = dict((name[len('generator_'):], name) for name in dir(ZTBParser) if name.startswith('generator_'))
+PAGERS = {  # type in the catalogue -> (Pager class, names of its parameters)
+    'aspnet-postback': (AspNetPostBackPager, ['event_target']),
+    'query-string': (QueryStringPager, ['parameter']),
+}
+
+
+def native(s):
+    """
+    :return: s as a str if it is ASCII, as is otherwise (JSON strings all
+             come as unicode)
+    """
+    try:
+        return s.encode('ascii')
+    except UnicodeError:
+        return s
+
+
+def build_flow(entry):
+    """
+    :param entry: dict of a flow, as validated by catalogue.Catalogue
+    :return: the ZTBCrawlFlow object
+    """
+    def attributes(d):
+        return dict((native(k), native(v)) for k, v in d.iteritems()) if d is not None else None
+
+    searches = [SoupAncestorSearch([native(p) for p in s['path']], HTMLTagAttributesVerifier(
+        native(s['tag']), attributes(s['attributes']), attributes(s.get('blacklist')))) for s in entry['searches']]
+    pager = None
+    if entry.get('pager'):
+        cls, parameters = PAGERS[entry['pager']['type']]
+        pager = cls(*[native(entry['pager'][p]) for p in parameters])
+    location = entry.get('location')
+    return ZTBCrawlFlow(native(entry['url']), native(location) if location else None, entry['name'],
+                        native(entry['tag']), searches, getattr(ZTBParser, GENERATORS[entry['generator']]),
+                        parser=entry.get('parser'), pager=pager, max_bytes=entry.get('max_bytes'))
+
+
+def open_catalogue(path):
+    """
+    :return: catalogue.Catalogue object of the flows described at path, its
+             compiled form being cached next to it
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    source = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    # The cache is stale once the code building the flows changes; the name
+    # of this module is part of the pickles (__main__ when run as a script).
+    version = __name__
+    if os.access(source, os.R_OK):
+        st = os.stat(source)
+        version += ':%d:%d' % (st.st_mtime, st.st_size)
+    return Catalogue(path, build_flow, GENERATORS, dict((k, v[1]) for k, v in PAGERS.iteritems()),
+                     PARSER_BACKENDS, os.path.join(directory, '.%s.cache' % name), version)
+
 
 def get_crawl_workflows():
-    crawl_flows={}
-    specs = [
-        ZTBCrawlFlow('http://www.yxztb.net/yxweb/zypd/012001/012001001/', './sample-data/yi-xin', u'宜兴市', 'a',
-                     [
-                         SoupAncestorSearch(['td'], HTMLTagAttributesVerifier(
-                             'td', {'class': 'tdmoreinfosub'})),
-                         SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                             'table', {'class': 'tbmoreinfosub'}))
-                     ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow('http://www.wxzb.net/wxzb/ZtbInfo/MoreZBGG.aspx', './sample-data/wu-xi', u'无锡市', 'a',
-                     [
-                         SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                             'table', {'id': 'DataGrid1'})),
-                         SoupAncestorSearch(['td', 'tr', 'table', 'td'], HTMLTagAttributesVerifier(
-                             'td', {'id': 'tdcontent'})),
-                         SoupAncestorSearch(['td', 'tr', 'table', 'td', 'tr', 'table'],
-                                            HTMLTagAttributesVerifier('table', {'id': 'moreinfo'})),
-                     ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow('http://www.ggzy.com.cn/jyweb/ShowInfo/Moreinfo.aspx?CategoryNum=003001001001',
-                     './sample-data/jiang-yin', u'江阴市', 'a',
-                     [
-                         SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                             'table', {'id': 'MoreInfoList1_DataGrid1'})),
-                         SoupAncestorSearch(['td', 'tr', 'table', 'td'], HTMLTagAttributesVerifier(
-                             'td', {'id': 'MoreInfoList1_tdcontent'})),
-                         SoupAncestorSearch(['td', 'tr', 'table', 'td', 'tr', 'table'],
-                                            HTMLTagAttributesVerifier('table', {'id': 'MoreInfoList1_moreinfo'})),
-                     ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow('http://zhaotoubiao.sipac.gov.cn/yqztbweb/ShowInfo/MoreInfo_zbgg.aspx?categoryNum=001001',
-                     './sample-data/su-zhou', u'苏州工业园区', 'a',
-                     [
-                         SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                             'table', {'id': 'DataGrid1'})),
-                     ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow('http://www.haztb.gov.cn/hawz/jyxx/004001/004001001/',
-                     './sample-data/huai-an', u'淮安市', 'a',
-                     [
-                         SoupAncestorSearch(['td', 'tr'], HTMLTagAttributesVerifier(
-                             'tr', {'height': '22'}
-                         )),
-                         SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                             'table', {'width': '99%'})),
-                     ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow('http://www.cxztb.gov.cn:8080/cxxztb/jyxx/003001/003001001/003001001001/MoreInfo.aspx?CategoryNum=003001001001',
-                     './sample-data/chang-xin', u'长兴县', 'a',
-                     [
-                         SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                             'table', {'id': 'MoreInfoList1_DataGrid1'})),
-                     ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow('http://ztb.huzhou.gov.cn/col/col3604/index.html', './sample-data/hu-zhou', u'湖州市', 'a',
-                     [
-                         SoupAncestorSearch(['td', 'tr', 'table', 'div', 'div'], HTMLTagAttributesVerifier(
-                             'div', {'id': '5824'})),
-                     ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow('http://www.czzbb.net/czztb/jyxx/010001/010001001/',
-                     './sample-data/chang-zhou', u'常州市', 'a',
-                     [
-                         SoupAncestorSearch(['td', 'tr'], HTMLTagAttributesVerifier(
-                             'tr', {'height': '22'}
-                         )),
-                         SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                             'table', {'width': '99%'})),
-                     ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow('http://ggzy.njzwfw.gov.cn/njggzy/jsgc/001001/001001001/001001001002/',
-                     './sample-data/nan-jing', u'南京市', 'a',
-                     [
-                         SoupAncestorSearch(['td', 'tr', 'table', 'div', 'td', 'tr', 'table'],
-                                            HTMLTagAttributesVerifier(
-                                                'table', {'width': '998', 'class': 'bk'})),
-                     ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow('http://www.zjcin.com/zjgcjs/ztbinfo/morezbgg.aspx',
-                     './sample-data/zhen-jiang', u'镇江市', 'a',
-                     [
-                         SoupAncestorSearch(['td', 'tr', 'table'],
-                                            HTMLTagAttributesVerifier(
-                                                'table', {'id': 'DataGrid1'})),
-                     ], ZTBParser.generator_zhenjiang),
-        ZTBCrawlFlow(
-            'http://www.txsp.gov.cn:8888/jsjy/Bulletin.aspx?Organ=%D6%D0%D0%C4',
-            './sample-data/tong-xiang', u'嘉兴市桐乡市', 'a',
-            [
-                SoupAncestorSearch([], HTMLTagAttributesVerifier('a', {'class': 'BulletinDate'})),
-            ], ZTBParser.generator_zhenjiang),
-        ZTBCrawlFlow(
-            'http://zbcg.mas.gov.cn/maszbw/jyxx/005001/005001001/',
-            './sample-data/ma-an-shan', u'马鞍山市', 'a',
-            [
-                SoupAncestorSearch(['td'], HTMLTagAttributesVerifier('td', {'width': '602'})),
-            ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow(
-            'http://www.whzbb.com.cn/whweb/jyzx/013004/013004001/013004001001/013004001001001/'
-            'MoreInfo.aspx?CategoryNum=013004001001001',
-            './sample-data/wu-hu', u'芜湖市', 'a',
-            [
-                SoupAncestorSearch(['td', 'tr', 'table', 'td', 'tr', 'table', 'form'],
-                                   HTMLTagAttributesVerifier('form', {'id': 'ctl00'})),
-            ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow(
-            'http://www.dycg.gov.cn/dyzgw/jyxx/001001/001001001/MoreInfo.aspx?CategoryNum=001001001',
-            './sample-data/dan-yang', u'丹阳市', 'a',
-            [
-                SoupAncestorSearch(['td', 'tr', 'table', 'td', 'tr', 'table', 'form'],
-                                   HTMLTagAttributesVerifier('form', {'id': 'ctl00'})),
-            ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow(
-            'http://www.yzzb.gov.cn/yzztb/zypd/010001/010001001/MoreInfo.aspx?CategoryNum=010001001',
-            './sample-data/yang-zhong', u'扬中市', 'a',
-            [
-                SoupAncestorSearch(['td', 'tr', 'table', 'td', 'tr', 'table', 'form'],
-                                   HTMLTagAttributesVerifier('form', {'id': 'ctl00'})),
-            ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow(
-            'http://www.yzcetc.com/yzcetc/YW_Info/ZaoBiaoReport/MoreReportList_YZ_New.aspx?CategoryNum=003',
-            './sample-data/yang-zhou', u'扬州市', 'a',
-            [
-                SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                    'table', {'id': 'MoreInfoList1_DataGrid1'})),
-                SoupAncestorSearch(['td', 'tr', 'table', 'td'], HTMLTagAttributesVerifier(
-                    'td', {'id': 'MoreInfoList1_tdcontent'})),
-                SoupAncestorSearch(['td', 'tr', 'table', 'td', 'tr', 'table'],
-                                   HTMLTagAttributesVerifier('table', {'id': 'MoreInfoList1_moreinfo'})),
-            ], ZTBParser.generator_yangzhou),
-        ZTBCrawlFlow(
-            'http://www.tzcetc.com/tzweb/yw_info/zaobiaoreport/moreinfo.aspx',
-            './sample-data/tai-zhou', u'泰州市', 'a',
-            [
-                SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                    'table', {'id': 'MoreInfoListZBGG1_DataGrid1'})),
-                SoupAncestorSearch(['td', 'tr', 'table', 'td'], HTMLTagAttributesVerifier(
-                    'td', {'id': 'MoreInfoListZBGG1_tdcontent'})),
-                SoupAncestorSearch(['td', 'tr', 'table', 'td', 'tr', 'table'],
-                                   HTMLTagAttributesVerifier('table', {'id': 'MoreInfoListZBGG1_moreinfo'})),
-            ], ZTBParser.generator_yxztb),
-        ZTBCrawlFlow(
-            'http://www.jszb.com.cn/jszb/YW_info/ZhaoBiaoGG/MoreInfo_ZBGG.aspx?categoryNum=012',
-            './sample-data/jiang-su', u'江苏省建设工程招标投标办公室', 'a',
-            [
-                SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                    'table', {'id': 'MoreInfoList1_DataGrid1'})),
-                SoupAncestorSearch(['td', 'tr', 'table', 'td'], HTMLTagAttributesVerifier(
-                    'td', {'id': 'MoreInfoList1_tdcontent'})),
-            ], ZTBParser.generator_yangzhou),
-        ZTBCrawlFlow(
-            'http://www.ntszjs.com/ntszzb/ProjectList.aspx?id=000100010002',
-            './sample-data/nan-tong', u'南通市', 'a',
-            [
-                SoupAncestorSearch(['td'], HTMLTagAttributesVerifier(
-                    'td', {'align': 'left'})),
-                SoupAncestorSearch(['td', 'tr', 'table'], HTMLTagAttributesVerifier(
-                    'table', {'class': 'xian1'})),
-            ], ZTBParser.generator_nantong),
-    ]
-    for f in specs:
-        crawl_flows[f.url] = f
-    return crawl_flows
+    """
+    :return: dict url -> ZTBCrawlFlow object of the flows of the catalogue
+             at ZTBCrawlFlow.catalogue_path, loaded on the first call
+    """
+    if ZTBCrawlFlow.catalogue is None:
+        ZTBCrawlFlow.catalogue = open_catalogue(ZTBCrawlFlow.catalogue_path)
+        return ZTBCrawlFlow.catalogue.load()
+    return dict(ZTBCrawlFlow.catalogue.flows)
+
+
+def load_flows():
+    """
+    get_crawl_workflows(), exiting if the catalogue cannot be loaded.
+    """
+    try:
+        return get_crawl_workflows()
+    except (CatalogueError, IOError, OSError) as e:
+        sys.exit('#Error: %s' % unicode(e).encode('utf-8'))
+
+
+def reload_flows(by_url):
+    """
+    Applies the changes of the catalogue since it was loaded to by_url; if
+    the catalogue has become invalid, the flows stay as they are.
+
+    :param by_url: dict url -> ZTBCrawlFlow object of the flows run
+    :return: tuple (urls of the flows added, changed, removed)
+    """
+    try:
+        added, changed, removed = ZTBCrawlFlow.catalogue.reload()
+    except (CatalogueError, IOError, OSError) as e:
+        print '#Warning: catalogue not reloaded: %s' % unicode(e).encode('utf-8')
+        return [], [], []
+    for url in added + changed:
+        by_url[url] = ZTBCrawlFlow.catalogue.flows[url]
+    for url in removed:
+        by_url.pop(url, None)
+    if added or changed or removed:
+        print '#Info: catalogue reloaded: %d flows added, %d changed, %d removed' % (
+            len(added), len(changed), len(removed))
+    return added, changed, removed
 
 
 def ensure_path_exists(path):
     if not os.access(path, os.R_OK):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:  # may have been created by another thread meanwhile
+            pass
     assert os.access(path, os.R_OK)
 
 
+class FlowLogBuffer(object):
+    """
+    Collects the log lines of a single flow so that flows running in parallel
+    do not interleave their output; the lines are replayed to the real log
+    handle once the flow is done.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def write(self, s):
+        self.lines.append(s)
+
+    def replay(self, handle):
+        for s in self.lines:
+            log_it(handle, s.rstrip('\n'))
+
+
 def log_it(handle, s):
     handle.write(s + '\n')
-    print s
-
-
-def commit(flow, data, prefix, log_handle):
-    # data (as returned from generators):
-    # [flow.name, time_as_in_article, addr, title, collected-time-point]
-    (name, t, addr, title, tx) = data
-    # The URLs constructed by the generators may contain things like
-    # '/foo/../foo/'. They are valid, yet QQ does not recognize them. Here
-    # removes them.
-    addr = re.sub(r'[^\/]*\/\.\.\/', '', addr)
-    if t and len(t) == 10:
-        t1 = t[0:7]  # 'YYYY-mm'
-        t2 = t[8:]   # 'dd
+    if not isinstance(handle, FlowLogBuffer):
+        print s
+
+
+def process_cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+class FlowStats(object):
+    def __init__(self, flow):
+        """
+        What happened during the run(s) of a flow.
+
+        CPU times are those of the whole process, hence only meaningful per
+        flow when the flows are not run in parallel.
+
+        :param flow: the ZTBCrawlFlow object
+        """
+        self.flow = flow
+        self.timings = {}      # stage name -> accumulated wall-clock seconds
+        self.cpu_timings = {}  # stage name -> accumulated process CPU seconds
+        self.bytes_fetched = 0
+        self.records = 0
+        self.new_records = 0
+        self.counters = {}     # event name, e.g. 'retries' -> count
+        self.succeeded = None
+        self.error = None      # (exception class name, message) of the failure
+
+    active = threading.local()  # the FlowStats of the flow run by each thread
+    profile_dir = None  # where run_flow() dumps per-flow cProfile stats, if anywhere
+    latest = None  # LatestFlowMetrics object, when the runs are of only some of the flows
+
+    @contextlib.contextmanager
+    def activated(self):
+        previous = getattr(FlowStats.active, 'stats', None)
+        FlowStats.active.stats = self
+        try:
+            yield self
+        finally:
+            FlowStats.active.stats = previous
+
+    @classmethod
+    def count(cls, event, n=1):
+        """
+        Counts an event for the flow run by the calling thread, if any; this
+        is how the layers below run_flow() (e.g. the data sources) report.
+        """
+        stats = getattr(cls.active, 'stats', None)
+        if stats is not None:
+            stats.counters[event] = stats.counters.get(event, 0) + n
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t, c = time.time(), process_cpu_time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - t
+            self.cpu_timings[name] = self.cpu_timings.get(name, 0.0) + process_cpu_time() - c
+
+    def merge(self, other):
+        """
+        Accounts what has been accounted in other, as returned by as_dict().
+        """
+        for timings, merged in ((other['timings'], self.timings), (other['cpu_timings'], self.cpu_timings)):
+            for k, v in timings.iteritems():
+                merged[k] = merged.get(k, 0.0) + v
+        for k, v in other['counters'].iteritems():
+            self.counters[k] = self.counters.get(k, 0) + v
+        self.bytes_fetched += other['bytes_fetched']
+        self.records += other['records']
+        self.new_records += other['new_records']
+
+    def as_dict(self):
+        return {
+            'url': self.flow.url,
+            'name': self.flow.name,
+            'succeeded': self.succeeded,
+            'error': {'class': self.error[0], 'message': self.error[1]} if self.error else None,
+            'timings': self.timings,
+            'cpu_timings': self.cpu_timings,
+            'bytes_fetched': self.bytes_fetched,
+            'records': self.records,
+            'new_records': self.new_records,
+            'counters': self.counters,
+        }
+
+
+def run_summary(stats, started, finished):
+    """
+    :param stats: list of the FlowStats objects of the run
+    :param started: time.time() the run started at
+    :param finished: time.time() the run finished at
+    :return: the machine-readable summary of the run, as a dict
+    """
+    flows = [s.as_dict() for s in stats]
+    return {
+        'started': started,
+        'finished': finished,
+        'duration': finished - started,
+        'flows': flows,
+        'totals': {
+            'flows': len(flows),
+            'failed': len([f for f in flows if not f['succeeded']]),
+            'bytes_fetched': sum([f['bytes_fetched'] for f in flows]),
+            'records': sum([f['records'] for f in flows]),
+            'new_records': sum([f['new_records'] for f in flows]),
+        },
+    }
+
+
+def commit(flow, records, store, log_handle):
+    """
+    Hands the records collected by a flow over to the store as one batch and
+    logs the ones that are new.
+
+    :return: the entries (digest, day, data) of the new records
+    """
+    entries = []
+    for data in records:
+        (name, t, addr, title, tx) = data
+        # The URLs constructed by the generators may contain things like
+        # '/foo/../foo/'. They are valid, yet QQ does not recognize them. Here
+        # removes them.
+        addr = re.sub(r'[^\/]*\/\.\.\/', '', addr)
+        if t and len(t) == 10:
+            t1 = t[0:7]  # 'YYYY-mm'
+            t2 = t[8:]   # 'dd
+        else:
+            t = u'<日期未知>'
+            t1 = u'年月未知'
+            t2 = u'日期未知'
+        data = Record(name, t, addr, title, tx)  # name interned again, if unpickled
+        digest = hashlib.md5(addr.encode('utf-8')).hexdigest()
+        entries.append((digest, (t1, t2), data))
+    created = store.add_batch(entries)
+    for data, locator in created:
+        log_it(log_handle, '#Info: created new data entry %s' % locator)
+        log_it(log_handle, '         %s' % '  '.join(data))
+    by_data = dict((id(data), (digest, day, data)) for digest, day, data in entries)
+    return [by_data[id(data)] for data, locator in created]
+
+
+def fetch_article(url):
+    """
+    What the DetailFetcher fetches the articles with: the data sources, hence
+    the throttle and sessions of the flows, without the HTTP cache (the
+    details have a cache of their own), and no larger than the pages; an
+    article that is (ContentTooLarge) is a detail not fetched.
+    """
+    content, content_type = CrawlerDataSource.fetch_content(url, None, False, ZTBCrawlFlow.max_bytes)
+    return content, CrawlerDataSource.decode_content(url, content, content_type)
+
+
+def commit_details(new_entries, store, log_handle):
+    """
+    Fetches the articles of the new records and keeps their details with
+    them. Failing to do so does not make the flow fail.
+    """
+    results = ZTBCrawlFlow.details.fetch_all([data[2] for digest, day, data in new_entries])
+    for entry, (url, r, e) in zip(new_entries, results):
+        if e is not None:
+            FlowStats.count('detail_errors')
+            log_it(log_handle, '#Warning: details of "%s" not fetched: %s: %s' % (url, e.__class__.__name__, e))
+            continue
+        details, cached = r
+        FlowStats.count('details_cached' if cached else 'details_fetched')
+        store.add_details(entry, details)
+        log_it(log_handle, '#Info: details of "%s": budget %s, deadline %s' % (
+            url, details['budget_text'] or '<unknown>', details['deadline'] or '<unknown>'))
+
+
+def select_anchors(flow, text, stats):
+    with stats.stage('parse'):
+        soup = ParserBackend.for_flow(flow).parse(text, flow)
+    with stats.stage('select'):
+        return list(flow.matcher.search(soup))
+
+
+def extract_records(flow, text, stats, collected=None):
+    """
+    :param collected: the collection time point of the records, if not now
+    :return: the Record objects of the page
+    """
+    collected = collected or collection_time()
+    anchors = select_anchors(flow, text, stats)
+    with stats.stage('generator'):
+        records = [flow.generator(flow, a, collected) for a in anchors]
+    stats.records += len(records)
+    return records
+
+
+def listing_fingerprint(flow, text):
+    """
+    :return: the fingerprint of the listing container(s) of the page, None
+             if they cannot be located
+    """
+    depth, verifiers = flow.matcher.outermost_verifiers()
+    if not verifiers:
+        return None
+    try:
+        spans = SubtreeLocator(verifiers).locate(text)
+    except HTMLParseError:
+        return None
+    if not spans:
+        return None
+    return fingerprint(u''.join([text[a:b] for a, b in spans]))
+
+
+def row_fingerprint(flow, anchor):
+    """
+    :return: the fingerprint of the row of the listing the anchor is in, i.e.
+             of what the generators look at
+    """
+    row = anchor
+    for _ in xrange(min(SubtreeParserBackend.min_depth, flow.matcher.outermost_verifiers()[0])):
+        row = row.parent or row
+    return fingerprint(unicode(row))
+
+
+def process_page(flow, page, location, content, content_type, stats, known=None, collected=None):
+    """
+    Everything done with a page between fetching it and committing its
+    records, CPU-bound work only.
+
+    :param collected: the collection time point of the records, if not now
+
+    :param known: tuple (listing fingerprint, row fingerprints) of the page
+                  the last time it was processed, as from
+                  ListingFingerprints.get(), if the page is to be compared
+                  with it: an unchanged listing is not extracted at all, and
+                  the rows of a changed one that were there already are
+                  skipped
+    :return: tuple (records, next_request, skipped, seen): next_request
+             being what the flow's pager says page + 1 is to be fetched
+             with, if it is to be; skipped the number of rows skipped; seen
+             the fingerprints of the page to be remembered, if known was
+             given
+    """
+    with stats.stage('decode'):
+        text = CrawlerDataSource.decode_content(location, content, content_type)
+    seen, skipped = None, 0
+    collected = collected or collection_time()
+    if known is None:
+        records = extract_records(flow, text, stats, collected)
     else:
-        data[1] = u'<日期未知>'
-        t1 = u'年月未知'
-        t2 = u'日期未知'
-    path = '/'.join([prefix, name, t1, t2])
-    ensure_path_exists(path)
-    digest = hashlib.md5(addr).hexdigest()
-    f = path + '/' + digest
-    if not os.access(f, os.W_OK):
-        log_it(log_handle, '#Info: created new data entry in file "%s"' % f)
-        log_it(log_handle, '         %s' % '  '.join([name, t, addr, title, tx]))
-        with codecs.open(f, 'w', 'utf-8') as h:
-            h.write('  '.join(data) + '\n')
+        with stats.stage('fingerprint'):
+            listing = listing_fingerprint(flow, text)
+        if listing is not None and listing == known[0]:
+            stats.counters['listing_unchanged'] = stats.counters.get('listing_unchanged', 0) + 1
+            records, skipped, seen = [], len(known[1]), known
+            stats.records += skipped
+        else:
+            anchors = select_anchors(flow, text, stats)
+            with stats.stage('fingerprint'):
+                rows = [row_fingerprint(flow, a) for a in anchors]
+            with stats.stage('generator'):
+                records = [flow.generator(flow, a, collected) for a, row in zip(anchors, rows)
+                           if row not in known[1]]
+            stats.records += len(anchors)
+            skipped, seen = len(anchors) - len(records), (listing, rows)
+    next_request = None
+    if flow.pager and not flow.replay and page < flow.max_pages and (records or skipped):
+        next_request = flow.pager.next_request(flow, page, location, text)
+    return records, next_request, skipped, seen
 
 
-def main():
-    if len(sys.argv) != 2:
-        print "Usage: %s prefix-directory" % sys.argv[0]
-        exit()
-    prefix = sys.argv[1]
-    ensure_path_exists(prefix)
-    log = '%s/ztb-crawler-%s.log' % (prefix, datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+class ExtractionPool(object):
+    def __init__(self, processes):
+        """
+        Pool of processes process_page() is run in, so that decoding, parsing
+        and extracting use all the cores while the threads of run_flows() do
+        the I/O and the committing. The processes build their own flows (see
+        get_crawl_workflows()) and get the pages by flow url; the Record
+        objects come back pickled.
+
+        :param processes: number of processes
+        """
+        settings = {
+            'parser': ParserBackend.default,
+            'replay': ZTBCrawlFlow.replay,
+            'max_pages': ZTBCrawlFlow.max_pages,
+            'backfill': ZTBCrawlFlow.backfill,
+            'catalogue': ZTBCrawlFlow.catalogue_path,
+        }
+        self.pool = multiprocessing.Pool(processes, initialize_extraction_worker, (settings,))
+
+    current = None  # the ExtractionPool object in use, if any
+    worker_flows = None  # in the processes of the pool: flow url -> ZTBCrawlFlow
+
+    @classmethod
+    def process(cls, flow, page, location, content, content_type, stats, known=None, collected=None):
+        """
+        process_page(), in the current pool if any (and if its processes know
+        the flow), in this process otherwise.
+        """
+        if cls.current:
+            r = cls.current.pool.apply(process_page_in_worker,
+                                       (flow.url, flow.spec_digest, page, location, content, content_type,
+                                        known, collected))
+            if r is not None:
+                result, worker_stats = r
+                stats.merge(worker_stats)
+                return result
+        return process_page(flow, page, location, content, content_type, stats, known, collected)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def initialize_extraction_worker(settings):
+    """
+    What the processes of ExtractionPool start with (a module-level function,
+    so that it can be pickled when they are spawned, as on Windows).
+    """
+    ParserBackend.default = settings['parser']
+    ZTBCrawlFlow.replay = settings['replay']
+    ZTBCrawlFlow.max_pages = settings['max_pages']
+    ZTBCrawlFlow.backfill = settings['backfill']
+    ZTBCrawlFlow.catalogue_path = settings['catalogue']
+    ExtractionPool.worker_flows = get_crawl_workflows()
+
+
+def process_page_in_worker(url, spec_digest, page, location, content, content_type, known, collected):
+    """
+    What ExtractionPool runs in its processes (a module-level function, so
+    that it can be pickled).
+
+    :param spec_digest: digest of the catalogue entry of the flow; the
+                        catalogue is reloaded if it is not that of the flow
+                        known here
+    :return: tuple (what process_page() returns, FlowStats.as_dict() of what
+             it did), or None if the flow is unknown there
+    """
+    flow = ExtractionPool.worker_flows.get(url)
+    if flow is None or flow.spec_digest != spec_digest:
+        try:
+            ZTBCrawlFlow.catalogue.reload()
+        except (CatalogueError, IOError, OSError):
+            pass
+        ExtractionPool.worker_flows = dict(ZTBCrawlFlow.catalogue.flows)
+        flow = ExtractionPool.worker_flows.get(url)
+        if flow is None or flow.spec_digest != spec_digest:
+            return None
+    stats = FlowStats(flow)
+    records, next_request, skipped, seen = process_page(flow, page, location, content, content_type, stats, known,
+                                                        collected)
+    return (records, next_request, skipped, seen), stats.as_dict()
+
+
+def run_flow(flow, store, h, stats=None):
+    """
+    :param stats: FlowStats object to account the run in, if not a new one
+    :return: the FlowStats object of the run
+    """
+    stats = stats or FlowStats(flow)
+    log_it(h, '#Info: job for url "%s" started ...' % flow.url)
+    source = flow.source()
+    collected = collection_time()  # one time point for all the records of the run
+    profiler = None
+    if FlowStats.profile_dir:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with stats.activated():
+            location, data, page = source, None, 1
+            while True:
+                with stats.stage('fetch'):
+                    content, content_type = CrawlerDataSource.fetch_content(location, data, page == 1, flow.max_bytes,
+                                                                            flow.end_watcher())
+                stats.bytes_fetched += len(content)
+                FlowStats.count('pages')
+                if ZTBCrawlFlow.archive:
+                    with stats.stage('archive'):
+                        if not ZTBCrawlFlow.archive.add(flow.url, page, location, content, content_type):
+                            FlowStats.count('pages_archived_before')
+                fingerprints = ZTBCrawlFlow.fingerprints
+                key = ListingFingerprints.key(flow.url, page)
+                known = fingerprints.get(key) if fingerprints else None
+                records, request, skipped, seen = ExtractionPool.process(flow, page, location, content, content_type,
+                                                                         stats, known, collected)
+                with stats.stage('commit'):
+                    new_entries = commit(flow, records, store, h)
+                if seen:
+                    fingerprints.put(key, *seen)
+                new_records = len(new_entries)
+                stats.new_records += new_records
+                if ZTBCrawlFlow.details and new_entries and not flow.replay:
+                    with stats.stage('details'):
+                        commit_details(new_entries, store, h)
+                if not request:
+                    break
+                if new_records < len(records) + skipped and not flow.backfill:
+                    break  # caught up with the records seen before
+                (location, data), page = request, page + 1
+        CrawlerDataSource.fetch_done(source, True)
+        log_it(h, '#Info: job for url "%s" succeeded' % flow.url)
+        stats.succeeded = True
+    except ContentNotModified:
+        CrawlerDataSource.fetch_done(source, True)
+        stats.counters['not_modified'] = stats.counters.get('not_modified', 0) + 1
+        log_it(h, '#Info: job for url "%s" skipped: content not modified' % flow.url)
+        stats.succeeded = True
+    except Exception as e:
+        CrawlerDataSource.fetch_done(source, False)
+        try:
+            message = unicode(e)
+        except UnicodeError:
+            message = repr(e)
+        stats.error = (e.__class__.__name__, message)
+        log_it(h, '#Error: job for url "%s" failed: %s: %s' % (flow.url, stats.error[0], stats.error[1]))
+        stats.succeeded = False
+    finally:
+        if profiler:
+            profiler.disable()
+            name = '%s-%s.pstats' % (re.sub(r'[^\w.-]', '_', HostThrottle.host_of(flow.url)),
+                                     hashlib.md5(flow.url).hexdigest()[:8])
+            profiler.dump_stats(os.path.join(FlowStats.profile_dir, name))
+    return stats
+
+
+def run_flows(flows, store, h, workers=1):
+    """
+    Runs the flows, sequentially or with a pool of worker threads. In the
+    latter case the log lines of each flow are kept together and written in
+    the order of the flows, whatever the order they finish in.
+
+    :return: the FlowStats objects of the flows, in the order of the flows
+    """
+    if workers <= 1:
+        return [run_flow(flow, store, h) for flow in flows]
+    stats = [None] * len(flows)
+    todo = Queue.Queue()
+    done = Queue.Queue()
+    for i, flow in enumerate(flows):
+        todo.put((i, flow))
+
+    def worker():
+        while True:
+            try:
+                i, flow = todo.get_nowait()
+            except Queue.Empty:
+                return
+            buf = FlowLogBuffer()
+            try:
+                stats[i] = run_flow(flow, store, buf)
+            finally:
+                done.put((i, buf))
+
+    threads = [threading.Thread(target=worker) for _ in xrange(min(workers, len(flows)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    finished = {}
+    next_to_log = 0
+    while next_to_log < len(flows):
+        i, buf = done.get()
+        finished[i] = buf
+        while next_to_log in finished:
+            finished.pop(next_to_log).replay(h)
+            next_to_log += 1
+    for t in threads:
+        t.join()
+    return stats
+
+
+RECORD_STORES = {
+    'dir': lambda prefix: DirectoryRecordStore(prefix),
+    'sqlite': lambda prefix: SQLiteRecordStore(os.path.join(prefix, 'records.sqlite')),
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Crawls ZTB web sites for new records.')
+    parser.add_argument('prefix', help='directory the records and logs are written to')
+    parser.add_argument('--catalogue', metavar='PATH', default=ZTBCrawlFlow.catalogue_path,
+                        help='JSON (or YAML) file describing the flows; in daemon and worker modes, its '
+                             'changes are applied without restarting (default: flows.json next to this '
+                             'script)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of flows to run in parallel (default: 1)')
+    parser.add_argument('--per-host', type=int, default=1,
+                        help='maximum number of concurrent requests per host (default: 1)')
+    parser.add_argument('--host-delay', type=float, default=1.0,
+                        help='minimum delay in seconds between requests to the same host (default: 1.0)')
+    parser.add_argument('--connect-timeout', type=float, default=CrawlerDataSourceWebPage.timeout[0],
+                        help='seconds to wait for a connection to a web site (default: %g)'
+                             % CrawlerDataSourceWebPage.timeout[0])
+    parser.add_argument('--read-timeout', type=float, default=CrawlerDataSourceWebPage.timeout[1],
+                        help='seconds to wait for a web site to send data (default: %g)'
+                             % CrawlerDataSourceWebPage.timeout[1])
+    parser.add_argument('--breaker-threshold', type=int, default=5,
+                        help='number of consecutive failed requests after which a host is skipped (default: 5)')
+    parser.add_argument('--breaker-cooldown', type=float, default=600,
+                        help='seconds a host is skipped for after failing, before trying it again (default: 600)')
+    parser.add_argument('--store', choices=sorted(RECORD_STORES), default='dir',
+                        help='where to keep the records: one file per record under the prefix '
+                             'directory (dir, the default) or an SQLite database in it (sqlite)')
+    parser.add_argument('--parser', choices=sorted(PARSER_BACKENDS), default=ParserBackend.default,
+                        help='how to parse the pages of the flows not asking for a specific parser; '
+                             'subtree only builds the tree of the part of the page searched '
+                             '(default: %s)' % ParserBackend.default)
+    parser.add_argument('--replay', action='store_true',
+                        help='read the pages from the cached copies of the flows (see sample-data/) '
+                             'instead of fetching them')
+    parser.add_argument('--prometheus-textfile', metavar='PATH',
+                        help='where to write the metrics of the run for Prometheus '
+                             '(default: ztb-crawler.prom in the prefix directory)')
+    parser.add_argument('--profile', action='store_true',
+                        help='dump the cProfile stats of each flow in a directory next to the log')
+    parser.add_argument('--no-http-cache', action='store_true',
+                        help='always fetch and process the pages in full, even if they have not changed')
+    parser.add_argument('--max-pages', type=int, default=ZTBCrawlFlow.max_pages,
+                        help='maximum number of pages read per listing; pages after the first one are only '
+                             'read while all records on the previous one are new (default: %d)'
+                             % ZTBCrawlFlow.max_pages)
+    parser.add_argument('--backfill', action='store_true',
+                        help='read --max-pages pages of each listing, even if their records have been seen')
+    parser.add_argument('--max-page-bytes', type=int, default=ZTBCrawlFlow.max_bytes,
+                        help='size of the pages beyond which a flow fails, unless set by the flow '
+                             '(default: %d)' % ZTBCrawlFlow.max_bytes)
+    parser.add_argument('--no-early-stop', action='store_true',
+                        help='read the pages in full, even past the listing')
+    parser.add_argument('--no-fingerprints', action='store_true',
+                        help='extract all the rows of the listings, even if they have not changed since the '
+                             'last run')
+    parser.add_argument('--parse-processes', type=int, default=0,
+                        help='number of processes to decode, parse and extract the pages in, so that '
+                             'all cores are used; 0 to do it in the crawling threads (default: 0)')
+    parser.add_argument('--details', action='store_true',
+                        help='also fetch the article of each new record and keep its text, budget and '
+                             'deadline with the record (not when replaying)')
+    parser.add_argument('--detail-workers', type=int, default=4,
+                        help='maximum number of articles fetched at the same time, all flows together; '
+                             '--per-host and --host-delay apply as well (default: 4)')
+    parser.add_argument('--no-index', action='store_true',
+                        help='do not add the new records to the index the query command searches')
+    parser.add_argument('--subscriptions', metavar='PATH',
+                        help='JSON file of the subscribers, each with keywords, cities and exclusions; the '
+                             'new records of each subscriber are also logged in subscribers/<name>/ under '
+                             'the prefix directory, for sender.vbs')
+    parser.add_argument('--no-outbox', action='store_true',
+                        help='do not spool the new records in the outbox the deliver command reads')
+    parser.add_argument('--no-archive', action='store_true',
+                        help='do not keep the pages fetched in the archive the reextract command reads')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='do not look for the new records that are the same tender as a record of another '
+                             'flow; otherwise they are indexed, but neither routed to the subscribers nor '
+                             'spooled in the outbox')
+    parser.add_argument('--dedup-threshold', type=float, default=0.75,
+                        help='similarity of the titles (0 to 1) from which records are the same tender '
+                             '(default: 0.75)')
+    parser.add_argument('--dedup-window', type=int, default=30,
+                        help='maximum number of days between the records of the same tender (default: 30)')
+    daemon = parser.add_argument_group('daemon mode')
+    daemon.add_argument('--daemon', action='store_true',
+                        help='keep running, polling each flow at its own adaptive interval')
+    daemon.add_argument('--interval', type=float, default=1800,
+                        help='initial polling interval of the flows, in seconds (default: 1800)')
+    daemon.add_argument('--min-interval', type=float, default=300,
+                        help='shortest polling interval, in seconds (default: 300)')
+    daemon.add_argument('--max-interval', type=float, default=6 * 3600,
+                        help='longest polling interval, in seconds (default: 21600)')
+    daemon.add_argument('--quiet-hours', metavar='HH:MM-HH:MM',
+                        help='local time window without any polling, e.g. 23:00-06:30')
+    worker = parser.add_argument_group('worker mode', 'several processes, possibly on several hosts, share the '
+                                                      'flows through a lease queue (see the coordinate command); '
+                                                      'the daemon mode options apply')
+    worker.add_argument('--lease-queue', metavar='PATH',
+                        help='run the flows leased from the queue in this SQLite database, until interrupted')
+    worker.add_argument('--worker-id', default='%s:%d' % (socket.gethostname(), os.getpid()),
+                        help='what identifies this process in the queue (default: host:pid)')
+    worker.add_argument('--lease', type=float, default=600,
+                        help='seconds a flow is leased for, renewed while it runs; a crashed process\'s '
+                             'flows go to the others once their lease expires (default: 600)')
+    args = parser.parse_args(argv)
+    if args.daemon and args.lease_queue:
+        parser.error('--daemon and --lease-queue are exclusive')
+    try:
+        parse_quiet_hours(args.quiet_hours)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.subscriptions:
+        try:
+            args.subscribers = load_subscribers(args.subscriptions)
+        except (IOError, ValueError) as e:
+            parser.error(unicode(e).encode('utf-8'))
+    return args
+
+
+def main_migrate(argv):
+    parser = argparse.ArgumentParser(
+        prog='%s migrate' % sys.argv[0],
+        description='Imports the records of a directory tree written by the dir store into the sqlite store.')
+    parser.add_argument('prefix', help='directory the records have been written to')
+    args = parser.parse_args(argv)
+    store = RECORD_STORES['sqlite'](args.prefix)
+    try:
+        read, imported = migrate_directory_tree(args.prefix, store)
+    finally:
+        store.close()
+    print '#Info: %d records read, %d of them imported' % (read, imported)
+
+
+def open_index(prefix):
+    return RecordIndex(os.path.join(prefix, 'index.sqlite'))
+
+
+def main_index(argv):
+    parser = argparse.ArgumentParser(
+        prog='%s index' % sys.argv[0],
+        description='Adds the records already collected to the index the query command searches.')
+    parser.add_argument('prefix', help='directory the records have been written to')
+    parser.add_argument('--store', choices=sorted(RECORD_STORES), default='dir',
+                        help='where the records are kept (default: dir)')
+    args = parser.parse_args(argv)
+    store = RECORD_STORES[args.store](args.prefix)
+    index = open_index(args.prefix)
+    read = indexed = 0
+    try:
+        batch = []
+        for entry in store.walk():
+            batch.append(entry)
+            read += 1
+            if len(batch) >= 1000:
+                indexed += index.add_batch(batch)
+                batch = []
+        indexed += index.add_batch(batch)
+    finally:
+        store.close()
+        index.close()
+    print '#Info: %d records read, %d of them indexed' % (read, indexed)
+
+
+def main_query(argv):
+    parser = argparse.ArgumentParser(
+        prog='%s query' % sys.argv[0],
+        description='Searches the records collected for keywords in their titles.')
+    parser.add_argument('prefix', help='directory the records have been written to')
+    parser.add_argument('keywords', nargs='*',
+                        help='what the titles shall all contain, e.g. 监理')
+    parser.add_argument('--city', help='part of the name of the city of the records, e.g. 南京')
+    parser.add_argument('--since', metavar='YYYY-mm-dd', help='first day of the records')
+    parser.add_argument('--until', metavar='YYYY-mm-dd', help='last day of the records')
+    parser.add_argument('--limit', type=int, default=50,
+                        help='maximum number of records listed, latest first (default: 50)')
+    args = parser.parse_args(argv)
+    for day in (args.since, args.until):
+        if day and not re.match(r'^\d{4}-\d{2}-\d{2}$', day):
+            parser.error('invalid day "%s", shall be like 2015-06-30' % day)
+    encoding = sys.stdin.encoding or 'utf-8'
+    decode = lambda s: s.decode(encoding) if isinstance(s, str) else s
+    index = open_index(args.prefix)
+    try:
+        started = time.time()
+        found = index.query([decode(k) for k in args.keywords], decode(args.city) if args.city else None,
+                            args.since, args.until, args.limit)
+        elapsed = time.time() - started
+    finally:
+        index.close()
+    for digest, data in found:
+        print '  '.join(data).encode(sys.stdout.encoding or 'utf-8', 'replace')
+    print '#Info: %d records found in %.1f ms' % (len(found), elapsed * 1000)
+
+
+def open_outbox(prefix, matcher=None):
+    return Outbox(os.path.join(prefix, 'outbox'), matcher)
+
+
+def main_deliver(argv):
+    parser = argparse.ArgumentParser(
+        prog='%s deliver' % sys.argv[0],
+        description='Delivers the new records spooled in the outbox since the last delivery to the same consumer.')
+    parser.add_argument('prefix', help='directory the records have been written to')
+    parser.add_argument('sink', help='where to deliver the records: stdout, file:PATH, or the url of a webhook '
+                                     'the records are posted to as JSON')
+    parser.add_argument('--consumer', default='default',
+                        help='name the offset delivered up to is kept by; one per sink (default: default)')
+    parser.add_argument('--subscriber', help='only deliver the records routed to this subscriber')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='maximum number of records per message (default: 100)')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='number of times a failed message is sent again before giving up (default: 3)')
+    parser.add_argument('--follow', type=float, metavar='SECONDS',
+                        help='keep delivering, looking for new records every SECONDS')
+    args = parser.parse_args(argv)
+    if not re.match(r'^[\w.-]+$', args.consumer) or args.consumer.startswith('.'):
+        parser.error('invalid consumer name "%s"' % args.consumer)
+    try:
+        sink = make_sink(args.sink)
+    except ValueError as e:
+        parser.error(str(e))
+    outbox = open_outbox(args.prefix)
+    log = lambda s: sys.stderr.write(s + '\n')
+    try:
+        while True:
+            sent, ok = deliver(outbox, args.consumer, sink, args.batch_size,
+                               args.subscriber.decode(sys.stdin.encoding or 'utf-8') if args.subscriber else None,
+                               args.retries, log=log)
+            outbox.compact()
+            log('#Info: %d records delivered to consumer "%s"' % (sent, args.consumer))
+            if not ok:
+                sys.exit(1)
+            if args.follow is None:
+                break
+            time.sleep(args.follow)
+    finally:
+        sink.close()
+
+
+def open_duplicates(prefix, threshold=0.75, window=30):
+    return DuplicateDetector(os.path.join(prefix, 'duplicates.sqlite'), threshold, window)
+
+
+def main_duplicates(argv):
+    parser = argparse.ArgumentParser(
+        prog='%s duplicates' % sys.argv[0],
+        description='Shows the records that are the same tender as a record of another flow.')
+    parser.add_argument('prefix', help='directory the records have been written to')
+    parser.add_argument('--add', action='store_true',
+                        help='first look for the duplicates among the records already collected')
+    parser.add_argument('--store', choices=sorted(RECORD_STORES), default='dir',
+                        help='where the records are kept, for --add (default: dir)')
+    parser.add_argument('--threshold', type=float, default=0.75,
+                        help='similarity of the titles from which records are duplicates, for --add (default: 0.75)')
+    parser.add_argument('--window', type=int, default=30,
+                        help='maximum number of days between duplicates, for --add (default: 30)')
+    parser.add_argument('--limit', type=int, default=50,
+                        help='maximum number of groups of duplicates listed, latest first (default: 50)')
+    args = parser.parse_args(argv)
+    duplicates = open_duplicates(args.prefix, args.threshold, args.window)
+    try:
+        if args.add:
+            store = RECORD_STORES[args.store](args.prefix)
+            read = found = 0
+            try:
+                batch = []
+                for entry in store.walk():
+                    batch.append(entry)
+                    read += 1
+                    if len(batch) >= 1000:
+                        found += duplicates.add_batch(batch)
+                        batch = []
+                found += duplicates.add_batch(batch)
+            finally:
+                store.close()
+            print '#Info: %d records read, %d duplicates found' % (read, found)
+        groups = duplicates.groups(args.limit)
+    finally:
+        duplicates.close()
+    encoding = sys.stdout.encoding or 'utf-8'
+    for canonical, others in groups:
+        for mark, (digest, day, name, title) in [('*', canonical)] + [(' ', r) for r in others]:
+            print (u'%s %s  %s  %s  %s' % (mark, digest, day, name, title)).encode(encoding, 'replace')
+        print
+
+
+def main_export(argv):
+    parser = argparse.ArgumentParser(
+        prog='%s export' % sys.argv[0],
+        description='Writes the records collected to one columnar file, for the analyses over the years of them.')
+    parser.add_argument('prefix', help='directory the records have been written to')
+    parser.add_argument('output', help='file written: .parquet, .arrow (both need pyarrow) or .csv.gz')
+    parser.add_argument('--store', choices=sorted(RECORD_STORES), default='dir',
+                        help='where the records are kept (default: dir)')
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS),
+                        help='format of the file (default: after its extension)')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='records per row group, or record batch (default: 10000)')
+    args = parser.parse_args(argv)
+    try:
+        export = open_export(args.output, args.format)
+    except ValueError as e:
+        parser.error(str(e))
+    store = RECORD_STORES[args.store](args.prefix)
+    try:
+        written = export_records(store.walk(), export, args.batch_size)
+    finally:
+        store.close()
+        export.close()
+    print '#Info: %d records exported to "%s"' % (written, args.output)
+
+
+def open_archive(prefix):
+    return PageArchive(os.path.join(prefix, 'archive'))
+
+
+def reextract_page(flow, directory, page):
+    """
+    :param page: tuple as from PageArchive.pages()
+    :return: the records of the archived page, as extracted now; they are
+             stamped with the time the page was fetched
+    """
+    url, number, location, content_type, fetched, segment, offset, length = page
+    content = read_blob(directory, segment, offset, length)
+    text = CrawlerDataSource.decode_content(location, content, content_type)
+    return extract_records(flow, text, FlowStats(flow), fetched)
+
+
+def reextract_page_in_worker(directory, page):
+    """
+    What the reextract command runs in the processes of its ExtractionPool.
+
+    :return: tuple (url, records or the error message)
+    """
+    try:
+        return page[0], reextract_page(ExtractionPool.worker_flows[page[0]], directory, page)
+    except Exception as e:
+        return page[0], '%s: %s' % (e.__class__.__name__, e)
+
+
+def main_reextract(argv):
+    parser = argparse.ArgumentParser(
+        prog='%s reextract' % sys.argv[0],
+        description='Extracts the records of the archived pages again, with the flows as they are now, and adds '
+                    'those not collected yet; e.g. once a generator has been fixed. They are neither routed to '
+                    'the subscribers nor spooled in the outbox.')
+    parser.add_argument('prefix', help='directory the records have been written to')
+    parser.add_argument('--flow', metavar='URL', action='append',
+                        help='url of the flow whose pages are extracted again; may be repeated (default: all)')
+    parser.add_argument('--since', metavar='YYYY-mm-dd', help='first day of the pages')
+    parser.add_argument('--until', metavar='YYYY-mm-dd', help='last day of the pages')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes to extract the pages in; 0 to do it in this one '
+                             '(default: the number of cores)')
+    parser.add_argument('--store', choices=sorted(RECORD_STORES), default='dir',
+                        help='where the records are kept (default: dir)')
+    parser.add_argument('--catalogue', metavar='PATH', default=ZTBCrawlFlow.catalogue_path,
+                        help='JSON (or YAML) file describing the flows (default: flows.json next to this script)')
+    parser.add_argument('--no-index', action='store_true',
+                        help='do not add the new records to the index the query command searches')
+    parser.add_argument('--dry-run', action='store_true', help='only count the records, add none')
+    args = parser.parse_args(argv)
+    ZTBCrawlFlow.catalogue_path = args.catalogue
+    flows = load_flows()
+    urls = args.flow or sorted(flows)
+    unknown = [url for url in urls if url not in flows]
+    if unknown:
+        parser.error('unknown flow(s): %s' % ', '.join(unknown))
+    archive = open_archive(args.prefix)
+    try:
+        pages = archive.pages(urls, args.since, args.until)
+    finally:
+        archive.close()
+    directory = archive.directory
+    pool = None
+    if args.processes > 0 and len(pages) > 1:
+        pool = ExtractionPool(args.processes)
+        results = pool.pool.imap(functools.partial(reextract_page_in_worker, directory), pages, 8)
+    else:
+        ExtractionPool.worker_flows = flows
+        results = itertools.imap(functools.partial(reextract_page_in_worker, directory), pages)
+    store = RECORD_STORES[args.store](args.prefix)
+    if not (args.no_index or args.dry_run):
+        store = ObservedRecordStore(store, [open_index(args.prefix)])
+    log = '%s/ztb-crawler-reextract-%s.log' % (args.prefix, datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+    failed = extracted = new = 0
+    try:
+        with codecs.open(log, 'a', 'utf-8') as h:
+            for (url, records), page in zip(results, pages):
+                if isinstance(records, basestring):
+                    failed += 1
+                    log_it(h, '#Error: page %d of "%s" fetched at %s not extracted: %s' % (
+                        page[1], url, page[4], records))
+                    continue
+                extracted += len(records)
+                if not args.dry_run:
+                    new += len(commit(flows[url], records, store, h))
+            log_it(h, '#Info: %d pages, %d failed, %d records extracted, %d new' % (
+                len(pages), failed, extracted, new))
+            log_it(h, '#Info: log has been written to "%s"' % os.path.abspath(log))
+    finally:
+        store.close()
+        if pool:
+            pool.close()
+
+
+def main_coordinate(argv):
+    parser = argparse.ArgumentParser(
+        prog='%s coordinate' % sys.argv[0],
+        description='Fills the lease queue the crawler processes run with --lease-queue share with the flows, '
+                    'and shows its state.')
+    parser.add_argument('queue', help='the SQLite database of the queue')
+    parser.add_argument('--interval', type=float, default=1800,
+                        help='initial polling interval of the flows added, in seconds (default: 1800)')
+    parser.add_argument('--status', action='store_true', help='only show the state of the queue')
+    parser.add_argument('--catalogue', metavar='PATH', default=ZTBCrawlFlow.catalogue_path,
+                        help='JSON (or YAML) file describing the flows (default: flows.json next to this script)')
+    args = parser.parse_args(argv)
+    ZTBCrawlFlow.catalogue_path = args.catalogue
+    queue = LeaseQueue(args.queue)
+    try:
+        if not args.status:
+            added, removed = queue.sync(load_flows().keys(), args.interval)
+            print '#Info: %d flows added to the queue, %d removed' % (added, removed)
+        now = time.time()
+        for url, due, interval, failures, owner, lease_until, leases, result in queue.status():
+            state = 'leased by %s for %ds' % (owner, lease_until - now) if owner else 'due in %ds' % (due - now)
+            print '%s  %s  interval %ds  %d failures  %d leases  last: %s' % (
+                url, state, interval or 0, failures, leases, result)
+    finally:
+        queue.close()
+
+
+COMMANDS = {
+    'migrate': main_migrate,
+    'coordinate': main_coordinate,
+    'index': main_index,
+    'query': main_query,
+    'deliver': main_deliver,
+    'duplicates': main_duplicates,
+    'export': main_export,
+    'reextract': main_reextract,
+}
+
+
+def run_cycle(flows, store, args, router=None):
+    """
+    Runs the flows once, with a log of its own (and the .is-new flag of it
+    sender.vbs looks for), then writes the metrics of the run.
+
+    :param router: SubscriptionRouter object observing the store, if any
+
+    :return: the FlowStats objects of the flows
+    """
+    prefix = args.prefix
+    log_base = '%s/ztb-crawler-%s' % (prefix, datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+    if args.lease_queue:  # other processes may write logs in the same second
+        log_base += '-' + re.sub(r'[^\w.-]', '_', args.worker_id)
+    log = log_base + '.log'
+    if args.profile:
+        FlowStats.profile_dir = log_base + '.profile'
+        ensure_path_exists(FlowStats.profile_dir)
     with codecs.open(log, 'a', 'utf-8') as h:
         log_it(h, '#Info: log will be written to "%s"' % os.path.abspath(log))
-        for url, flow in get_crawl_workflows().iteritems():
-            log_it(h, '#Info: job for url "%s" started ...' % url)
-            try:
-                source = flow.url  # TODO: implement this as an option
-                text = CrawlerDataSource.fetch_text(source)
-                soup = bs4.BeautifulSoup(text, 'html.parser')
-                for a in SoupAncestorSearch.search_soup_for_tags(soup, flow.tag, flow.searches):
-                    data = flow.generator(flow, a)
-                    commit(flow, data, prefix, h)
-                log_it(h, '#Info: job for url "%s" succeeded' % url)
-            except:
-                log_it(h, '#Error: job for url "%s" failed' % url)
+        started = time.time()
+        stats = run_flows(flows, store, h, args.workers)
+        CrawlerDataSourceWebPage.breaker.save_state()
+        if ZTBCrawlFlow.fingerprints:
+            ZTBCrawlFlow.fingerprints.save()
+        summary = run_summary(stats, started, time.time())
+        write_json_summary(summary, log_base + '.metrics.json')
+        write_prometheus_textfile(FlowStats.latest.update(summary) if FlowStats.latest else summary,
+                                  args.prometheus_textfile or os.path.join(prefix, 'ztb-crawler.prom'))
+        log_it(h, '#Info: %(flows)d jobs, %(failed)d failed, %(records)d records seen, %(new_records)d new, '
+                  '%(bytes_fetched)d bytes fetched' % summary['totals'])
+        log_it(h, '#Info: metrics written to "%s"' % os.path.abspath(log_base + '.metrics.json'))
         log_it(h, '#Info: log has been written to "%s"' % os.path.abspath(log))
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if router:
+        for name, n in sorted(router.flush(os.path.basename(log), timestamp).iteritems()):
+            print '#Info: %d new records for subscriber "%s"' % (n, name.encode('utf-8'))
     with codecs.open(log + '.is-new', 'w', 'utf-8') as h:
-        h.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + '\n')
+        h.write(timestamp + '\n')
+    return stats
+
+
+def run_daemon(flows, store, args, router=None):
+    """
+    Keeps polling the flows, each when the scheduler says it is due. The
+    flows (and their compiled matchers), the record store, the HTTP sessions
+    and caches stay warm in memory between the polls.
+    """
+    scheduler = AdaptiveScheduler(args.interval, args.min_interval, args.max_interval,
+                                  quiet_hours=parse_quiet_hours(args.quiet_hours),
+                                  state_path=os.path.join(args.prefix, '.schedule.json'))
+    by_url = dict((flow.url, flow) for flow in flows)
+    for url in sorted(by_url):
+        scheduler.add(url)
+    FlowStats.latest = LatestFlowMetrics()
+    while True:
+        added, changed, removed = reload_flows(by_url)
+        for url in added:
+            scheduler.add(url)
+        for url in removed:
+            scheduler.remove(url)
+            FlowStats.latest.remove(url)
+        now = time.time()
+        due = scheduler.next_due()
+        if due is None:  # no flows at all, until the catalogue has some again
+            time.sleep(60)
+            continue
+        if due > now:
+            time.sleep(min(due - now, 60))
+            continue
+        urls, stats = scheduler.pop_due(now), []
+        try:
+            stats = run_cycle([by_url[url] for url in urls], store, args, router)
+            for s in stats:
+                delay = scheduler.report(s.flow.url, s.succeeded, s.new_records)
+                print '#Info: next poll of "%s" in %d seconds' % (s.flow.url, delay)
+        finally:
+            # the flows of a cycle that failed as a whole are failed polls,
+            # rather than out of the queue for good
+            reported = set([s.flow.url for s in stats])
+            for url in urls:
+                if url not in reported:
+                    scheduler.report(url, False, 0)
+            scheduler.save_state()
+
+
+def run_worker(flows, store, args, router=None):
+    """
+    Keeps running the flows leased from the queue, up to --workers of them at
+    a time, renewing their leases meanwhile; each is completed (which
+    schedules its next poll) once its records have been committed.
+    """
+    queue = LeaseQueue(args.lease_queue)
+    policy = AdaptiveScheduler(args.interval, args.min_interval, args.max_interval,
+                               quiet_hours=parse_quiet_hours(args.quiet_hours))
+    by_url = dict((flow.url, flow) for flow in flows)
+    owner = args.worker_id
+    name = re.sub(r'[^\w.-]', '_', owner)
+    FlowStats.latest = LatestFlowMetrics(os.path.join(args.prefix, '.metrics-%s.json' % name),
+                                         os.path.join(args.prefix, '.metrics-*.json'))
+    queue.restrict(by_url)
+    try:
+        while True:
+            # the flows added are run once the coordinate command has queued them
+            added, changed, removed = reload_flows(by_url)
+            if added or removed:
+                queue.restrict(by_url)
+            for url in removed:
+                FlowStats.latest.remove(url)
+            leased = queue.acquire(owner, args.lease, max(args.workers, 1))
+            unknown = [url for url, interval, failures in leased if url not in by_url]
+            if unknown:  # removed from the catalogue since acquire()
+                queue.release(unknown, owner)
+            leased = [(url, interval, failures) for url, interval, failures in leased if url in by_url]
+            if not leased:
+                due = queue.next_due()
+                time.sleep(min(max((due or 0) - time.time(), 1), 60))
+                continue
+            done = threading.Event()
+
+            def renew():
+                while not done.wait(args.lease / 3):
+                    for url in queue.renew([url for url, _, _ in leased], owner, args.lease):
+                        print '#Warning: lease of "%s" lost' % url
+
+            renewer = threading.Thread(target=renew)
+            renewer.daemon = True
+            renewer.start()
+            try:
+                stats = run_cycle([by_url[url] for url, _, _ in leased], store, args, router)
+            finally:
+                done.set()
+                renewer.join()
+            for (url, interval, failures), s in zip(leased, stats):
+                interval, failures, delay = policy.next_poll(interval or args.interval, failures, s.succeeded,
+                                                             s.new_records)
+                due = policy.after_quiet_hours(time.time() + delay)
+                result = 'ok' if s.succeeded else '%s: %s' % s.error
+                if queue.complete(url, owner, interval, failures, due, result):
+                    print '#Info: next poll of "%s" in %d seconds' % (url, due - time.time())
+    finally:
+        queue.close()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+    args = parse_args(sys.argv[1:])
+    prefix = args.prefix
+    CrawlerDataSourceWebPage.throttle = HostThrottle(args.per_host, args.host_delay)
+    CrawlerDataSourceWebPage.timeout = (args.connect_timeout, args.read_timeout)
+    CrawlerDataSourceWebPage.breaker = CircuitBreaker(args.breaker_threshold, args.breaker_cooldown,
+                                                      os.path.join(prefix, '.circuits.json'))
+    ParserBackend.default = args.parser
+    ZTBCrawlFlow.replay = args.replay
+    ZTBCrawlFlow.max_pages = args.max_pages
+    ZTBCrawlFlow.backfill = args.backfill
+    ZTBCrawlFlow.max_bytes = args.max_page_bytes
+    ZTBCrawlFlow.stop_early = not args.no_early_stop
+    if not args.no_fingerprints:
+        ZTBCrawlFlow.fingerprints = ListingFingerprints(os.path.join(prefix, '.fingerprints.json'))
+    ensure_path_exists(prefix)
+    if not args.no_http_cache:
+        CrawlerDataSourceWebPage.cache = HTTPResponseCache(os.path.join(prefix, '.http-cache'))
+    if args.details:
+        ZTBCrawlFlow.details = DetailFetcher(fetch_article, DetailCache(os.path.join(prefix, '.detail-cache')),
+                                             args.detail_workers)
+    if not args.no_archive:
+        ZTBCrawlFlow.archive = open_archive(prefix)
+    ZTBCrawlFlow.catalogue_path = args.catalogue
+    flows = [flow for url, flow in sorted(load_flows().iteritems())]
+    store = RECORD_STORES[args.store](prefix)
+    observers = []
+    if not args.no_index:
+        observers.append(open_index(prefix))
+    router = None
+    if args.subscriptions:
+        router = SubscriptionRouter(args.subscribers, os.path.join(prefix, 'subscribers'))
+        observers.append(router)
+    if not args.no_outbox:
+        observers.append(open_outbox(prefix, router.matcher if router else None))
+    duplicates = None
+    if not args.no_dedup:
+        duplicates = open_duplicates(prefix, args.dedup_threshold, args.dedup_window)
+    if observers or duplicates:
+        store = ObservedRecordStore(store, observers, duplicates)
+    if args.parse_processes > 0:
+        ExtractionPool.current = ExtractionPool(args.parse_processes)
+    try:
+        if args.daemon:
+            run_daemon(flows, store, args, router)
+        elif args.lease_queue:
+            run_worker(flows, store, args, router)
+        else:
+            run_cycle(flows, store, args, router)
+    finally:
+        store.close()
+        if ZTBCrawlFlow.archive:
+            ZTBCrawlFlow.archive.close()
+        if ExtractionPool.current:
+            ExtractionPool.current.close()
 
 
-main()
+if __name__ == '__main__':
+    main()
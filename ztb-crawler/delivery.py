@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import codecs
+import requests
+
+
+def format_record(record):
+    """
+    :return: the record as one line, as in the logs
+    """
+    return u'  '.join([record['name'], record['t'], record['addr'], record['title'], record['collected']])
+
+
+class Sink(object):
+    """
+    Where the records of the outbox are delivered to, many at a time.
+    """
+
+    def send(self, records):
+        """
+        Delivers the records as one message; raises if that fails, in which
+        case they are sent again later.
+
+        :param records: list of record dicts, as spooled by outbox.Outbox
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class StdoutSink(Sink):
+    def send(self, records):
+        text = u'\n'.join([format_record(r) for r in records]) + u'\n'
+        sys.stdout.write(text.encode(sys.stdout.encoding or 'utf-8', 'replace'))
+        sys.stdout.flush()
+
+
+class FileSink(Sink):
+    def __init__(self, path):
+        """
+        Appends the records to the file at path, one line each.
+        """
+        self.path = path
+
+    def send(self, records):
+        with codecs.open(self.path, 'a', 'utf-8') as h:
+            for r in records:
+                h.write(format_record(r) + u'\n')
+
+
+class WebhookSink(Sink):
+    def __init__(self, url, timeout=30):
+        """
+        Posts the records to url as one JSON document:
+          {"text": "<the records, one line each>", "records": [...]}
+        Any status but 2xx is a failure.
+        """
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, records):
+        payload = {
+            'text': u'\n'.join([format_record(r) for r in records]),
+            'records': records,
+        }
+        r = self.session.post(self.url, data=json.dumps(payload), timeout=self.timeout,
+                              headers={'Content-Type': 'application/json; charset=utf-8'})
+        if not 200 <= r.status_code < 300:
+            raise IOError("Webhook '%s' returns status code %d" % (self.url, r.status_code))
+
+    def close(self):
+        self.session.close()
+
+
+def make_sink(spec):
+    """
+    :param spec: 'stdout', 'file:PATH', or the url of a webhook
+    :return: the Sink object
+    """
+    if spec == 'stdout':
+        return StdoutSink()
+    if spec.startswith('file:'):
+        return FileSink(spec[len('file:'):])
+    if spec.startswith('http://') or spec.startswith('https://'):
+        return WebhookSink(spec)
+    raise ValueError('unknown sink "%s", shall be stdout, file:PATH or the url of a webhook' % spec)
+
+
+def deliver(outbox, consumer, sink, batch_size=100, subscriber=None, retries=3, backoff=5.0, log=None):
+    """
+    Sends the records spooled since the offset of consumer to sink, in
+    batches, acking each batch once sent. A batch failing more than retries
+    times stops the delivery; it is what the next delivery starts with.
+
+    :param subscriber: name of the only subscriber whose records are sent,
+                       if any; the other records are skipped (and acked)
+    :param log: function(message) telling what happens, if any
+    :return: tuple (number of records sent, whether everything has been)
+    """
+    sent = 0
+    offset = outbox.offset(consumer)
+    outbox.ack(consumer, offset)  # so that compact() keeps what a new consumer has not read yet
+    while True:
+        found = outbox.read(offset, batch_size)
+        if not found:
+            return sent, True
+        records = [r for r, _ in found if subscriber is None or subscriber in r.get('subscribers', [])]
+        attempt = 0
+        while records:
+            try:
+                sink.send(records)
+                break
+            except Exception as e:
+                attempt += 1
+                if log:
+                    log('#Warning: delivery of %d records to consumer "%s" failed (attempt %d): %s: %s' % (
+                        len(records), consumer, attempt, e.__class__.__name__, e))
+                if attempt > retries:
+                    return sent, False
+                time.sleep(backoff * 2 ** (attempt - 1))
+        offset = found[-1][1]
+        outbox.ack(consumer, offset)
+        sent += len(records)
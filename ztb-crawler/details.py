@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import time
+import Queue
+import hashlib
+import threading
+from urlparse import urlparse, urlunparse, parse_qsl
+from urllib import urlencode
+import bs4
+
+
+def normalize_url(url):
+    """
+    :return: url in a canonical form, so that the addresses of the same
+             article as written by different listings compare equal: lower
+             case scheme and host, no default port, no fragment, no '/../'
+             nor '/./' in the path, query parameters sorted
+    """
+    p = urlparse(url.strip())
+    scheme = p.scheme.lower()
+    host = p.netloc.lower()
+    if (scheme, host.rpartition(':')[2]) in (('http', '80'), ('https', '443')):
+        host = host.rpartition(':')[0]
+    path = p.path or '/'
+    path = re.sub(r'/(\./)+', '/', path)
+    while re.search(r'[^/]+/\.\./', path):
+        path = re.sub(r'[^/]+/\.\./', '', path, 1)
+    query = urlencode(sorted(parse_qsl(p.query, keep_blank_values=True))) if p.query else ''
+    return urlunparse((scheme, host, path, p.params, query, ''))
+
+
+class DetailCache(object):
+    def __init__(self, directory):
+        """
+        On-disk cache of the details extracted from the article pages,
+        content-addressed: each distinct page body is kept once (as the
+        details extracted from it) under the sha1 digest of the body, and
+        each normalized url refers to the body it was fetched with. An
+        article republished under the same url by several portals, or seen
+        again by a later run, is thus fetched only once.
+
+        :param directory: where the cache is kept
+        :return:
+        """
+        self.directory = directory
+        for d in ('urls', 'objects'):
+            path = os.path.join(directory, d)
+            if not os.access(path, os.R_OK):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    pass
+
+    def url_path(self, url):
+        return os.path.join(self.directory, 'urls', hashlib.md5(normalize_url(url).encode('utf-8')).hexdigest())
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest + '.json')
+
+    def lookup(self, url):
+        """
+        :return: the details of the article at url, None if not cached
+        """
+        try:
+            with open(self.url_path(url), 'r') as h:
+                digest = h.read().strip()
+            with open(self.object_path(digest), 'r') as h:
+                return json.load(h)
+        except (IOError, ValueError):
+            return None
+
+    def store(self, url, content, details):
+        """
+        :param content: the raw body of the article page
+        :param details: dict of what has been extracted from it
+        """
+        digest = hashlib.sha1(content).hexdigest()
+        path = self.object_path(digest)
+        if not os.access(path, os.R_OK):
+            self.write_replacing(path, json.dumps(details, sort_keys=True))
+        self.write_replacing(self.url_path(url), digest + '\n')
+
+    @staticmethod
+    def write_replacing(path, s):
+        tmp = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp, 'w') as h:
+            h.write(s)
+        if os.name == 'nt' and os.access(path, os.F_OK):
+            os.remove(path)  # rename() does not replace files on Windows
+        os.rename(tmp, path)
+
+
+BLOCK_TAGS = set(['div', 'td', 'th', 'article', 'section', 'li', 'body'])
+SKIPPED_TAGS = set(['script', 'style', 'noscript', 'head', 'title', 'select', 'option'])
+
+BUDGET_LABELS = [u'预算金额', u'项目预算', u'采购预算', u'预算价', u'最高限价', u'招标控制价',
+                 u'控制价', u'投资估算', u'估算价', u'投资额', u'投资总额']
+__budget__ = re.compile(u'(%s)[^\\d\\n]{0,20}?(\\d[\\d,，]*(?:\\.\\d+)?)\\s*(亿元|万元|元)?' % u'|'.join(BUDGET_LABELS))
+BUDGET_UNITS = {u'亿元': 100000000, u'万元': 10000, u'元': 1, None: 1}
+
+DEADLINE_LABELS = [u'投标截止时间', u'递交截止时间', u'响应文件提交截止时间', u'投标文件递交截止时间',
+                   u'截止时间', u'开标时间']
+__deadline__ = re.compile(
+    u'(%s)[^\\d\\n]{0,20}?(\\d{4})\\s*[年\\-/.]\\s*(\\d{1,2})\\s*[月\\-/.]\\s*(\\d{1,2})\\s*日?'
+    u'\\s*(上午|下午)?\\s*(?:(\\d{1,2})\\s*[:：时点]\\s*(\\d{1,2})?)?' % u'|'.join(DEADLINE_LABELS))
+
+
+def main_text(soup):
+    """
+    :return: the text of the block of the page holding most of its text,
+             which for article pages is the article itself
+    """
+    weights = {}
+    for s in soup.find_all(text=True):
+        if isinstance(s, bs4.Comment) or any(p.name in SKIPPED_TAGS for p in s.parents):
+            continue
+        n = len(s.strip())
+        if not n:
+            continue
+        block = next((p for p in s.parents if p.name in BLOCK_TAGS), None)
+        if block is not None:
+            weights[block] = weights.get(block, 0) + n
+    if not weights:
+        return u''
+    block = max(weights.iteritems(), key=lambda item: item[1])[0]
+    lines = []
+    for s in block.find_all(text=True):
+        if isinstance(s, bs4.Comment) or any(p.name in SKIPPED_TAGS for p in s.parents):
+            continue
+        s = re.sub(r'\s+', ' ', s).strip()
+        if s:
+            lines.append(s)
+    return u'\n'.join(lines)
+
+
+def extract_budget(text):
+    """
+    :return: tuple (amount in yuan, text it has been read from), or
+             (None, None) if no budget is found; the labels listed first in
+             BUDGET_LABELS win
+    """
+    found = {}
+    for m in __budget__.finditer(text):
+        found.setdefault(m.group(1), m)
+    for label in BUDGET_LABELS:
+        m = found.get(label)
+        if m:
+            amount = float(re.sub(u'[,，]', '', m.group(2))) * BUDGET_UNITS[m.group(3)]
+            return amount, m.group(0)
+    return None, None
+
+
+def extract_deadline(text):
+    """
+    :return: the deadline for the bids as 'YYYY-mm-dd' or 'YYYY-mm-dd HH:MM',
+             None if none is found
+    """
+    found = {}
+    for m in __deadline__.finditer(text):
+        found.setdefault(m.group(1), m)
+    for label in DEADLINE_LABELS:
+        m = found.get(label)
+        if not m:
+            continue
+        y, mo, d = int(m.group(2)), int(m.group(3)), int(m.group(4))
+        if not (1 <= mo <= 12 and 1 <= d <= 31):
+            continue
+        deadline = '%04d-%02d-%02d' % (y, mo, d)
+        if m.group(6):
+            h, mi = int(m.group(6)), int(m.group(7) or 0)
+            if m.group(5) == u'下午' and h < 12:
+                h += 12
+            if h < 24 and mi < 60:
+                deadline += ' %02d:%02d' % (h, mi)
+        return deadline
+    return None
+
+
+def extract_details(text):
+    """
+    :param text: the article page, decoded
+    :return: dict of the text of the article, its budget and its deadline
+    """
+    body = main_text(bs4.BeautifulSoup(text, 'html.parser'))
+    budget, budget_text = extract_budget(body)
+    return {
+        'text': body,
+        'budget': budget,
+        'budget_text': budget_text,
+        'deadline': extract_deadline(body),
+    }
+
+
+class DetailFetcher(object):
+    def __init__(self, fetch, cache=None, workers=4):
+        """
+        Fetches and extracts the details of articles with a fixed pool of
+        threads shared by all the flows, so that the number of article
+        requests in flight stays bounded whatever the number of flows (the
+        bound per host being up to fetch, e.g. through a HostThrottle).
+
+        :param fetch: function(url) returning tuple (content, text): the
+                      raw body of the page at url and its decoded text;
+                      raises on failure
+        :param cache: DetailCache object, if any
+        :param workers: number of threads
+        :return:
+        """
+        self.fetch = fetch
+        self.cache = cache
+        self.queue = Queue.Queue()
+        self.threads = []
+        for _ in xrange(workers):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def worker(self):
+        while True:
+            url, results = self.queue.get()
+            try:
+                results.put((url, self.details_of(url), None))
+            except Exception as e:
+                results.put((url, None, e))
+
+    def details_of(self, url):
+        """
+        :return: tuple (details, cached)
+        """
+        details = self.cache.lookup(url) if self.cache else None
+        if details is not None:
+            # cached by content, maybe as fetched from another url
+            details['url'] = url
+            return details, True
+        content, text = self.fetch(url)
+        details = extract_details(text)
+        details['url'] = url
+        details['fetched'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        if self.cache:
+            self.cache.store(url, content, details)
+        return details, False
+
+    def fetch_all(self, urls):
+        """
+        :return: list of (url, (details, cached), exception) in the order of
+                 urls; urls equal once normalized are only fetched once, each
+                 having details of its own, with its own url
+        """
+        urls = list(urls)
+        results = Queue.Queue()
+        todo = {}  # normalized url -> url to fetch
+        for url in urls:
+            todo.setdefault(normalize_url(url), url)
+        for url in sorted(todo.itervalues()):
+            self.queue.put((url, results))
+        done = {}
+        for _ in todo:
+            url, r, e = results.get()
+            done[normalize_url(url)] = (r, e)
+        fetched = [(url,) + done[normalize_url(url)] for url in urls]
+        return [(url, (dict(r[0], url=url), r[1]) if r else None, e) for url, r, e in fetched]
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+import re
+import zlib
+import array
+import random
+import sqlite3
+import datetime
+import threading
+from index import normalize_text
+
+__bracketed__ = re.compile(u'\\[[^\\]]*\\]|【[^】]*】')
+__code__ = re.compile(u'[a-z]*\\d[-a-z\\d]{5,}')  # project numbers, e.g. ZJDY201505120-01
+__non_word__ = re.compile(u'[\\W_]+', re.U)
+__day__ = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def normalize_title(title):
+    """
+    :return: title without what tells the same tender apart from one portal
+             to the other: the bracketed tags ([招标公告], 【资格预审】, the
+             prefixes of the yangzhou and nantong generators), the project
+             numbers each portal has its own of, the punctuation and spaces,
+             the full-width forms and the case
+    """
+    s = __bracketed__.sub(u'', normalize_text(title or u''))
+    return __non_word__.sub(u'', __code__.sub(u'', s))
+
+
+def shingles(s, n=3):
+    """
+    :return: the set of the n-grams of s (s itself if shorter)
+    """
+    if len(s) <= n:
+        return set([s]) if s else set()
+    return set([s[i:i + n] for i in xrange(len(s) - n + 1)])
+
+
+class MinHasher(object):
+    prime = (1 << 31) - 1  # so that the products stay machine integers
+
+    def __init__(self, num_perm=64, seed=1):
+        """
+        MinHash signatures of sets of strings: the minimum, over the set, of
+        num_perm random hash functions (a * crc32 + b) mod prime. Two
+        signatures agree at each position with the probability that is the
+        Jaccard similarity of their sets.
+        """
+        r = random.Random(seed)
+        self.num_perm = num_perm
+        self.perms = [(r.randint(1, self.prime - 1), r.randint(0, self.prime - 1)) for _ in xrange(num_perm)]
+
+    def signature(self, items):
+        """
+        :return: array of num_perm integers, None if items is empty
+        """
+        if not items:
+            return None
+        p = self.prime
+        hashes = [zlib.crc32(s.encode('utf-8')) & 0x7fffffff for s in items]
+        return array.array('i', [min([(a * x + b) % p for x in hashes]) for a, b in self.perms])
+
+    @staticmethod
+    def similarity(s1, s2):
+        """
+        :return: estimate of the Jaccard similarity of the sets of the
+                 signatures s1 and s2
+        """
+        return sum([1 for x, y in zip(s1, s2) if x == y]) / float(len(s1))
+
+
+class DuplicateDetector(object):
+    def __init__(self, path, threshold=0.75, window=30, num_perm=64, bands=16, timeout=30.0):
+        """
+        Links the records that are the same tender published by different
+        flows (e.g. by a city and again by the province) to one canonical
+        record, the first one seen: the records whose normalized titles (see
+        normalize_title()) have trigrams similar enough, and whose days are
+        close enough.
+
+        The MinHash signatures of the titles (see MinHasher) are kept in an
+        SQLite database; the candidates are found through a locality
+        sensitive hashing index in memory, the signatures being cut into
+        bands that similar titles likely share at least one of. Only the
+        records of the days within window of those of the last batch are
+        kept in memory, so that the memory used does not grow with the
+        history.
+
+        Several processes (e.g. those sharing a lease queue) may link records
+        in the same database: each batch is one write transaction, taken
+        before the records the others have added meanwhile are loaded.
+
+        :param path: path of the database file
+        :param threshold: estimated Jaccard similarity from which two titles
+                          are the same tender
+        :param window: maximum number of days between the two records
+        :param num_perm: size of the signatures
+        :param bands: number of bands the signatures are cut into; with
+                      num_perm / bands rows per band, titles of similarity s
+                      share a band with the probability
+                      1 - (1 - s ** rows) ** bands
+        :param timeout: seconds to wait for the other processes' batches
+        :return:
+        """
+        assert num_perm % bands == 0
+        self.path = path
+        self.threshold = threshold
+        self.window = window
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.rows = num_perm / bands
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS records ('
+            ' id INTEGER PRIMARY KEY,'
+            ' digest TEXT NOT NULL UNIQUE,'
+            ' day TEXT NOT NULL,'
+            ' name TEXT NOT NULL,'
+            ' title TEXT,'
+            ' signature BLOB,'
+            ' canonical INTEGER)')  # id of the canonical record, NULL for the canonical records
+        self.conn.execute('CREATE INDEX IF NOT EXISTS records_day ON records (day)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS records_canonical ON records (canonical)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('num_perm', ?)", (str(num_perm),))
+        stored = int(self.conn.execute("SELECT value FROM settings WHERE key = 'num_perm'").fetchone()[0])
+        if stored != num_perm:
+            raise ValueError('%s holds signatures of %d hashes, not %d' % (path, stored, num_perm))
+        self.buckets = {}    # hash of (band, values) -> ids of the records
+        self.records = {}    # id -> (day ordinal, name, signature, canonical id)
+        self.days = {}       # day ordinal -> ids of its records
+        self.loaded = set()  # day ordinals whose records are in memory
+        self.last_id = self.conn.execute('SELECT MAX(id) FROM records').fetchone()[0] or 0  # the latest seen
+
+    @staticmethod
+    def day_of(entry):
+        """
+        :return: 'YYYY-mm-dd' of the record, the day it was collected if
+                 that is unknown
+        """
+        digest, (t1, t2), data = entry
+        day = '%s-%s' % (t1, t2)
+        return day if __day__.match(day) else data[4][:10]
+
+    def band_keys(self, signature):
+        r = self.rows
+        return [hash((i, tuple(signature[i * r:(i + 1) * r]))) for i in xrange(self.bands)]
+
+    def remember(self, id, ordinal, name, signature, canonical):
+        self.records[id] = (ordinal, name, signature, canonical)
+        self.days.setdefault(ordinal, []).append(id)
+        for key in self.band_keys(signature):
+            self.buckets.setdefault(key, []).append(id)
+
+    def forget_days(self, keep):
+        """
+        Drops the records of the days loaded that are not in keep from
+        memory.
+        """
+        for ordinal in self.loaded - keep:
+            for id in self.days.pop(ordinal, ()):
+                signature = self.records.pop(id)[2]
+                for key in self.band_keys(signature):
+                    ids = self.buckets[key]
+                    ids.remove(id)
+                    if not ids:
+                        del self.buckets[key]
+        self.loaded &= keep
+
+    def load_added(self):
+        """
+        Loads the records the other processes have added to the days in
+        memory since they were loaded.
+        """
+        for id, day, name, blob, canonical in self.conn.execute(
+                'SELECT id, day, name, signature, canonical FROM records'
+                ' WHERE id > ? AND signature IS NOT NULL ORDER BY id', (self.last_id,)):
+            o = datetime.datetime.strptime(day, '%Y-%m-%d').toordinal()
+            if id not in self.records and o in self.loaded:
+                self.remember(id, o, intern(name.encode('utf-8')), array.array('i', str(blob)), canonical)
+        self.last_id = self.conn.execute('SELECT MAX(id) FROM records').fetchone()[0] or 0
+
+    def load_days(self, ordinal):
+        """
+        Makes sure the records of the days within window of ordinal are in
+        memory.
+        """
+        missing = [o for o in xrange(ordinal - self.window, ordinal + self.window + 1) if o not in self.loaded]
+        if not missing:
+            return
+        first = datetime.date.fromordinal(missing[0]).isoformat()
+        last = datetime.date.fromordinal(missing[-1]).isoformat()
+        for id, day, name, blob, canonical in self.conn.execute(
+                'SELECT id, day, name, signature, canonical FROM records'
+                ' WHERE day BETWEEN ? AND ? AND signature IS NOT NULL', (first, last)):
+            o = datetime.datetime.strptime(day, '%Y-%m-%d').toordinal()
+            if id not in self.records and o not in self.loaded:
+                self.remember(id, o, intern(name.encode('utf-8')), array.array('i', str(blob)), canonical)
+        self.loaded.update(missing)
+
+    def find(self, ordinal, name, signature):
+        """
+        :return: the id of the canonical record of the record most similar
+                 to the one given, among those of the other flows, None if
+                 none is similar enough
+        """
+        candidates = set()
+        for key in self.band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        best, best_similarity = None, self.threshold
+        for id in candidates:
+            o, n, s, canonical = self.records[id]
+            if n == name or abs(o - ordinal) > self.window:
+                continue
+            similarity = self.hasher.similarity(signature, s)
+            if similarity >= best_similarity:
+                best, best_similarity = canonical or id, similarity
+        return best
+
+    def link_batch(self, entries):
+        """
+        Adds the records, linking those that are duplicates of records seen
+        before to their canonical record.
+
+        :param entries: list of (digest, day, data) tuples, as handed over to
+                        the record stores
+        :return: dict digest -> digest of the canonical record, for the
+                 entries that are duplicates
+        """
+        duplicates = {}
+        keep = set()  # the day ordinals within window of those of the batch
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')  # one transaction for the whole batch
+            try:
+                self.load_added()
+                for entry in entries:
+                    digest, day, data = entry
+                    name, t, addr, title, tx = data
+                    day = self.day_of(entry)
+                    try:
+                        ordinal = datetime.datetime.strptime(day, '%Y-%m-%d').toordinal()
+                    except ValueError:
+                        continue
+                    keep.update(xrange(ordinal - self.window, ordinal + self.window + 1))
+                    signature = self.hasher.signature(shingles(normalize_title(title)))
+                    canonical = None
+                    if signature is not None:
+                        self.load_days(ordinal)
+                        canonical = self.find(ordinal, intern(name.encode('utf-8')), signature)
+                    c = self.conn.execute(
+                        'INSERT OR IGNORE INTO records (digest, day, name, title, signature, canonical)'
+                        ' VALUES (?, ?, ?, ?, ?, ?)',
+                        (digest, day, name, title,
+                         buffer(signature.tostring()) if signature is not None else None, canonical))
+                    if c.rowcount != 1:
+                        continue
+                    if signature is not None:
+                        self.remember(c.lastrowid, ordinal, intern(name.encode('utf-8')), signature, canonical)
+                    if canonical is not None:
+                        duplicates[digest] = self.conn.execute(
+                            'SELECT digest FROM records WHERE id = ?', (canonical,)).fetchone()[0]
+                self.last_id = max(self.last_id, self.conn.execute('SELECT MAX(id) FROM records').fetchone()[0] or 0)
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                self.buckets, self.records, self.days, self.loaded = {}, {}, {}, set()  # reloaded as needed
+                raise
+            self.conn.execute('COMMIT')
+            if keep:
+                self.forget_days(keep)
+        return duplicates
+
+    def add_batch(self, entries):
+        """
+        link_batch(), as an observer of the record store.
+
+        :return: the number of duplicates found
+        """
+        return len(self.link_batch(entries))
+
+    def groups(self, limit=50):
+        """
+        :return: list of (canonical, duplicates) of the latest groups of
+                 duplicates, each record being a tuple (digest, day, name,
+                 title)
+        """
+        columns = 'digest, day, name, title'
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id, %s FROM records WHERE id IN (SELECT DISTINCT canonical FROM records'
+                ' WHERE canonical IS NOT NULL) ORDER BY day DESC, id DESC LIMIT ?' % columns, (limit,)).fetchall()
+            return [(tuple(r[1:]), self.conn.execute(
+                'SELECT %s FROM records WHERE canonical = ? ORDER BY id' % columns, (r[0],)).fetchall())
+                for r in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import gzip
+try:
+    import pyarrow  # optional; only needed for the Parquet and Arrow exports
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNS = ['digest', 'name', 'day', 't', 'addr', 'title', 'collected']
+
+
+def rows_of(entries):
+    """
+    :param entries: list of (digest, day, data) tuples, as walked from the
+                    record stores
+    :return: the columns of the entries, as a dict column -> list of values
+    """
+    columns = dict((c, []) for c in COLUMNS)
+    for digest, (t1, t2), data in entries:
+        name, t, addr, title, tx = data
+        for c, v in zip(COLUMNS, (digest, name, '%s-%s' % (t1, t2), t, addr, title, tx)):
+            columns[c].append(v)
+    return columns
+
+
+class CsvExport(object):
+    extensions = ['.csv.gz']
+
+    def __init__(self, path):
+        """
+        Gzipped CSV in UTF-8, one line per record and the column names first;
+        what is left when pyarrow is not installed.
+        """
+        self.h = gzip.open(path, 'wb')
+        self.writer = csv.writer(self.h)
+        self.writer.writerow(COLUMNS)
+
+    def write_batch(self, entries):
+        columns = rows_of(entries)
+        self.writer.writerows(zip(*[[(v or u'').encode('utf-8') for v in columns[c]] for c in COLUMNS]))
+
+    def close(self):
+        self.h.close()
+
+
+def arrow_schema():
+    """
+    :return: the schema of the Arrow and Parquet exports, all strings, the
+             names of the cities (repeated over all their records) dictionary
+             encoded
+    """
+    return pyarrow.schema([
+        (c, pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if c == 'name' else pyarrow.string())
+        for c in COLUMNS])
+
+
+def arrow_batch(entries, schema):
+    columns = rows_of(entries)
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(columns[c], type=pyarrow.string()).dictionary_encode() if c == 'name'
+         else pyarrow.array(columns[c], type=pyarrow.string()) for c in COLUMNS], schema=schema)
+
+
+class ArrowExport(object):
+    extensions = ['.arrow', '.feather']
+
+    def __init__(self, path):
+        """
+        Arrow IPC file, one record batch per batch of entries.
+        """
+        self.schema = arrow_schema()
+        self.sink = pyarrow.OSFile(path, 'wb')
+        self.writer = pyarrow.RecordBatchFileWriter(self.sink, self.schema)
+
+    def write_batch(self, entries):
+        self.writer.write_batch(arrow_batch(entries, self.schema))
+
+    def close(self):
+        self.writer.close()
+        self.sink.close()
+
+
+class ParquetExport(object):
+    extensions = ['.parquet']
+
+    def __init__(self, path):
+        """
+        Parquet file compressed with zstd, one row group per batch of
+        entries.
+        """
+        self.schema = arrow_schema()
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+
+    def write_batch(self, entries):
+        self.writer.write_table(pyarrow.Table.from_batches([arrow_batch(entries, self.schema)]))
+
+    def close(self):
+        self.writer.close()
+
+
+EXPORT_FORMATS = {
+    'parquet': ParquetExport,
+    'arrow': ArrowExport,
+    'csv': CsvExport,
+}
+
+
+def format_of(path):
+    """
+    :return: the name of the export format of the extension of path, None
+             if there is none
+    """
+    for name, cls in EXPORT_FORMATS.iteritems():
+        if [e for e in cls.extensions if path.endswith(e)]:
+            return name
+    return None
+
+
+def open_export(path, name=None):
+    """
+    :param name: name of the format, that of the extension of path if None;
+                 parquet when pyarrow is installed, csv otherwise if neither
+    :return: the export object, with write_batch(entries) and close()
+    """
+    name = name or format_of(path) or ('parquet' if pyarrow is not None else 'csv')
+    if name != 'csv' and pyarrow is None:
+        raise ValueError('pyarrow is needed for the %s exports' % name)
+    return EXPORT_FORMATS[name](path)
+
+
+def export_records(entries, export, batch_size=10000):
+    """
+    Writes the entries to the export in batches of batch_size.
+
+    :return: the number of entries written
+    """
+    written = 0
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            export.write_batch(batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        export.write_batch(batch)
+        written += len(batch)
+    return written
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock shared by all the processes (e.g. those of a
+    lease queue working in the same prefix) on the file at path, created if
+    need be, waiting for it as long as it takes: flock() on POSIX, locking()
+    of its first byte on Windows.
+    """
+    with open(path, 'a+') as h:
+        if fcntl:
+            fcntl.flock(h.fileno(), fcntl.LOCK_EX)
+        else:
+            h.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(h.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:  # LK_LOCK gives up after 10 seconds
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(h.fileno(), fcntl.LOCK_UN)
+            else:
+                h.seek(0)
+                msvcrt.locking(h.fileno(), msvcrt.LK_UNLCK, 1)
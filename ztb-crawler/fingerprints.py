@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import hashlib
+import threading
+from filelock import file_lock
+
+__comment__ = re.compile(r'<!--.*?-->', re.S)
+__space__ = re.compile(r'\s+')
+
+
+def fingerprint(html):
+    """
+    :param html: unicode markup
+    :return: hex digest of html with comments and whitespace removed, so that
+             reindenting or commenting does not count as a change
+    """
+    s = __space__.sub(u'', __comment__.sub(u'', html))
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+class ListingFingerprints(object):
+    def __init__(self, path=None):
+        """
+        What the listings of the flows looked like the last time they were
+        processed, per page: the fingerprint of the listing container(s)
+        and those of its rows, kept in a JSON file across runs.
+
+        Entries are staged by put() and only saved by save(), typically once
+        the records of the pages have been committed. Processes sharing the
+        file (e.g. those of a lease queue) each save the entries they have
+        put into what the others have saved.
+
+        :param path: the JSON file, if any
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self.read() if path else {}  # key -> (listing fingerprint, frozenset of row fingerprints)
+        self.staged = set()  # keys put since the last save()
+
+    def read(self):
+        """
+        :return: the entries saved in the file, none if it is missing or
+                 damaged
+        """
+        entries = {}
+        if os.access(self.path, os.R_OK):
+            try:
+                with open(self.path, 'r') as h:
+                    for key, e in json.load(h).iteritems():
+                        entries[key] = (e['listing'], frozenset(e['rows']))
+            except (ValueError, KeyError, TypeError):
+                return {}
+        return entries
+
+    @staticmethod
+    def key(url, page):
+        return '%s#%d' % (url, page)
+
+    def get(self, key):
+        """
+        :return: tuple (listing fingerprint, frozenset of row fingerprints),
+                 (None, frozenset()) if unknown
+        """
+        with self.lock:
+            return self.entries.get(key, (None, frozenset()))
+
+    def put(self, key, listing, rows):
+        with self.lock:
+            self.entries[key] = (listing, frozenset(rows))
+            self.staged.add(key)
+
+    def save(self):
+        if not self.path:
+            return
+        with file_lock(self.path + '.lock'):
+            entries = self.read()
+            with self.lock:
+                for key in self.staged:
+                    entries[key] = self.entries[key]
+                self.entries, self.staged = entries, set()
+            state = dict((k, {'listing': listing, 'rows': sorted(rows)})
+                         for k, (listing, rows) in entries.iteritems())
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())  # other processes may save it too
+            with open(tmp, 'w') as h:
+                json.dump(state, h, indent=1, sort_keys=True, separators=(',', ': '))
+            if os.name == 'nt' and os.access(self.path, os.F_OK):
+                os.remove(self.path)  # rename() does not replace files on Windows
+            os.rename(tmp, self.path)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import threading
+
+
+class HTTPResponseCache(object):
+    def __init__(self, directory):
+        """
+        On-disk cache of what we know about the pages fetched before: their
+        validators (ETag, Last-Modified) and the digest of their bodies.
+
+        Entries are first staged in memory when a page is fetched and only
+        written to disk by commit() once the page has been fully processed,
+        so that a run that fails half way does not make the next run believe
+        the page has been seen.
+
+        :param directory: where the cache entries are kept, one file per url
+        :return:
+        """
+        self.directory = directory
+        self.pending = {}
+        self.lock = threading.Lock()
+        if not os.access(directory, os.R_OK):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+    def entry_path(self, url):
+        return os.path.join(self.directory, hashlib.md5(url).hexdigest() + '.json')
+
+    def lookup(self, url):
+        try:
+            with open(self.entry_path(url), 'r') as h:
+                return json.load(h)
+        except (IOError, ValueError):
+            return None
+
+    def conditional_headers(self, url):
+        entry = self.lookup(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha1(content).hexdigest()
+
+    def is_unchanged(self, url, content):
+        """
+        Body-hash fallback for the sites that send no validators (or that
+        send them but ignore the conditional request headers).
+        """
+        entry = self.lookup(url)
+        return bool(entry) and entry.get('digest') == self.digest(content)
+
+    def stage(self, url, headers, content):
+        entry = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'digest': self.digest(content),
+        }
+        with self.lock:
+            self.pending[url] = entry
+
+    def commit(self, url):
+        with self.lock:
+            entry = self.pending.pop(url, None)
+        if entry is None:
+            return
+        with open(self.entry_path(url), 'w') as h:
+            json.dump(entry, h)
+
+    def discard(self, url):
+        with self.lock:
+            self.pending.pop(url, None)
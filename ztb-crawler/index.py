@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import re
+import sqlite3
+import threading
+import unicodedata
+
+__cjk_run__ = re.compile(u'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+__word__ = re.compile(u'[a-z0-9]+')
+
+
+def normalize_text(s):
+    """
+    :return: s with the full-width forms folded (ＡＢＣ１２３ -> abc123) and
+             in lower case, which is what is searched
+    """
+    return unicodedata.normalize('NFKC', s).lower()
+
+
+def tokenize(s, query=False):
+    """
+    Splits normalized text into the terms of the index: the bigrams of each
+    run of CJK characters (a run of one character being a term by itself),
+    and the latin words and numbers.
+
+    :param query: whether s is a keyword searched for; the single CJK
+                  characters are then left out, as they are only indexed
+                  when standing alone
+    :return: set of terms
+    """
+    terms = set()
+    for m in __cjk_run__.finditer(s):
+        run = m.group(0)
+        if len(run) == 1:
+            if not query:
+                terms.add(run)
+            continue
+        for i in xrange(len(run) - 1):
+            terms.add(run[i:i + 2])
+    for m in __word__.finditer(s):
+        terms.add(m.group(0))
+    return terms
+
+
+class RecordIndex(object):
+    def __init__(self, path):
+        """
+        Inverted index of the records in an SQLite database: the postings of
+        the terms of the titles (see tokenize()), with the document frequency
+        of each term, and the records themselves indexed by city (the flow
+        name) and day, so that keyword, city and date range queries are
+        answered without reading the record store.
+
+        :param path: path of the database file
+        :return:
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS docs ('
+            ' id INTEGER PRIMARY KEY,'
+            ' digest TEXT NOT NULL UNIQUE,'
+            ' name TEXT NOT NULL,'
+            ' day TEXT,'
+            ' t TEXT,'
+            ' addr TEXT NOT NULL,'
+            ' title TEXT,'
+            ' collected TEXT,'
+            ' normalized TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS docs_name_day ON docs (name, day)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS docs_day ON docs (day)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS postings ('
+            ' term TEXT NOT NULL,'
+            ' doc INTEGER NOT NULL,'
+            ' PRIMARY KEY (term, doc)) WITHOUT ROWID')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS terms ('
+            ' term TEXT PRIMARY KEY,'
+            ' df INTEGER NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cities (name TEXT PRIMARY KEY)')
+        self.conn.commit()
+
+    @staticmethod
+    def day_of(entry):
+        """
+        :return: 'YYYY-mm-dd', None if the day of the record is unknown
+        """
+        digest, (t1, t2), data = entry
+        day = '%s-%s' % (t1, t2)
+        return day if re.match(r'^\d{4}-\d{2}-\d{2}$', day) else None
+
+    def add_batch(self, entries):
+        """
+        :param entries: list of (digest, day, data) tuples, as handed over to
+                        the record stores
+        :return: the number of records indexed, those already in the index
+                 being left alone
+        """
+        added = 0
+        with self.lock:
+            with self.conn:  # one transaction for the whole batch
+                for entry in entries:
+                    digest, day, data = entry
+                    name, t, addr, title, tx = data
+                    normalized = normalize_text(title or u'')
+                    c = self.conn.execute(
+                        'INSERT OR IGNORE INTO docs (digest, name, day, t, addr, title, collected, normalized)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (digest, name, self.day_of(entry), t, addr, title, tx, normalized))
+                    if c.rowcount != 1:
+                        continue
+                    doc = c.lastrowid
+                    self.conn.execute('INSERT OR IGNORE INTO cities (name) VALUES (?)', (name,))
+                    terms = sorted(tokenize(normalized))
+                    self.conn.executemany('INSERT INTO postings (term, doc) VALUES (?, ?)',
+                                          [(term, doc) for term in terms])
+                    self.conn.executemany('INSERT OR IGNORE INTO terms (term, df) VALUES (?, 0)',
+                                          [(term,) for term in terms])
+                    self.conn.executemany('UPDATE terms SET df = df + 1 WHERE term = ?',
+                                          [(term,) for term in terms])
+                    added += 1
+        return added
+
+    all_records = True  # duplicates included (see recordstore.ObservedRecordStore)
+
+    # the records are scanned by day rather than from the postings of the
+    # rarest term when it is in more than one record out of scan_ratio
+    scan_ratio = 50
+
+    def max_doc_id(self):
+        with self.lock:
+            return self.conn.execute('SELECT MAX(id) FROM docs').fetchone()[0] or 0
+
+    def query(self, keywords=(), city=None, since=None, until=None, limit=50):
+        """
+        :param keywords: what the titles shall all contain: CJK keywords match
+                         anywhere, latin words and numbers match whole words
+        :param city: part of the name of the city (of the flow) of the records
+        :param since: first day, 'YYYY-mm-dd'
+        :param until: last day, 'YYYY-mm-dd'
+        :return: list of (digest, data) of the records found, latest first
+        """
+        keywords = [normalize_text(k) for k in keywords if k.strip()]
+        terms = set()
+        for k in keywords:
+            terms |= tokenize(k, query=True)
+        with self.lock:
+            df = {}
+            for term in terms:
+                r = self.conn.execute('SELECT df FROM terms WHERE term = ?', (term,)).fetchone()
+                df[term] = r[0] if r else 0
+        if any(n == 0 for n in df.itervalues()):
+            return []
+        terms = sorted(terms, key=lambda term: df[term])  # the rarest first
+        sql = ['SELECT d.digest, d.name, d.t, d.addr, d.title, d.collected FROM']
+        where, params = [], []
+        if terms and df[terms[0]] * self.scan_ratio < self.max_doc_id():
+            # few enough records to sort: from the postings of the rarest term
+            sql.append('postings p JOIN docs d ON d.id = p.doc')
+            where.append('p.term = ?')
+            params.append(terms[0])
+            terms = terms[1:]
+        else:
+            # too many: along the records by day, until enough are found
+            sql.append('docs d')
+        for term in terms:
+            where.append('EXISTS (SELECT 1 FROM postings WHERE term = ? AND doc = d.id)')
+            params.append(term)
+        for k in keywords:
+            where.append('instr(d.normalized, ?) > 0')  # the bigrams of k may be anywhere in the title
+            params.append(k)
+        if city:  # the flows it is part of, e.g. u'嘉兴市桐乡市' for u'桐乡'; as a subquery, whatever their number
+            where.append('d.name IN (SELECT name FROM cities WHERE instr(name, ?) > 0)')
+            params.append(city)
+        if since:
+            where.append('d.day >= ?')
+            params.append(since)
+        if until:
+            where.append('d.day <= ?')
+            params.append(until)
+        if where:
+            sql.append('WHERE ' + ' AND '.join(where))
+        sql.append('ORDER BY d.day DESC, d.id DESC LIMIT ?')
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(' '.join(sql), params).fetchall()
+        return [(r[0], list(r[1:])) for r in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
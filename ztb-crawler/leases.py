@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import time
+import sqlite3
+import threading
+
+
+class LeaseQueue(object):
+    def __init__(self, path, timeout=30.0):
+        """
+        Work queue of flows shared by crawler processes, possibly on several
+        hosts (the database being on a shared disk), in SQLite.
+
+        A process leases the flows that are due for a while, renews the
+        leases while running them, and completes them once their records
+        have been committed, which schedules their next poll. A lease that
+        expires (its holder having crashed or hung) makes the flow available
+        to the others again; as the record stores tell new records by their
+        digest, running a flow again never duplicates records.
+
+        :param path: path of the database file
+        :param timeout: seconds to wait for the other processes to release
+                        the database
+        :return:
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS flows ('
+            ' url TEXT PRIMARY KEY,'
+            ' due REAL NOT NULL,'
+            ' interval REAL,'
+            ' failures INTEGER NOT NULL DEFAULT 0,'
+            ' owner TEXT,'
+            ' lease_until REAL,'
+            ' leases INTEGER NOT NULL DEFAULT 0,'
+            ' last_result TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS flows_due ON flows (due)')
+        self.restricted = False
+
+    def transaction(self, work):
+        """
+        Runs statements in one write transaction, taken before anything is
+        read so that two processes never lease the same flow.
+
+        :param work: function(execute) running the statements, execute being
+                     that of the connection
+        :return: what work returns
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                r = work(self.conn.execute)
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return r
+
+    def sync(self, urls, interval, now=None):
+        """
+        Makes the queue hold exactly the flows at urls: the new ones are due
+        now, the ones gone are removed, the others are left alone.
+
+        :return: tuple (number of flows added, number of flows removed)
+        """
+        now = now if now is not None else time.time()
+        urls = set(urls)
+
+        def work(execute):
+            known = set([r[0] for r in execute('SELECT url FROM flows')])
+            for url in sorted(urls - known):
+                execute('INSERT INTO flows (url, due, interval) VALUES (?, ?, ?)', (url, now, interval))
+            for url in sorted(known - urls):
+                execute('DELETE FROM flows WHERE url = ?', (url,))
+            return len(urls - known), len(known - urls)
+        return self.transaction(work)
+
+    def restrict(self, urls):
+        """
+        Makes acquire() lease only the flows at urls, e.g. those this process
+        knows of, its catalogue being older or newer than the queue; in a
+        temporary table, whatever their number.
+        """
+        with self.lock:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS known (url TEXT PRIMARY KEY)')
+            self.conn.execute('BEGIN')
+            self.conn.execute('DELETE FROM temp.known')
+            self.conn.executemany('INSERT OR IGNORE INTO temp.known (url) VALUES (?)', [(url,) for url in urls])
+            self.conn.execute('COMMIT')
+            self.restricted = True
+
+    def acquire(self, owner, lease, limit=1, now=None):
+        """
+        Leases up to limit of the flows due (most overdue first), including
+        those whose lease has expired; only those given to restrict(), if it
+        has been called.
+
+        :param owner: what identifies the process, e.g. host:pid
+        :param lease: duration of the leases, in seconds
+        :return: list of (url, interval, failures) of the flows leased
+        """
+        now = now if now is not None else time.time()
+
+        def work(execute):
+            rows = execute('SELECT url, interval, failures FROM flows'
+                           ' WHERE due <= ? AND (owner IS NULL OR lease_until < ?)%s'
+                           ' ORDER BY due LIMIT ?' % (
+                               ' AND url IN (SELECT url FROM temp.known)' if self.restricted else ''),
+                           (now, now, limit)).fetchall()
+            for url, interval, failures in rows:
+                execute('UPDATE flows SET owner = ?, lease_until = ?, leases = leases + 1 WHERE url = ?',
+                        (owner, now + lease, url))
+            return rows
+        return self.transaction(work)
+
+    def renew(self, urls, owner, lease, now=None):
+        """
+        Extends the leases owner holds on the flows at urls.
+
+        :return: the urls whose lease has been lost (expired and taken over)
+        """
+        now = now if now is not None else time.time()
+
+        def work(execute):
+            lost = []
+            for url in urls:
+                c = execute('UPDATE flows SET lease_until = ? WHERE url = ? AND owner = ?',
+                            (now + lease, url, owner))
+                if c.rowcount != 1:
+                    lost.append(url)
+            return lost
+        return self.transaction(work)
+
+    def complete(self, url, owner, interval, failures, due, result):
+        """
+        Releases the lease on a flow that has been run, scheduling its next
+        poll at due.
+
+        :param result: what to tell about the run, e.g. 'ok' or the error
+        :return: whether owner still held the lease (if not, the flow has
+                 been leased by another process meanwhile, which schedules
+                 it)
+        """
+        def work(execute):
+            c = execute('UPDATE flows SET owner = NULL, lease_until = NULL, due = ?, interval = ?, failures = ?,'
+                        ' last_result = ? WHERE url = ? AND owner = ?',
+                        (due, interval, failures, result, url, owner))
+            return c.rowcount == 1
+        return self.transaction(work)
+
+    def release(self, urls, owner):
+        """
+        Gives up the leases owner holds on the flows at urls without running
+        them: they stay due, for the other processes to lease right away.
+        """
+        def work(execute):
+            for url in urls:
+                execute('UPDATE flows SET owner = NULL, lease_until = NULL WHERE url = ? AND owner = ?', (url, owner))
+        return self.transaction(work)
+
+    def next_due(self):
+        """
+        :return: the earliest time a flow is due or its lease expires, None
+                 if there are no flows
+        """
+        with self.lock:
+            r = self.conn.execute('SELECT MIN(CASE WHEN owner IS NULL THEN due ELSE MAX(due, lease_until) END)'
+                                  ' FROM flows').fetchone()
+        return r[0]
+
+    def status(self):
+        """
+        :return: list of (url, due, interval, failures, owner, lease_until,
+                 leases, last_result) of all the flows
+        """
+        with self.lock:
+            return self.conn.execute('SELECT url, due, interval, failures, owner, lease_until, leases, last_result'
+                                     ' FROM flows ORDER BY due').fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
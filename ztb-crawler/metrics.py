@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import json
+import codecs
+
+
+def write_file_replacing(path, text):
+    """
+    Writes text to path through a temporary file, so that readers (e.g. the
+    textfile collector of the Prometheus node exporter) never see it half
+    written.
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())  # other processes may write it too
+    with codecs.open(tmp, 'w', 'utf-8') as h:
+        h.write(text)
+    if os.name == 'nt' and os.access(path, os.F_OK):
+        os.remove(path)  # rename() does not replace files on Windows
+    os.rename(tmp, path)
+
+
+def write_json_summary(summary, path):
+    """
+    :param summary: the run summary, as built by crawl.run_summary()
+    """
+    write_file_replacing(path, json.dumps(summary, ensure_ascii=False, indent=1, sort_keys=True,
+                                          separators=(',', ': ')) + '\n')
+
+
+def escape_label_value(v):
+    return unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    return ','.join(['%s="%s"' % (k, escape_label_value(v)) for k, v in labels])
+
+
+def format_prometheus(summary):
+    """
+    :return: the summary in the Prometheus text exposition format
+    """
+    metrics = []  # (name, type, help, [(labels, value)])
+
+    def add(name, kind, text, samples):
+        metrics.append((name, kind, text, samples))
+
+    flows = summary['flows']
+
+    def per_flow(key):
+        return [([('flow', f['name']), ('url', f['url'])], key(f)) for f in flows]
+
+    add('ztb_run_timestamp_seconds', 'gauge', 'Time the last run finished.',
+        [([], summary['finished'])])
+    add('ztb_run_duration_seconds', 'gauge', 'Wall-clock duration of the last run.',
+        [([], summary['duration'])])
+    add('ztb_flow_success', 'gauge', 'Whether the flow succeeded in the last run.',
+        per_flow(lambda f: 1 if f['succeeded'] else 0))
+    add('ztb_flow_stage_seconds', 'gauge', 'Wall-clock time spent by the flow in each stage.',
+        [([('flow', f['name']), ('url', f['url']), ('stage', stage)], seconds)
+         for f in flows for stage, seconds in sorted(f['timings'].iteritems())])
+    add('ztb_flow_stage_cpu_seconds', 'gauge', 'Process CPU time spent while the flow was in each stage.',
+        [([('flow', f['name']), ('url', f['url']), ('stage', stage)], seconds)
+         for f in flows for stage, seconds in sorted(f['cpu_timings'].iteritems())])
+    add('ztb_flow_bytes_fetched', 'gauge', 'Bytes fetched by the flow.',
+        per_flow(lambda f: f['bytes_fetched']))
+    add('ztb_flow_records_seen', 'gauge', 'Records extracted by the flow.',
+        per_flow(lambda f: f['records']))
+    add('ztb_flow_records_new', 'gauge', 'Records extracted by the flow that were new.',
+        per_flow(lambda f: f['new_records']))
+    counters = sorted(set([k for f in flows for k in f['counters']]))
+    add('ztb_flow_events', 'gauge', 'Events counted during the flow, e.g. retries.',
+        [([('flow', f['name']), ('url', f['url']), ('event', k)], f['counters'].get(k, 0))
+         for f in flows for k in counters])
+    add('ztb_flow_error', 'gauge', 'Class of the exception that made the flow fail.',
+        [([('flow', f['name']), ('url', f['url']), ('exception', f['error']['class'])], 1)
+         for f in flows if f['error']])
+    lines = []
+    for name, kind, text, samples in metrics:
+        lines.append('# HELP %s %s' % (name, text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            lines.append('%s{%s} %s' % (name, format_labels(labels), repr(float(value)))
+                         if labels else '%s %s' % (name, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_textfile(summary, path):
+    write_file_replacing(path, format_prometheus(summary))
+
+
+class LatestFlowMetrics(object):
+    def __init__(self, path=None, pattern=None):
+        """
+        The metrics of each flow as of its last run, so that the textfile of
+        a run of only some of the flows (as in daemon mode) still has the
+        gauges of the others, instead of them disappearing until their next
+        run.
+
+        Processes sharing the textfile (as the workers of a lease queue) each
+        keep theirs in a JSON file of their own, and merge those of all of
+        them, the latest run of each flow winning.
+
+        :param path: the JSON file of this process, if any
+        :param pattern: glob pattern of the JSON files of all the processes
+        """
+        self.path = path
+        self.pattern = pattern
+        self.flows = {}  # url -> metrics of the flow in the summary of its last run, with its 'finished' time
+
+    def update(self, summary):
+        """
+        Takes the metrics of the flows of the run.
+
+        :return: summary, with the metrics of all the flows known
+        """
+        for f in summary['flows']:
+            self.flows[f['url']] = dict(f, finished=summary['finished'])
+        if self.path:
+            write_file_replacing(self.path, json.dumps(self.flows, ensure_ascii=False))
+        flows = dict(self.flows)
+        for path in sorted(glob.glob(self.pattern)) if self.pattern else []:
+            if path == self.path:
+                continue
+            try:
+                with codecs.open(path, 'r', 'utf-8') as h:
+                    others = json.load(h)
+            except (IOError, ValueError):  # e.g. removed meanwhile
+                continue
+            for url, f in others.iteritems():
+                if url not in flows or f['finished'] > flows[url]['finished']:
+                    flows[url] = f
+        return dict(summary, flows=[f for url, f in sorted(flows.iteritems())])
+
+    def remove(self, url):
+        self.flows.pop(url, None)
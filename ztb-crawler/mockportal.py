@@ -0,0 +1,358 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Stand-in for the portals, for testing the crawler at scale without
+# touching the network:
+#   mockportal.py serve [--port 8770] [--latency MS] [--error-rate R] ...
+#   mockportal.py flows --count N > mock-flows.json
+# The flows generated are copies of those of flows.json, at virtual hosts
+# named <sample page>-<n>.mock, e.g. http://wu-xi-12.mock/wxzb/ZtbInfo/MoreZBGG.aspx.
+# The crawler reaches them through the server as its HTTP proxy, so that no
+# name has to resolve:
+#   http_proxy=http://127.0.0.1:8770 crawl.py PREFIX --catalogue mock-flows.json
+# Each virtual host serves the sample page of its name, with the variations
+# asked for: more pages, rows changing over time, latency, errors and
+# oversized bodies.
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse, urlunparse, parse_qs
+
+MOCK_DOMAIN = 'mock'
+__mock_host__ = re.compile(r'^(?P<template>[-a-z]+)-(?P<n>\d+)\.%s(:\d+)?$' % re.escape(MOCK_DOMAIN))
+__href__ = re.compile(r'''(href\s*=\s*["'])([^"'#]+)''', re.I)
+__head_end__ = re.compile(r'</head\s*>', re.I)
+
+
+def load_templates(catalogue):
+    """
+    :param catalogue: the flows.json the flows are copied from
+    :return: tuple (entries, templates): the entries of the catalogue with
+             a location in sample-data/, and dict name of the sample page ->
+             (its content, the pager of its flow)
+    """
+    base = os.path.dirname(os.path.abspath(catalogue))
+    with open(catalogue, 'rb') as h:
+        flows = json.loads(h.read().decode('utf-8'))['flows']
+    entries, templates = [], {}
+    for entry in flows:
+        location = entry.get('location')
+        if not location:
+            continue
+        path = os.path.join(base, location[2:]) if location.startswith('./') else location
+        with open(path, 'rb') as h:
+            templates[os.path.basename(location)] = (h.read(), entry.get('pager'))
+        entries.append(entry)
+    return entries, templates
+
+
+def mock_entries(entries, count):
+    """
+    :return: count catalogue entries, copies of entries at virtual hosts of
+             the mock portal, without location
+    """
+    mocks = []
+    for n in xrange(count):
+        entry = dict(entries[n % len(entries)])
+        template = os.path.basename(entry.pop('location'))
+        scheme, netloc, path, params, query, fragment = urlparse(entry['url'])
+        entry['url'] = urlunparse(('http', '%s-%d.%s' % (template, n, MOCK_DOMAIN), path, params, query, ''))
+        entry['name'] = u'%s-%d' % (entry['name'], n)
+        mocks.append(entry)
+    return mocks
+
+
+class MockPortal(object):
+    def __init__(self, templates, pages=1, new_rows=0, churn=60.0, latency=0.0, error_rate=0.0, reset_rate=0.0,
+                 down_rate=0.0, oversize_rate=0.0, oversize_bytes=16 * 1024 * 1024, seed=None):
+        """
+        What the virtual hosts serve.
+
+        :param templates: dict name -> (content, pager) of the sample pages,
+                          as returned by load_templates()
+        :param pages: number of pages of each listing; the pages after the
+                      first one are the first one with other links
+        :param new_rows: number of rows at the top of the listings whose
+                         links change every churn seconds, i.e. which are
+                         new records
+        :param latency: mean of the (exponentially distributed) time taken
+                        to respond, in seconds
+        :param error_rate: fraction of the requests failing with a 500 or 503
+        :param reset_rate: fraction of the requests whose connection is
+                           closed without a response
+        :param down_rate: fraction of the virtual hosts whose requests all
+                          get their connection closed
+        :param oversize_rate: fraction of the responses padded before the
+                              listing up to oversize_bytes
+        :param seed: of the random decisions, for repeatable runs
+        """
+        self.templates = templates
+        self.pages = pages
+        self.new_rows = new_rows
+        self.churn = churn
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.down_rate = down_rate
+        self.oversize_rate = oversize_rate
+        self.oversize_bytes = oversize_bytes
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def count(self, event, n=1):
+        with self.lock:
+            self.counters[event] = self.counters.get(event, 0) + n
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+    def is_down(self, host):
+        return (zlib.crc32(host) & 0xffff) < self.down_rate * 0x10000
+
+    @staticmethod
+    def tag_links(content, tag, limit=None):
+        """
+        :return: content with tag added to the query string of its links
+                 (the first limit ones, if any), so that they are other
+                 records
+        """
+        left = [limit]
+
+        def tagged(m):
+            href = m.group(2)
+            if href.lower().startswith('javascript:') or left[0] == 0:
+                return m.group(0)
+            if left[0] is not None:
+                left[0] -= 1
+            return m.group(1) + href + ('&' if '?' in href else '?') + 'mock=' + tag
+        return __href__.sub(tagged, content)
+
+    def page_of(self, pager, query, form):
+        if pager and pager['type'] == 'aspnet-postback' and form.get('__EVENTTARGET') == pager['event_target']:
+            return int(form.get('__EVENTARGUMENT', '1') or 1)
+        if pager and pager['type'] == 'query-string' and pager['parameter'] in query:
+            return int(query[pager['parameter']][0])
+        return 1
+
+    def with_pager_links(self, content, pager, page):
+        """
+        :return: content linking to the next page unless it is the last one
+        """
+        if not pager:
+            return content
+        if pager['type'] == 'aspnet-postback':
+            link = "__doPostBack('%s','%%d')" % pager['event_target'].encode('utf-8')
+            anchor = '<a href="javascript:%s">next</a>' % link
+        else:
+            link = '%s=%%d' % pager['parameter'].encode('utf-8')
+            anchor = '<a href="?%s">next</a>' % link
+        # what the sample page links to
+        content = re.sub(re.escape(link % (page + 1)) + r'(?!\d)', link % 0, content)
+        if page < self.pages:
+            content += anchor % (page + 1)
+        return content
+
+    def respond(self, host, path, form):
+        """
+        :param host: the virtual host the request is for
+        :param path: its path and query string
+        :param form: dict of the form fields posted, if any
+        :return: tuple (status, body), status None for closing the
+                 connection without responding
+        """
+        m = __mock_host__.match(host.lower())
+        if not m or m.group('template') not in self.templates:
+            self.count('not_found')
+            return 404, 'unknown virtual host %s\n' % host
+        if self.latency:
+            with self.lock:
+                delay = self.random.expovariate(1.0 / self.latency)
+            time.sleep(delay)
+        if self.is_down(host) or self.draw() < self.reset_rate:
+            self.count('resets')
+            return None, None
+        if self.draw() < self.error_rate:
+            self.count('errors')
+            return (503 if self.draw() < 0.5 else 500), 'mock failure\n'
+        content, pager = self.templates[m.group('template')]
+        page = self.page_of(pager, parse_qs(urlparse(path).query), form)
+        if page > 1:
+            content = self.tag_links(content, 'p%d' % page)
+        if self.new_rows:
+            content = self.tag_links(content, 'g%d' % int(time.time() / self.churn), self.new_rows)
+        content = self.with_pager_links(content, pager, page)
+        if self.draw() < self.oversize_rate:
+            self.count('oversized')
+            padding = '<!--%s-->' % (' ' * max(self.oversize_bytes - len(content), 0))
+            m = __head_end__.search(content)
+            at = m.end() if m else 0
+            content = content[:at] + padding + content[at:]
+        self.count('pages')
+        self.count('bytes', len(content))
+        return 200, content
+
+
+class MockPortalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # so that the sessions of the crawler keep their connections
+
+    def target(self):
+        """
+        :return: tuple (virtual host, path and query string) of the request,
+                 whether it is made to a proxy or not
+        """
+        u = urlparse(self.path)
+        if u.netloc:
+            return u.netloc, urlunparse(('', '', u.path, u.params, u.query, ''))
+        return self.headers.get('Host', ''), self.path
+
+    def handle_request(self, form):
+        host, path = self.target()
+        if path == '/_stats':
+            with self.server.portal.lock:
+                self.send_body(200, json.dumps(self.server.portal.counters, sort_keys=True) + '\n',
+                               'application/json')
+            return
+        status, body = self.server.portal.respond(host, path, form)
+        if status is None:
+            self.close_connection = 1
+            return
+        self.send_body(status, body, 'text/html')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for i in xrange(0, len(body), 64 * 1024):
+            self.wfile.write(body[i:i + 64 * 1024])
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = dict((k, v[-1]) for k, v in parse_qs(self.rfile.read(length), keep_blank_values=True).iteritems())
+        self.handle_request(form)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class MockPortalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, portal, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockPortalHandler)
+        self.portal = portal
+        self.verbose = verbose
+
+    def handle_error(self, request, client_address):
+        if sys is None:  # the interpreter is exiting, with connections still open
+            return
+        if not isinstance(sys.exc_info()[1], socket.error):  # the crawler giving up on a response is fine
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+def start_server(portal, port=0, bind='127.0.0.1'):
+    """
+    Serves portal from a thread of its own.
+
+    :param port: 0 for any free one
+    :return: the MockPortalServer object; shutdown() stops it
+    """
+    server = MockPortalServer((bind, port), portal)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def default_catalogue():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flows.json')
+
+
+def main_serve(argv):
+    parser = argparse.ArgumentParser(prog='%s serve' % sys.argv[0],
+                                     description='Serves the virtual hosts of the mock portal, as an HTTP proxy.')
+    parser.add_argument('--port', type=int, default=8770, help='(default: 8770)')
+    parser.add_argument('--bind', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--catalogue', metavar='PATH', default=default_catalogue(),
+                        help='the flows whose sample pages are served (default: flows.json)')
+    parser.add_argument('--pages', type=int, default=1, help='number of pages of the listings (default: 1)')
+    parser.add_argument('--new-rows', type=int, default=0,
+                        help='number of rows at the top of the listings that are new every --churn seconds '
+                             '(default: 0)')
+    parser.add_argument('--churn', type=float, default=60, help='(default: 60)')
+    parser.add_argument('--latency', type=float, default=0, help='mean response time, in ms (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of the requests failing with a 500 or 503 (default: 0)')
+    parser.add_argument('--reset-rate', type=float, default=0,
+                        help='fraction of the requests whose connection is closed (default: 0)')
+    parser.add_argument('--down-rate', type=float, default=0,
+                        help='fraction of the virtual hosts that never respond (default: 0)')
+    parser.add_argument('--oversize-rate', type=float, default=0,
+                        help='fraction of the pages padded up to --oversize-bytes (default: 0)')
+    parser.add_argument('--oversize-bytes', type=int, default=16 * 1024 * 1024, help='(default: 16 MB)')
+    parser.add_argument('--seed', type=int, help='of the random decisions, for repeatable runs')
+    parser.add_argument('--verbose', action='store_true', help='log the requests')
+    args = parser.parse_args(argv)
+    entries, templates = load_templates(args.catalogue)
+    portal = MockPortal(templates, args.pages, args.new_rows, args.churn, args.latency / 1000.0, args.error_rate,
+                        args.reset_rate, args.down_rate, args.oversize_rate, args.oversize_bytes, args.seed)
+    server = MockPortalServer((args.bind, args.port), portal, args.verbose)
+    print '#Info: serving %d sample pages at http://%s:%d/ (use it as http_proxy)' % (
+        len(templates), args.bind, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print '#Info: %s' % json.dumps(portal.counters, sort_keys=True)
+
+
+def main_flows(argv):
+    parser = argparse.ArgumentParser(prog='%s flows' % sys.argv[0],
+                                     description='Writes a catalogue of flows at the virtual hosts of the mock '
+                                                 'portal (see crawl.py --catalogue).')
+    parser.add_argument('--count', type=int, default=190, help='number of flows (default: 190)')
+    parser.add_argument('--catalogue', metavar='PATH', default=default_catalogue(),
+                        help='the flows copied (default: flows.json)')
+    parser.add_argument('-o', '--output', metavar='PATH', help='where to write the catalogue (default: stdout)')
+    args = parser.parse_args(argv)
+    entries, templates = load_templates(args.catalogue)
+    text = json.dumps({'flows': mock_entries(entries, args.count)}, ensure_ascii=False, indent=1, sort_keys=True,
+                      separators=(',', ': ')).encode('utf-8') + '\n'
+    if args.output:
+        with open(args.output, 'wb') as h:
+            h.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+COMMANDS = {
+    'serve': main_serve,
+    'flows': main_flows,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        sys.exit('usage: %s {%s} ...' % (sys.argv[0], ','.join(sorted(COMMANDS))))
+    COMMANDS[sys.argv[1]](sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()
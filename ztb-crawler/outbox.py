@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import threading
+from metrics import write_file_replacing
+from filelock import file_lock
+
+
+class Outbox(object):
+    def __init__(self, directory, matcher=None):
+        """
+        Durable spool of the new records waiting to be delivered, read by any
+        number of consumers (see delivery.py), each at its own offset.
+
+        The spool is a series of append-only segment files of JSON lines,
+        each named after the offset of its first byte, offsets counting the
+        bytes written since the spool was created. A consumer acks the
+        offset it has delivered up to, and resumes from there; segments all
+        consumers are past are removed by compact(). Processes sharing the
+        spool (e.g. those of a lease queue) append to it in turn, under a
+        lock on the .lock file of the directory.
+
+        :param directory: where the segments and the offsets are kept
+        :param matcher: subscriptions.SubscriptionMatcher object the
+                        records are tagged with the subscribers of, if any
+        :return:
+        """
+        self.directory = directory
+        self.matcher = matcher
+        self.lock = threading.Lock()
+        for path in (directory, os.path.join(directory, 'offsets')):
+            if not os.access(path, os.R_OK):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    pass
+
+    segment_size = 4 * 1024 * 1024  # bytes after which the next segment is started
+    __segment_name__ = re.compile(r'^(\d{20})\.jsonl$')
+
+    def lock_path(self):
+        return os.path.join(self.directory, '.lock')
+
+    def segment_path(self, start):
+        return os.path.join(self.directory, '%020d.jsonl' % start)
+
+    def segments(self):
+        """
+        :return: the offsets the segments start at, in order
+        """
+        starts = []
+        for name in os.listdir(self.directory):
+            m = self.__segment_name__.match(name)
+            if m:
+                starts.append(int(m.group(1)))
+        return sorted(starts)
+
+    def end(self):
+        """
+        :return: the offset the next record will be written at
+        """
+        starts = self.segments()
+        if not starts:
+            return 0
+        return starts[-1] + os.path.getsize(self.segment_path(starts[-1]))
+
+    def append(self, records):
+        """
+        :param records: list of dicts, written and synced to disk together
+        """
+        if not records:
+            return
+        lines = ''.join([json.dumps(r, sort_keys=True) + '\n' for r in records])
+        with self.lock:
+            with file_lock(self.lock_path()):  # the size and the name of the next segment are those on disk
+                starts = self.segments()
+                start = starts[-1] if starts else 0
+                size = os.path.getsize(self.segment_path(start)) if starts else 0
+                if size >= self.segment_size:
+                    start, size = start + size, 0
+                with open(self.segment_path(start), 'ab') as h:
+                    h.write(lines)
+                    h.flush()
+                    os.fsync(h.fileno())
+
+    def record_of(self, entry):
+        digest, day, data = entry
+        name, t, addr, title, tx = data
+        return {
+            'digest': digest,
+            'name': name,
+            't': t,
+            'addr': addr,
+            'title': title,
+            'collected': tx,
+            'subscribers': self.matcher.match(name, title) if self.matcher else [],
+        }
+
+    def add_batch(self, entries):
+        """
+        Spools the new records, as an observer of the record store (see
+        recordstore.ObservedRecordStore).
+        """
+        self.append([self.record_of(entry) for entry in entries])
+        return len(entries)
+
+    def read(self, offset, max_records):
+        """
+        :param offset: where to read from, as returned by offset() or by
+                       the previous read()
+        :return: list of (record, offset of the record after it); a line
+                 still being written (not ending with a newline) is left
+                 for the next time
+        """
+        starts = self.segments()
+        found = []
+        for i, start in enumerate(starts):
+            following = starts[i + 1] if i + 1 < len(starts) else None
+            if following is not None and following <= offset:
+                continue
+            if start > offset:
+                offset = start  # the segments before have been compacted away
+            with open(self.segment_path(start), 'rb') as h:
+                h.seek(offset - start)
+                while len(found) < max_records:
+                    line = h.readline()
+                    if not line.endswith('\n'):
+                        break
+                    offset += len(line)
+                    found.append((json.loads(line), offset))
+            if len(found) >= max_records:
+                break
+        return found
+
+    def offset_path(self, consumer):
+        return os.path.join(self.directory, 'offsets', consumer)
+
+    def consumers(self):
+        return sorted(os.listdir(os.path.join(self.directory, 'offsets')))
+
+    def offset(self, consumer):
+        """
+        :return: the offset consumer has acked, or the start of the oldest
+                 segment for a new consumer
+        """
+        try:
+            with open(self.offset_path(consumer), 'r') as h:
+                return int(h.read().strip())
+        except (IOError, ValueError):
+            starts = self.segments()
+            return starts[0] if starts else 0
+
+    def ack(self, consumer, offset):
+        write_file_replacing(self.offset_path(consumer), u'%d\n' % offset)
+
+    def compact(self):
+        """
+        Removes the segments all the consumers have read past (the last one
+        always stays, being the one written to).
+
+        :return: the number of segments removed
+        """
+        consumers = self.consumers()
+        if not consumers:
+            return 0
+        low = min([self.offset(c) for c in consumers])
+        removed = 0
+        with file_lock(self.lock_path()):
+            starts = self.segments()
+            for start, following in zip(starts, starts[1:]):
+                if following > low:
+                    break
+                os.remove(self.segment_path(start))
+                removed += 1
+        return removed
+
+    def close(self):
+        pass
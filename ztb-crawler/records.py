@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from collections import namedtuple
+
+
+class Record(namedtuple('Record', ['name', 't', 'addr', 'title', 'collected'])):
+    """
+    A record, as emitted by the generators:
+      name: the name of the flow, i.e. the city
+      t: the time of the article as shown in the listing, if any
+      addr: the url of the article
+      title: its title
+      collected: when it was collected, 'YYYY-mm-dd HH:MM:SS'
+    Immutable (changes make new records, see _replace()) and without a
+    __dict__; still a sequence of the five fields, as the lists generators
+    used to return.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, t, addr, title, collected):
+        return super(Record, cls).__new__(cls, intern_name(name), t, addr, title, collected)
+
+
+__names__ = {}
+
+
+def intern_name(name):
+    """
+    :return: the one copy of name kept for all the records of the same city
+             (intern() only takes str in Python 2)
+    """
+    return __names__.setdefault(name, name)
+
+
+def collection_time():
+    """
+    :return: the time point the records collected now are stamped with
+    """
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import codecs
+import sqlite3
+import threading
+from records import Record
+
+
+class RecordStore(object):
+    """
+    Where the collected records are kept, and what tells new records from the
+    ones seen before.
+
+    Records are handed over in batches (typically all the records of one
+    flow), as lists of entries (digest, day, data) where
+      digest: the md5 hex digest of the record's address, the dedup key
+      day: tuple (t1, t2) of the 'YYYY-mm' and 'dd' parts of the record time
+      data: the Record (flow.name, time_as_in_article, addr, title,
+            collected-time-point)
+    """
+
+    def add_batch(self, entries):
+        """
+        :param entries: list of (digest, day, data) tuples
+        :return: list of (data, locator) of the entries that are new, locator
+                 being a human-readable description of where it is stored
+        """
+        raise NotImplementedError
+
+    def add_details(self, entry, details):
+        """
+        Keeps the details of the article of a record (see details.py) with
+        the record.
+
+        :param entry: tuple (digest, day, data) of the record
+        :param details: dict with the keys text, budget, budget_text,
+                        deadline, url and fetched
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def format_line(data):
+        return '  '.join(data) + '\n'
+
+    @staticmethod
+    def parse_line(line):
+        """
+        Inverse of format_line(). Titles may themselves contain two spaces,
+        so the fields around them are taken from both ends of the line.
+        """
+        line = line.rstrip('\r\n')
+        name, t, addr, rest = line.split('  ', 3)
+        title, tx = rest.rsplit('  ', 1)
+        return Record(name, t, addr, title, tx)
+
+
+class DirectoryRecordStore(RecordStore):
+    def __init__(self, prefix):
+        """
+        The original layout: one file per record at prefix/name/t1/t2/digest.
+
+        :param prefix: the top directory of the tree
+        :return:
+        """
+        self.prefix = prefix
+        self.known_paths = set()
+        self.lock = threading.Lock()
+
+    def path_of(self, name, day):
+        t1, t2 = day
+        return '/'.join([self.prefix, name, t1, t2])
+
+    def ensure_path_exists(self, path):
+        with self.lock:
+            if path in self.known_paths:
+                return
+        if not os.access(path, os.R_OK):
+            try:
+                os.makedirs(path)
+            except OSError:  # may have been created by another thread meanwhile
+                pass
+        assert os.access(path, os.R_OK)
+        with self.lock:
+            self.known_paths.add(path)
+
+    def add_batch(self, entries):
+        created = []
+        for digest, day, data in entries:
+            path = self.path_of(data[0], day)
+            self.ensure_path_exists(path)
+            f = path + '/' + digest
+            if not os.access(f, os.W_OK):
+                with codecs.open(f, 'w', 'utf-8') as h:
+                    h.write(self.format_line(data))
+                created.append((data, 'in file "%s"' % f))
+        return created
+
+    def add_details(self, entry, details):
+        digest, day, data = entry
+        f = self.path_of(data[0], day) + '/' + digest + '.details.json'
+        with codecs.open(f, 'w', 'utf-8') as h:
+            h.write(json.dumps(details, ensure_ascii=False, indent=1, sort_keys=True,
+                               separators=(',', ': ')) + '\n')
+
+    def walk(self):
+        """
+        Yields (digest, day, data) for every record in the tree.
+        """
+        prefix = self.prefix
+        if not isinstance(prefix, unicode):  # so that os.listdir() yields unicode names
+            prefix = prefix.decode(sys.getfilesystemencoding() or 'utf-8')
+        for name in sorted(os.listdir(prefix)):
+            name_path = os.path.join(prefix, name)
+            if name.startswith('.') or not os.path.isdir(name_path):
+                continue
+            for t1 in sorted(os.listdir(name_path)):
+                t1_path = os.path.join(name_path, t1)
+                if not os.path.isdir(t1_path):
+                    continue
+                for t2 in sorted(os.listdir(t1_path)):
+                    t2_path = os.path.join(t1_path, t2)
+                    if not os.path.isdir(t2_path):
+                        continue
+                    for digest in sorted(os.listdir(t2_path)):
+                        if '.' in digest:  # e.g. the .details.json files
+                            continue
+                        with codecs.open(os.path.join(t2_path, digest), 'r', 'utf-8') as h:
+                            line = h.readline()
+                        try:
+                            data = self.parse_line(line)
+                        except ValueError:
+                            continue
+                        yield digest, (t1, t2), data
+
+
+class SQLiteRecordStore(RecordStore):
+    def __init__(self, path):
+        """
+        All records in one SQLite database, indexed by digest; each batch is
+        inserted in a single transaction.
+
+        :param path: path of the database file
+        :return:
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS records ('
+            ' digest TEXT PRIMARY KEY,'
+            ' name TEXT NOT NULL,'
+            ' month TEXT NOT NULL,'
+            ' day TEXT NOT NULL,'
+            ' t TEXT,'
+            ' addr TEXT NOT NULL,'
+            ' title TEXT,'
+            ' collected TEXT)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS details ('
+            ' digest TEXT PRIMARY KEY REFERENCES records (digest),'
+            ' url TEXT NOT NULL,'
+            ' text TEXT,'
+            ' budget REAL,'
+            ' budget_text TEXT,'
+            ' deadline TEXT,'
+            ' fetched TEXT)')
+        self.conn.commit()
+
+    def add_batch(self, entries):
+        created = []
+        with self.lock:
+            with self.conn:  # one transaction for the whole batch
+                for digest, day, data in entries:
+                    name, t, addr, title, tx = data
+                    c = self.conn.execute(
+                        'INSERT OR IGNORE INTO records (digest, name, month, day, t, addr, title, collected)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (digest, name, day[0], day[1], t, addr, title, tx))
+                    if c.rowcount == 1:
+                        created.append((data, 'with digest %s in "%s"' % (digest, self.path)))
+        return created
+
+    def add_details(self, entry, details):
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO details (digest, url, text, budget, budget_text, deadline, fetched)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (entry[0], details['url'], details['text'], details['budget'], details['budget_text'],
+                     details['deadline'], details['fetched']))
+
+    def walk(self):
+        """
+        Yields (digest, day, data) for every record in the database.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT digest, month, day, name, t, addr, title, collected FROM records ORDER BY rowid').fetchall()
+        for r in rows:
+            yield r[0], (r[1], r[2]), Record(*r[3:])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ObservedRecordStore(RecordStore):
+    def __init__(self, store, observers, duplicates=None):
+        """
+        A record store that also hands the new records over to observers,
+        e.g. an index.RecordIndex object.
+
+        :param store: the RecordStore object the records are kept in
+        :param observers: objects with the methods add_batch(entries), called
+                          with the entries of the new records only, and
+                          close()
+        :param duplicates: duplicates.DuplicateDetector object the new
+                           records are linked to the records they duplicate
+                           by, if any; the duplicates then only go to the
+                           observers whose all_records attribute is true
+        :return:
+        """
+        self.store = store
+        self.observers = observers
+        self.duplicates = duplicates
+
+    def add_batch(self, entries):
+        created = self.store.add_batch(entries)
+        new = set([id(data) for data, locator in created])
+        new_entries = [entry for entry in entries if id(entry[2]) in new]
+        unique_entries = new_entries
+        if self.duplicates:
+            canonicals = self.duplicates.link_batch(new_entries)
+            unique_entries = [entry for entry in new_entries if entry[0] not in canonicals]
+        for observer in self.observers:
+            observer.add_batch(new_entries if getattr(observer, 'all_records', False) else unique_entries)
+        return created
+
+    def add_details(self, entry, details):
+        self.store.add_details(entry, details)
+
+    def walk(self):
+        return self.store.walk()
+
+    def close(self):
+        self.store.close()
+        for observer in self.observers:
+            observer.close()
+        if self.duplicates:
+            self.duplicates.close()
+
+
+def migrate_directory_tree(prefix, store, batch_size=1000):
+    """
+    Imports the records of a DirectoryRecordStore tree into another store.
+
+    :return: tuple (number of records read, number of records imported)
+    """
+    read = imported = 0
+    batch = []
+    for entry in DirectoryRecordStore(prefix).walk():
+        batch.append(entry)
+        read += 1
+        if len(batch) >= batch_size:
+            imported += len(store.add_batch(batch))
+            batch = []
+    if batch:
+        imported += len(store.add_batch(batch))
+    return read, imported
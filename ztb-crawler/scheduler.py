@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import heapq
+import random
+import datetime
+
+
+def parse_quiet_hours(s):
+    """
+    :param s: string like '23:00-06:30' (or '23-6'), in local time; the
+              window may run across midnight
+    :return: tuple (start, end) in minutes since midnight, or None if s is
+             empty
+    """
+    if not s:
+        return None
+
+    def minutes(t):
+        h, _, m = t.strip().partition(':')
+        h, m = int(h), int(m or 0)
+        if not (0 <= h <= 24 and 0 <= m < 60):
+            raise ValueError('invalid time of day "%s"' % t)
+        return (h * 60 + m) % (24 * 60)
+
+    start, sep, end = s.partition('-')
+    if not sep:
+        raise ValueError('quiet hours shall be like 23:00-06:30, not "%s"' % s)
+    return minutes(start), minutes(end)
+
+
+class FlowSchedule(object):
+    def __init__(self, key, interval):
+        """
+        :param key: what identifies the flow, typically its url
+        :param interval: current polling interval in seconds
+        """
+        self.key = key
+        self.interval = interval
+        self.failures = 0  # consecutive ones
+        self.due = None
+        self.version = 0   # invalidates the stale entries of the queue
+
+
+class AdaptiveScheduler(object):
+    def __init__(self, interval=1800, min_interval=300, max_interval=6 * 3600, max_backoff=24 * 3600,
+                 quiet_hours=None, jitter=0.1, state_path=None):
+        """
+        Priority queue of flows by the time they are next due, each with its
+        own polling interval: the interval is halved after a poll finding
+        new records and grows by half after one finding none, within
+        [min_interval, max_interval]. Failed polls are retried after an
+        exponential backoff (up to max_backoff) that leaves the interval
+        alone. No poll is due during the quiet hours.
+
+        :param interval: initial interval of the flows, in seconds
+        :param quiet_hours: tuple (start, end) as from parse_quiet_hours()
+        :param jitter: fraction of the delays randomized, so that flows do
+                       not stay in lockstep
+        :param state_path: JSON file the learned intervals are kept in across
+                           restarts, if any
+        """
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.quiet_hours = quiet_hours
+        self.jitter = jitter
+        self.state_path = state_path
+        self.schedules = {}
+        self.queue = []  # (due, version, key)
+        self.saved = self.load_state()
+
+    def load_state(self):
+        if not (self.state_path and os.access(self.state_path, os.R_OK)):
+            return {}
+        try:
+            with open(self.state_path, 'r') as h:
+                return json.load(h)
+        except ValueError:
+            return {}
+
+    def save_state(self):
+        if not self.state_path:
+            return
+        state = dict((k, {'interval': s.interval, 'failures': s.failures})
+                     for k, s in self.schedules.iteritems())
+        with open(self.state_path, 'w') as h:
+            json.dump(state, h, indent=1, sort_keys=True, separators=(',', ': '))
+
+    def add(self, key, due=None):
+        s = FlowSchedule(key, self.interval)
+        saved = self.saved.get(key)
+        if saved:
+            s.interval = min(max(saved['interval'], self.min_interval), self.max_interval)
+            s.failures = saved['failures']
+        self.schedules[key] = s
+        self.schedule(s, due if due is not None else time.time())
+
+    def remove(self, key):
+        self.schedules.pop(key, None)  # its queue entries are skipped from now on
+
+    def schedule(self, s, due):
+        s.due = self.after_quiet_hours(due)
+        s.version += 1
+        heapq.heappush(self.queue, (s.due, s.version, s.key))
+
+    def after_quiet_hours(self, t):
+        """
+        :return: t, or the end of the quiet hours t falls within
+        """
+        if not self.quiet_hours:
+            return t
+        start, end = self.quiet_hours
+        dt = datetime.datetime.fromtimestamp(t)
+        minute = dt.hour * 60 + dt.minute
+        if start <= end:
+            quiet = start <= minute < end
+        else:  # across midnight
+            quiet = minute >= start or minute < end
+        if not quiet:
+            return t
+        end_dt = dt.replace(hour=end // 60, minute=end % 60, second=0, microsecond=0)
+        if end_dt <= dt:
+            end_dt += datetime.timedelta(days=1)
+        return time.mktime(end_dt.timetuple())
+
+    def next_due(self):
+        """
+        :return: the time the next flow is due, None if there is none
+        """
+        while self.queue:
+            due, version, key = self.queue[0]
+            s = self.schedules.get(key)
+            if s is not None and s.version == version:
+                return due
+            heapq.heappop(self.queue)
+        return None
+
+    def pop_due(self, now=None):
+        """
+        :return: the keys of the flows due at now, most overdue first; they
+                 are out of the queue until report() is called for them
+        """
+        now = now if now is not None else time.time()
+        keys = []
+        while self.queue and self.queue[0][0] <= now:
+            due, version, key = heapq.heappop(self.queue)
+            s = self.schedules.get(key)
+            if s is not None and s.version == version:
+                keys.append(key)
+        return keys
+
+    def jittered(self, delay):
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def next_poll(self, interval, failures, succeeded, new_records):
+        """
+        The policy of report(), for flows whose schedule is kept elsewhere
+        (see leases.LeaseQueue).
+
+        :param interval: the current interval of the flow
+        :param failures: its number of consecutive failed polls
+        :return: tuple (interval, failures, delay until the next poll)
+        """
+        if succeeded:
+            failures = 0
+            if new_records:
+                interval = max(self.min_interval, interval / 2.0)
+            else:
+                interval = min(self.max_interval, interval * 1.5)
+            delay = interval
+        else:
+            failures += 1
+            delay = min(self.max_backoff, self.min_interval * 2 ** failures)
+        return interval, failures, self.jittered(delay)
+
+    def report(self, key, succeeded, new_records, now=None):
+        """
+        Tells how the poll of a flow went, which schedules its next one.
+
+        :return: the delay until the next poll, in seconds
+        """
+        now = now if now is not None else time.time()
+        s = self.schedules.get(key)
+        if s is None:
+            return None
+        s.interval, s.failures, delay = self.next_poll(s.interval, s.failures, succeeded, new_records)
+        self.schedule(s, now + delay)
+        return delay
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import codecs
+import threading
+from index import normalize_text
+
+
+class AhoCorasick(object):
+    def __init__(self):
+        """
+        Automaton finding all the occurrences of many patterns in a text in
+        a single pass over it, whatever the number of patterns.
+        """
+        self.goto = [{}]     # node -> {character: node}
+        self.fail = [0]      # node -> node of the longest proper suffix
+        self.outputs = [[]]  # node -> values of the patterns ending there
+        self.built = True
+
+    def add(self, pattern, value):
+        """
+        :param value: what find() yields when pattern is found
+        """
+        node = 0
+        for c in pattern:
+            following = self.goto[node].get(c)
+            if following is None:
+                following = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.goto[node][c] = following
+            node = following
+        self.outputs[node].append(value)
+        self.built = False
+
+    def build(self):
+        """
+        Computes the failure links, breadth first; to be called once all the
+        patterns have been added.
+        """
+        queue = list(self.goto[0].itervalues())
+        for node in queue:
+            self.fail[node] = 0
+        i = 0
+        while i < len(queue):
+            node = queue[i]
+            i += 1
+            for c, following in self.goto[node].iteritems():
+                queue.append(following)
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(c, 0)
+                self.fail[following] = f if f != following else 0
+                self.outputs[following] = self.outputs[following] + self.outputs[self.fail[following]]
+        self.built = True
+
+    def find(self, text):
+        """
+        Yields the values of the patterns found in text, once per occurrence.
+        """
+        assert self.built, 'build() shall be called after add()'
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        for c in text:
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for value in outputs[node]:
+                yield value
+
+
+class Subscriber(object):
+    def __init__(self, name, keywords=(), cities=(), exclude=()):
+        """
+        :param name: what the subscriber is known by, also the name of the
+                     directory the records routed to it are written to
+        :param keywords: a record is routed to the subscriber if its title
+                         contains any of them (any record if there are none)
+        :param cities: ... and if the name of its city (of its flow) contains
+                       any of them (whatever the city if there are none)
+        :param exclude: ... and unless its title contains any of them
+        """
+        self.name = name
+        self.keywords = [normalize_text(k) for k in keywords if k.strip()]
+        self.cities = [c for c in cities if c.strip()]
+        self.exclude = [normalize_text(k) for k in exclude if k.strip()]
+
+    @classmethod
+    def from_dict(cls, d):
+        name = d.get('name')
+        if not isinstance(name, basestring) or not name.strip() or '/' in name or '\\' in name or \
+                name.startswith('.'):
+            raise ValueError('invalid subscriber name %r' % (name,))
+        lists = []
+        for key in ('keywords', 'cities', 'exclude'):
+            v = d.get(key, [])
+            if isinstance(v, basestring):
+                v = [v]
+            if not all(isinstance(s, basestring) for s in v):
+                raise ValueError('%s of subscriber "%s" shall be strings' % (key, name))
+            lists.append(v)
+        return cls(name, *lists)
+
+
+class SubscriptionMatcher(object):
+    KEYWORD, EXCLUSION = 0, 1
+
+    def __init__(self, subscribers):
+        """
+        Tells the subscribers a record is to be routed to with one pass of
+        an AhoCorasick automaton of all their keywords and exclusions over
+        the title, then only looks at the subscribers it hit (and at those
+        without keywords).
+
+        :param subscribers: list of Subscriber objects
+        """
+        self.subscribers = subscribers
+        self.automaton = AhoCorasick()
+        self.catch_all = []  # indices of the subscribers without keywords
+        for i, s in enumerate(subscribers):
+            for k in s.keywords:
+                self.automaton.add(k, (self.KEYWORD, i))
+            for k in s.exclude:
+                self.automaton.add(k, (self.EXCLUSION, i))
+            if not s.keywords:
+                self.catch_all.append(i)
+        self.automaton.build()
+        self.by_city = {}  # city (flow) name -> indices of the subscribers of it
+        self.lock = threading.Lock()
+
+    def subscribers_of_city(self, city):
+        with self.lock:
+            indices = self.by_city.get(city)
+            if indices is None:
+                indices = frozenset([i for i, s in enumerate(self.subscribers)
+                                     if not s.cities or any(c in city for c in s.cities)])
+                self.by_city[city] = indices
+            return indices
+
+    def match(self, city, title):
+        """
+        :return: the names of the subscribers the record is routed to
+        """
+        hits, excluded = set(self.catch_all), set()
+        for kind, i in self.automaton.find(normalize_text(title or u'')):
+            (hits if kind == self.KEYWORD else excluded).add(i)
+        indices = (hits - excluded) & self.subscribers_of_city(city)
+        return [self.subscribers[i].name for i in sorted(indices)]
+
+
+def load_subscribers(path):
+    """
+    Reads a subscriptions file, in JSON:
+      {"subscribers": [
+        {"name": "alice", "keywords": ["监理", "勘察"], "cities": ["南京", "镇江"], "exclude": ["中标"]},
+        ...]}
+
+    :return: list of Subscriber objects
+    """
+    with codecs.open(path, 'r', 'utf-8') as h:
+        try:
+            config = json.load(h)
+        except ValueError as e:
+            raise ValueError('%s: %s' % (path, e))
+    if not isinstance(config, dict) or not isinstance(config.get('subscribers'), list):
+        raise ValueError('%s: a "subscribers" list is expected' % path)
+    subscribers = [Subscriber.from_dict(d) for d in config['subscribers']]
+    names = [s.name for s in subscribers]
+    if len(set(names)) != len(names):
+        raise ValueError('%s: subscriber names shall be unique' % path)
+    return subscribers
+
+
+class SubscriptionRouter(object):
+    def __init__(self, subscribers, directory):
+        """
+        Routes the new records to their subscribers (as an observer of the
+        record store, see recordstore.ObservedRecordStore) and writes them to
+        directory/<subscriber>/, in logs with an .is-new flag as the main one
+        is, so that sender.vbs can be run on the directory of a subscriber.
+
+        :param subscribers: list of Subscriber objects
+        :param directory: where the directories of the subscribers are
+        """
+        self.matcher = SubscriptionMatcher(subscribers)
+        self.directory = directory
+        self.pending = {}  # subscriber name -> records routed since the last flush()
+        self.lock = threading.Lock()
+
+    def add_batch(self, entries):
+        routed = 0
+        for digest, day, data in entries:
+            for name in self.matcher.match(data[0], data[3]):
+                with self.lock:
+                    self.pending.setdefault(name, []).append(data)
+                routed += 1
+        return routed
+
+    def flush(self, log_name, timestamp):
+        """
+        Writes the records routed since the last call to the logs of their
+        subscribers.
+
+        :param log_name: file name of the logs, e.g. that of the main log
+        :param timestamp: what the .is-new flags are written with
+        :return: dict subscriber name -> number of records written
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        written = {}
+        for name, records in sorted(pending.iteritems()):
+            path = os.path.join(self.directory, name)
+            if not os.access(path, os.R_OK):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    pass
+            log = os.path.join(path, log_name)
+            records.sort(key=lambda data: (data[0], data[2]))  # whatever the order the flows finished in
+            with codecs.open(log, 'a', 'utf-8') as h:
+                h.write(u'#Info: %d new records for subscriber "%s"\n' % (len(records), name))
+                for data in records:
+                    h.write(u'  '.join(data) + u'\n')
+            with codecs.open(log + '.is-new', 'w', 'utf-8') as h:
+                h.write(timestamp + '\n')
+            written[name] = len(records)
+        return written
+
+    def close(self):
+        pass